@@ -20,7 +20,7 @@
 """
 
 import argparse
-import glob
+import functools
 import logging
 import multiprocessing
 import os
@@ -28,7 +28,10 @@ import smtplib
 import sys
 import time
 import traceback
+import uuid
 from functools import wraps
+from multiprocessing.pool import ThreadPool
+from threading import Thread
 
 import yaml
 
@@ -43,6 +46,18 @@ from .pypdfocr_filer_dirs import PyFilerDirs
 from .pypdfocr_filer_evernote import ENABLED as evernote_enabled
 from .pypdfocr_filer_evernote import PyFilerEvernote
 from .pypdfocr_preprocess import PyPreprocess
+from .pypdfocr_blank import PyBlankDetector
+from .pypdfocr_orientation import PyOrientation, restore_hocr
+from .pypdfocr_interrupts import (WorkerExit, exit_as_exception,
+                                  map_in_shared_pool)
+from .pypdfocr_batch import PyBatch
+from .pypdfocr_cache import PyCache
+from .pypdfocr_checkpoint import PyCheckpoint
+from .pypdfocr_cpu import PyCpuBudget, get_cpu_count
+from .pypdfocr_scratch import PyDeleteQueue, PyScratch
+from .pypdfocr_server import PyJobQueue, make_server
+from .pypdfocr_stats import (PyHistograms, PyStats, bind_stats, timed,
+                             use_stats, write_report)
 from .version import __version__
 
 
@@ -102,9 +117,16 @@ class PyPDFOCR(object):
         self.config = None
         self.gs = None
         self.ts = None
+        self.pdf_cache = None
+        self.delete_queue = None
         self.preprocess = None
+        self.blank = None
+        self.orientation = None
         self.filer = None
         self.pdf_filer = None
+        self.pool = None
+        self.budget = None
+        self.histograms = None
 
     @staticmethod
     def _get_config_file(config_file):
@@ -132,6 +154,8 @@ class PyPDFOCR(object):
             :ivar enable_filing: Whether to enable post-OCR filing of PDFs
             :ivar pdf_filename: Filename for single conversion mode
             :ivar watch_dir: Directory to watch for files to convert
+            :ivar batch_paths: Files, directories and globs for batch mode
+            :ivar serve_address: Address to take jobs on in service mode
             :ivar config: Dict of the config file
             :ivar watch: Whether folder watching mode is turned on
             :ivar enable_evernote: Enable filing to evernote
@@ -184,8 +208,42 @@ class PyPDFOCR(object):
                             dest='skip_preprocess',
                             help='DEPRECATED: Preprocessing is skipped by default.')
 
+        parser.add_argument('--stream', action='store_true', default=False,
+                            dest='stream',
+                            help='Start OCR on each page as soon as it is'
+                            ' rendered instead of waiting for the whole'
+                            ' document')
+
+        parser.add_argument('--scratch-dir', default=None, dest='scratch_dir',
+                            help='Write the page images and other'
+                            ' intermediate files to a new directory under'
+                            ' SCRATCH_DIR (e.g. /dev/shm) instead of the'
+                            ' system temporary directory')
+
+        parser.add_argument('--checkpoint-dir', default=None,
+                            dest='checkpoint_dir',
+                            help='Keep the intermediate files of each'
+                            ' conversion in a directory under CHECKPOINT_DIR'
+                            ' until it is done, so a conversion that is'
+                            ' interrupted can be resumed by running it again')
+
+        parser.add_argument('--stats-dir', default=None, dest='stats_dir',
+                            help='Write a JSON report of how long each'
+                            ' stage of each conversion took to STATS_DIR,'
+                            ' along with histograms of the timings of all'
+                            ' the conversions')
+
+        parser.add_argument('--force-ocr', action='store_true', default=False,
+                            dest='force_ocr',
+                            help='OCR every page, even the ones that already'
+                            ' have text or are blank')
+
+        parser.add_argument('--drop-blank', action='store_true',
+                            default=False, dest='drop_blank',
+                            help='Leave blank pages out of the OCR\'ed pdf')
+
         #---------
-        # Single or watch mode
+        # Single, watch or batch mode
         #--------
         single_or_watch_group = parser.add_mutually_exclusive_group(required=True)
         # Positional argument for single file conversion
@@ -195,6 +253,26 @@ class PyPDFOCR(object):
         single_or_watch_group.add_argument(
             '-w', '--watch', dest='watch_dir',
             help='Watch given directory and run ocr automatically until terminated')
+        # Files, directories and globs for batch mode
+        single_or_watch_group.add_argument(
+            '-b', '--batch', nargs='+', dest='batch_paths', metavar='PATH',
+            help='OCR every pdf in the given files, directories (including'
+            ' subdirectories) and glob patterns, skipping the ones that are'
+            ' already converted')
+        single_or_watch_group.add_argument(
+            '--batch-list', dest='batch_list', metavar='FILE',
+            help='Like --batch, with the paths read from FILE, one per line'
+            ' ("-" for stdin)')
+        # Address for service mode
+        single_or_watch_group.add_argument(
+            '--serve', dest='serve_address', metavar='ADDRESS',
+            help='Run as a service, taking conversion jobs over HTTP on'
+            ' ADDRESS (HOST:PORT, PORT for localhost, or unix:PATH for a'
+            ' Unix socket) until terminated')
+        parser.add_argument(
+            '--manifest', dest='manifest', default=None,
+            help='File to record the result of each pdf of a batch in,'
+            ' one JSON record per line (default pypdfocr_manifest.jsonl)')
 
         #-----------
         # Filing options
@@ -213,9 +291,16 @@ class PyPDFOCR(object):
 
         # Add sub-section defaults which can be set in config file
         parser.set_defaults(**{
+            'threads': get_cpu_count(),
             'ghostscript': {},
             'tesseract': {},
             'preprocess': {},
+            'blank': {},
+            'orientation': {},
+            'watch': {},
+            'batch': {},
+            'server': {},
+            'cache': {},
             'evernote': {},
             'email': {}
             })
@@ -245,28 +330,23 @@ class PyPDFOCR(object):
         # else:
         #     self.enable_filing = False
 
+        # Keep the watch section of the config file, as args.watch is
+        # turned into a flag below
+        args.watch_config = args.watch if isinstance(args.watch, dict) else {}
         args.watch = bool(args.watch_dir)
 
+        if args.batch_list:
+            args.batch_paths = PyBatch.read_file_list(args.batch_list)
+        if args.batch_paths is not None and args.manifest is None:
+            args.manifest = args.batch.get('manifest',
+                                           'pypdfocr_manifest.jsonl')
+
         # TODO: Move email config checking into email module
         # if self.enable_email and not args.email:
         #     parser.error("Please specify a configuration file(CONFIGFILE) to enable email")
 
         return args
 
-    @staticmethod
-    def _clean_up_files(files):
-        """
-            Helper function to delete files
-            :param files: List of files to delete
-            :type files: list
-            :returns: None
-        """
-        for fname in files:
-            try:
-                os.remove(fname)
-            except OSError:
-                logging.debug("Error removing file %s .... continuing", fname)
-
     def _setup_filing(self):
         """
             Instance the proper PyFiler object (either
@@ -344,11 +424,86 @@ class PyPDFOCR(object):
         """
         logging.error(self.config)
         self.gs = PyGs(self.config.ghostscript)
+        self.gs.skip_text_pages = not self.config.force_ocr
         self.ts = PyTesseract(self.config.tesseract)
         self.pdf = PyPdf(self.gs)
         self.preprocess = PyPreprocess(self.config.preprocess)
+        self.blank = PyBlankDetector(self.config.blank)
+        if self.config.force_ocr:
+            self.blank.enabled = False
+        if self.config.drop_blank:
+            self.blank.drop = True
+        self.orientation = PyOrientation(self.config.orientation)
+
+        # One thread pool for all the stages and documents.  The workers
+        # mostly wait on gs/tesseract/convert subprocesses, so threads are
+        # enough, and we avoid forking new workers for every document.
+        self.pool = ThreadPool(processes=self.config.threads)
+        self.gs.pool = self.pool
+        self.ts.pool = self.pool
+        self.preprocess.pool = self.pool
+        # ... and one CPU budget, so the gs, convert and tesseract processes
+        # running for all of them never want more than config.threads CPUs
+        self.budget = PyCpuBudget(self.config.threads)
+        self.gs.budget = self.budget
+        self.ts.budget = self.budget
+        self.preprocess.budget = self.budget
+
+        # Timings of every conversion, for the histograms
+        self.histograms = PyHistograms()
+        if self.config.stats_dir and not os.path.isdir(self.config.stats_dir):
+            os.makedirs(self.config.stats_dir)
+
+        # Clear out the scratch files of earlier runs that crashed
+        PyScratch.sweep(self.config.scratch_dir)
+        self.delete_queue = PyDeleteQueue()
+
+        cache_dir = self.config.cache.get('dir')
+        if cache_dir:
+            self.ts.cache = self._make_cache(cache_dir, 'hocr', '.hocr')
+            if self.config.cache.get('documents', True):
+                self.pdf_cache = self._make_cache(cache_dir, 'pdf', '.pdf')
         return
 
+    def _make_cache(self, cache_dir, name, suffix):
+        """
+            Open one of the caches in the cache directory from the config
+        """
+        # max_size is given in MB
+        max_size = int(self.config.cache.get('max_size', 500)) * 1024 * 1024
+        cache_dir = os.path.join(os.path.expanduser(cache_dir), name)
+        return PyCache(cache_dir, max_size, suffix)
+
+    def _teardown_external_tools(self):
+        """
+            Shut down the shared worker pool and any loaded tesseract
+            engines, and report the cache statistics
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.budget = None
+            for tool in (self.gs, self.ts, self.preprocess):
+                if tool is not None:
+                    tool.pool = tool.budget = None
+        if self.delete_queue is not None:
+            # Give locked files a little while to be let go of
+            if not self.delete_queue.close(timeout=30):
+                logging.warning("Gave up waiting for scratch files to be"
+                                " deleted")
+            self.delete_queue = None
+        if self.ts is not None and self.ts.engines is not None:
+            self.ts.engines.close()
+        if self.ts is not None and self.ts.cache is not None:
+            logging.info("OCR cache: %(hits)d hits, %(misses)d misses,"
+                         " %(evictions)d evictions, %(entries)d entries"
+                         " (%(size)d bytes)", self.ts.cache.stats())
+        if self.pdf_cache is not None:
+            logging.info("Document cache: %(hits)d hits, %(misses)d misses,"
+                         " %(evictions)d evictions, %(entries)d entries"
+                         " (%(size)d bytes)", self.pdf_cache.stats())
+
     def run_conversion(self, pdf_filename):
         """
             Does the following:
@@ -364,59 +519,264 @@ class PyPDFOCR(object):
             :rtype: filename string
         """
         print("Starting conversion of %s" % pdf_filename)
+        self.ts.lang = self.config.lang
+        # All the intermediate files go into a scratch directory for this
+        # conversion, out of the pdf's directory (which may well be a slow
+        # network share), and are removed together at the end
+        checkpoint = None
+        if self.config.checkpoint_dir:
+            checkpoint = PyCheckpoint(self.config.checkpoint_dir,
+                                      pdf_filename, *self._get_settings())
+            scratch = checkpoint
+        else:
+            scratch = PyScratch(self.config.scratch_dir)
+        logging.info("Using scratch directory %s", scratch.path)
+        converted = False
         try:
-            # Make the images for Tesseract
-            img_dpi, glob_img_filename = self.gs.make_img_from_pdf(pdf_filename)
+            # Checkpoints record each page as soon as it is done, which
+            # only the streaming conversion does
+            if self.config.stream or checkpoint is not None:
+                ocr_pdf_filename = self._run_stream_conversion(
+                    pdf_filename, scratch.path, checkpoint)
+            else:
+                ocr_pdf_filename = self._run_staged_conversion(
+                    pdf_filename, scratch.path)
+            converted = True
 
-            fns = glob.glob(glob_img_filename)
+        finally:
+            # Clean up the files in the background, retrying any that are
+            # still locked, so the output is ready as soon as it is written
+            if self.config.debug:
+                logging.info("Leaving intermediate files in %s",
+                             scratch.path)
+                if checkpoint is not None:
+                    checkpoint.close()
+            elif checkpoint is not None and not converted:
+                print("Conversion of %s interrupted, run it again to resume"
+                      " from %s" % (pdf_filename, checkpoint.path))
+                checkpoint.close()
+            else:
+                scratch.cleanup(self.delete_queue)
 
-        except Exception:
-            raise
+        print("Completed conversion successfully to %s" % ocr_pdf_filename)
+        return ocr_pdf_filename
 
-        try:
-            # Preprocess
-            if not self.config.skip_preprocess:
-                preprocess_imagefilenames = self.preprocess.preprocess(fns)
-            else:
-                logging.info("Skipping preprocess step")
-                preprocess_imagefilenames = fns
-            # Run teserract
-            self.ts.lang = self.config.lang
-            hocr_filenames = self.ts.make_hocr_from_pnms(preprocess_imagefilenames)
+    def _run_staged_conversion(self, pdf_filename, scratch_dir=None):
+        """
+            Run each step of the conversion over the whole document before
+            moving on to the next one.
 
-            # Generate new pdf with overlayed text
-            ocr_pdf_filename = self.pdf.overlay_hocr_pages(
-                img_dpi, hocr_filenames, pdf_filename)
+            :returns: OCR'ed PDF filename
+        """
+        # Make the images for Tesseract
+        img_dpi, fns = self.gs.make_img_from_pdf(pdf_filename, scratch_dir)
+        fns, blank_pages = self._find_blank_pages(fns)
+        upright = self._make_upright(fns)
+
+        # Preprocess
+        upright_fns = [upright_fn for upright_fn, _, _ in upright]
+        if not self.config.skip_preprocess:
+            preprocess_imagefilenames = self.preprocess.preprocess(upright_fns)
+        else:
+            logging.info("Skipping preprocess step")
+            preprocess_imagefilenames = upright_fns
+        # Run teserract
+        hocr_filenames = self.ts.make_hocr_from_pnms(preprocess_imagefilenames)
+        # Put the text back where it is on the pages as rendered
+        for (_, hocr_filename), (_, angle, skew) in zip(hocr_filenames,
+                                                        upright):
+            restore_hocr(hocr_filename, angle, skew)
+        hocr_filenames = [(fn, hocr_filename) for fn, (_, hocr_filename)
+                          in zip(fns, hocr_filenames)]
+
+        # Generate new pdf with overlayed text
+        return self.pdf.overlay_hocr_pages(
+            img_dpi, hocr_filenames, pdf_filename,
+            self._get_drop_pages(blank_pages))
+
+    def _find_blank_pages(self, img_filenames):
+        """
+            Check the rendered pages for blank ones, which don't need
+            preprocessing or OCR.
 
+            :returns: (filenames of the pages that aren't blank, numbers of
+                      the blank pages)
+        """
+        if not self.blank.enabled:
+            return img_filenames, []
+        if self.pool is not None:
+            blank = map_in_shared_pool(self.pool, self.blank.is_blank,
+                                       img_filenames)
+        else:
+            blank = [self.blank.is_blank(fn) for fn in img_filenames]
+        pages = [fn for fn, is_blank in zip(img_filenames, blank)
+                 if not is_blank]
+        blank_pages = [self.pdf._get_page_num(fn)
+                       for fn, is_blank in zip(img_filenames, blank)
+                       if is_blank]
+        self._report_blank_pages(blank_pages)
+        return pages, blank_pages
+
+    def _make_upright(self, img_filenames):
+        """
+            Turn the rendered pages so their text is upright and level for
+            OCR.
+
+            :returns: list of (upright image filename, angle, skew) for
+                      :func:`restore_hocr`
+        """
+        if not self.orientation.enabled:
+            return [(fn, 0, 0.0) for fn in img_filenames]
+        if self.pool is not None:
+            return map_in_shared_pool(self.pool, self.orientation.make_upright,
+                                      img_filenames)
+        return [self.orientation.make_upright(fn) for fn in img_filenames]
+
+    def _report_blank_pages(self, blank_pages):
+        if not blank_pages:
+            return
+        pages = ', '.join(str(page) for page in sorted(blank_pages))
+        if self.blank.drop:
+            print("Dropping blank pages %s" % pages)
+        else:
+            print("Skipped OCR of blank pages %s" % pages)
+
+    def _get_drop_pages(self, blank_pages):
+        """:returns: the pages to leave out of the OCR'ed pdf"""
+        if self.blank.drop:
+            return blank_pages
+        return []
+
+    def _run_stream_conversion(self, pdf_filename, scratch_dir=None,
+                               checkpoint=None):
+        """
+            Hand each page over to preprocessing and OCR as soon as
+            Ghostscript has rendered it, and add each OCR'ed page to the text
+            layer as soon as the pages before it are done, so rendering, OCR
+            and text layer generation all overlap.  Only the final merge
+            waits for all the pages.
+
+            :param checkpoint: Optional :class:`PyCheckpoint` to skip the
+                               pages already rendered and OCR'ed in, and to
+                               record the pages done in
+            :returns: OCR'ed PDF filename
+        """
+        if checkpoint is None:
+            img_dpi, img_filenames = self.gs.iter_img_from_pdf(pdf_filename,
+                                                               scratch_dir)
+        else:
+            rendered = checkpoint.get_pages('image')
+            img_dpi, img_filenames = self.gs.iter_img_from_pdf(
+                pdf_filename, scratch_dir, rendered)
+            img_filenames = self._iter_checkpointed_images(
+                checkpoint, rendered, img_filenames)
+        text_layer = self.pdf.start_text_layer(pdf_filename)
+
+        if self.pool is not None:
+            try:
+                blank_pages = self._stream_pages(self.pool, img_dpi,
+                                                 img_filenames, text_layer,
+                                                 checkpoint)
+            except WorkerExit as err:
+                sys.exit(err.code)
+            self._report_blank_pages(blank_pages)
+            return self.pdf.merge_text_layer(
+                text_layer, pdf_filename, self._get_drop_pages(blank_pages))
+
+        logging.debug("Making pool for streaming conversion")
+        pool = ThreadPool(processes=self.ts.threads)
+        try:
+            blank_pages = self._stream_pages(pool, img_dpi, img_filenames,
+                                             text_layer, checkpoint)
+            pool.close()
+        except WorkerExit as err:
+            pool.terminate()
+            sys.exit(err.code)
+        except (KeyboardInterrupt, SystemExit, Exception):
+            # SystemExit from error() in the gs iterator, which runs here
+            logging.info("Caught keyboard interrupt... terminating")
+            pool.terminate()
+            raise
         finally:
-            # Clean up the files
-            time.sleep(1)
-            if not self.config.debug:
-                # Need to clean up the original image files before preprocessing
-                if "fns" in locals(): # Have to check if this was set before exception raised
-                    logging.info("Cleaning up %s", fns)
-                    self._clean_up_files(fns)
-
-                # Have to check if this was set before exception raised
-                if "preprocess_imagefilenames" in locals():
-                    logging.info("Cleaning up %s", preprocess_imagefilenames)
-                    # splat the hocr_filenames as it is a list of pairs
-                    self._clean_up_files(preprocess_imagefilenames)
-                    for ext in [".hocr", ".html", ".txt"]:
-                        fns_to_remove = [
-                            os.path.splitext(fn)[0] + ext for fn in preprocess_imagefilenames]
-                        logging.info("Cleaning up %s", fns_to_remove)
-                        # splat the hocr_filenames as it is a list of pairs
-                        self._clean_up_files(fns_to_remove)
-                    # clean up the hocr input (jpg) and output (html) files
-                    # self._clean_up_files(itertools.chain(*hocr_filenames))
-                    # splat the hocr_filenames as it is a list of pairs
-                    # Seems like newer tessearct > 3.03 is creating .txt files with the OCR text
-                    # self._clean_up_files([x[1].replace(".hocr", ".txt") for x in hocr_filenames])
+            pool.join()
 
+        self._report_blank_pages(blank_pages)
+        return self.pdf.merge_text_layer(
+            text_layer, pdf_filename, self._get_drop_pages(blank_pages))
 
-        print("Completed conversion successfully to %s" % ocr_pdf_filename)
-        return ocr_pdf_filename
+    def _iter_checkpointed_images(self, checkpoint, rendered, img_filenames):
+        """
+            Yield the page images left from an earlier run, then the newly
+            rendered ones, recording each in the checkpoint.
+        """
+        for page_num in sorted(rendered):
+            yield rendered[page_num]
+        for img_filename in img_filenames:
+            checkpoint.set_page(self.pdf._get_page_num(img_filename), 'image',
+                                img_filename)
+            yield img_filename
+
+    def _stream_pages(self, pool, img_dpi, img_filenames, text_layer,
+                      checkpoint=None):
+        """
+            Queue up each page on the pool as it comes out of Ghostscript,
+            and add the finished pages to the text layer in page order.
+
+            :returns: numbers of the blank pages
+        """
+        results = []
+        blank_pages = []
+        for img_filename in img_filenames:
+            results.append(pool.apply_async(bind_stats(self._ocr_page),
+                                            (img_filename, checkpoint)))
+            # Lay out whatever is already done while gs keeps rendering
+            while results and results[0].ready():
+                self._add_stream_page(text_layer, img_dpi,
+                                      results.pop(0).get(), blank_pages)
+        for result in results:
+            self._add_stream_page(text_layer, img_dpi, result.get(),
+                                  blank_pages)
+        return blank_pages
+
+    def _add_stream_page(self, text_layer, img_dpi, page, blank_pages):
+        """Add one result of :func:`_ocr_page` to the text layer."""
+        hocr_filename, img_filename = page
+        if hocr_filename is None:
+            blank_pages.append(self.pdf._get_page_num(img_filename))
+        else:
+            self.pdf.add_text_page(text_layer, img_dpi, hocr_filename,
+                                   img_filename)
+
+    @exit_as_exception
+    def _ocr_page(self, img_filename, checkpoint=None):
+        """
+            Preprocess and OCR a single page.  Runs in a pool thread in
+            streaming mode.
+
+            :param checkpoint: Optional :class:`PyCheckpoint` with the pages
+                               OCR'ed already, to add this one to
+            :returns: (hocr filename, OCR'ed image filename), with no hocr
+                      filename for a blank page
+        """
+        if checkpoint is not None:
+            page_num = self.pdf._get_page_num(img_filename)
+            hocr_filename = checkpoint.get_page(page_num, 'hocr')
+            if hocr_filename is not None:
+                logging.info("Using OCR of page %d from checkpoint", page_num)
+                return hocr_filename, img_filename
+        if self.blank.enabled and self.blank.is_blank(img_filename):
+            return None, img_filename
+        ocr_filename, angle, skew = img_filename, 0, 0.0
+        if self.orientation.enabled:
+            ocr_filename, angle, skew = self.orientation.make_upright(
+                img_filename)
+        if not self.config.skip_preprocess:
+            ocr_filename = self.preprocess._run_preprocess(ocr_filename)
+        hocr_filename = self.ts.make_hocr_from_pnm(ocr_filename)
+        restore_hocr(hocr_filename, angle, skew)
+        if checkpoint is not None:
+            checkpoint.set_page(page_num, 'hocr', hocr_filename)
+        return hocr_filename, img_filename
 
     def file_converted_file(self, ocr_pdffilename, original_pdffilename):
         """ move the converted filename to its destination directory.  Optionally also
@@ -488,36 +848,267 @@ class PyPDFOCR(object):
         if self.config.enable_filing:
             self._setup_filing()
 
-        # Do the actual conversion followed by optional filing and email
-        if self.config.watch_dir:
-            logging.info("Starting to watch %s", self.config.watch_dir)
+        try:
+            # Do the actual conversion followed by optional filing and email
+            if self.config.watch_dir:
+                self._watch()
+            elif self.config.serve_address:
+                self._serve()
+            elif self.config.batch_paths is not None:
+                if self._batch()['failed']:
+                    sys.exit(1)
+            else:
+                self._convert_and_file_email(self.config.pdf_filename)
+        finally:
+            self._teardown_external_tools()
+
+    def _watch(self):
+        """
+            Watch the folder and hand every new pdf to a pool of document
+            workers, so up to ``max_concurrent_documents`` (from the watch
+            section of the config file) are converted and filed at once.
+        """
+        logging.info("Starting to watch %s", self.config.watch_dir)
+        max_documents = self.config.watch_config.get(
+            'max_concurrent_documents', 1)
+        # Separate from the stage pool, as documents wait on stage workers
+        document_pool = ThreadPool(processes=max_documents)
+        try:
             while True:  # Make sure the watcher doesn't terminate
                 try:
                     py_watcher = PyPdfWatcher(self.config.watch_dir,
-                                              self.config.get('watch'))
+                                              self.config.watch_config)
                     for pdf_filename in py_watcher.start():
-                        self._convert_and_file_email(pdf_filename)
+                        document_pool.apply_async(
+                            self._convert_and_file_email_logged,
+                            (pdf_filename,))
                 except KeyboardInterrupt:
                     break
                 except Exception as err:
                     print(traceback.print_exc(err))
                     py_watcher.stop()
-        else:
-            self._convert_and_file_email(self.config.pdf_filename)
+        finally:
+            document_pool.terminate()
+            document_pool.join()
+
+    def _serve(self):
+        """
+            Take conversion jobs over HTTP, and run them in
+            ``max_concurrent_documents`` (from the server section of the
+            config file) document workers, until terminated.  The tools and
+            pools are set up once, so a job costs no more than its
+            conversion.
+        """
+        server_config = self.config.server
+        jobs = PyJobQueue(server_config.get('jobs_dir',
+                                            '~/.pypdfocr/jobs'))
+        try:
+            server = make_server(self.config.serve_address, jobs,
+                                 self.histograms,
+                                 server_config.get('allow_remote', False))
+        except ValueError as err:
+            error(str(err))
+        max_documents = server_config.get('max_concurrent_documents', 1)
+        for _ in range(max_documents):
+            worker = Thread(target=self._run_jobs, args=(jobs,),
+                            name='pypdfocr-job')
+            worker.daemon = True
+            worker.start()
+        print("Taking jobs on %s" % self.config.serve_address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Jobs still running are queued again on the next start
+            jobs.stop()
+            server.server_close()
 
-    def _convert_and_file_email(self, pdf_filename):
+    def _run_jobs(self, jobs):
+        """
+            Run jobs from the queue one after the other in a document
+            worker, until the queue is stopped.
+        """
+        while True:
+            job = jobs.next_job()
+            if job is None:
+                return
+            stats = PyStats(job['pdf'])
+            try:
+                ocr_pdf_filename, filing = self._convert_and_file_email(
+                    job['pdf'], stats)
+            except (SystemExit, Exception) as err:
+                logging.exception("Job %s failed", job['id'])
+                jobs.finish(job['id'], error=str(err) or repr(err),
+                            stats=stats.get_report())
+            else:
+                jobs.finish(job['id'], ocr_pdf_filename,
+                            filing if self.config.enable_filing else None,
+                            stats=stats.get_report())
+
+    def _batch(self):
+        """
+            Convert every pdf of the batch, up to ``max_concurrent_documents``
+            (from the batch section of the config file) at once, recording
+            how each one went in the manifest.  Pdfs converted since they
+            last changed are skipped, so an interrupted batch can simply be
+            run again.
+
+            :returns: dict of the number of pdfs converted, skipped and
+                      failed
+        """
+        max_documents = self.config.batch.get('max_concurrent_documents', 1)
+        counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+        with PyBatch(self.config.batch_paths, self.config.manifest) as batch:
+            # Separate from the stage pool, as documents wait on stage workers
+            document_pool = ThreadPool(processes=max_documents)
+            try:
+                for status in document_pool.imap_unordered(
+                        functools.partial(self._convert_batch_file, batch),
+                        batch.iter_pdfs()):
+                    counts[status] += 1
+                document_pool.close()
+            finally:
+                document_pool.terminate()
+                document_pool.join()
+        print("Batch complete: %(converted)d converted, %(skipped)d skipped,"
+              " %(failed)d failed" % counts)
+        return counts
+
+    def _convert_batch_file(self, batch, pdf_filename):
+        """
+            Convert, file and email one pdf of a batch in a document worker,
+            unless it is up to date, and record the result.
+
+            :returns: "converted", "skipped" or "failed"
+        """
+        ocr_pdf_filename = batch.is_up_to_date(pdf_filename)
+        if ocr_pdf_filename is not None:
+            print("Skipping %s, already converted to %s"
+                  % (pdf_filename, ocr_pdf_filename))
+            status = batch.records.get(pdf_filename, {}).get('status')
+            if status not in ('converted', 'skipped'):
+                batch.record(pdf_filename, 'skipped', ocr_pdf_filename)
+            return 'skipped'
+        stats = PyStats(pdf_filename)
+        try:
+            ocr_pdf_filename, filing = self._convert_and_file_email(
+                pdf_filename, stats)
+        except (SystemExit, Exception) as err:
+            logging.exception("Conversion of %s failed", pdf_filename)
+            report = stats.get_report()
+            batch.record(pdf_filename, 'failed', error=str(err) or repr(err),
+                         seconds=report['seconds'], stats=report)
+            return 'failed'
+        report = stats.get_report()
+        batch.record(pdf_filename, 'converted', ocr_pdf_filename,
+                     filing if self.config.enable_filing else None,
+                     seconds=report['seconds'], stats=report)
+        return 'converted'
+
+    def _convert_and_file_email_logged(self, pdf_filename):
+        """
+            Run :func:`_convert_and_file_email` in a document worker, logging
+            any failure so the other documents carry on.
+        """
+        try:
+            self._convert_and_file_email(pdf_filename)
+        except (SystemExit, Exception):
+            logging.exception("Conversion of %s failed", pdf_filename)
+
+    def _get_settings(self):
+        """
+            :returns: tuple of everything besides the pdf itself that changes
+                      the OCR'ed pdf made from it
+        """
+        return (__version__, self.config.lang, self.config.force_ocr,
+                self.config.skip_preprocess, self.preprocess.engine,
+                self.blank.enabled, self.blank.max_ink, self.blank.margin,
+                self.blank.drop, self.orientation.enabled,
+                self.orientation.deskew, self.ts.ts_version, self.ts.engine,
+                self.gs.adaptive_dpi, self.gs.min_dpi, self.gs.max_dpi,
+                self.gs.x_height)
+
+    def _run_cached_conversion(self, pdf_filename):
+        """
+            Run :func:`run_conversion`, unless the exact same pdf has been
+            converted before with the same settings, in which case the
+            earlier OCR'ed pdf is reused without running gs or tesseract.
+
+            :returns: OCR'ed PDF filename
+        """
+        if self.pdf_cache is None:
+            return self.run_conversion(pdf_filename)
+
+        key = self.pdf_cache.hash_file(pdf_filename, *self._get_settings())
+        ocr_pdf_filename = "%s_ocr.pdf" % os.path.splitext(pdf_filename)[0]
+        if self.pdf_cache.get(key, ocr_pdf_filename):
+            print("Reused earlier conversion of identical file as %s"
+                  % ocr_pdf_filename)
+            return ocr_pdf_filename
+
+        ocr_pdf_filename = self.run_conversion(pdf_filename)
+        self.pdf_cache.put(key, ocr_pdf_filename)
+        return ocr_pdf_filename
+
+    def _convert_and_file_email(self, pdf_filename, stats=None):
         """
             Helper function to run the conversion, then do the optional filing,
             and optional emailing.
+
+            :param stats: :class:`PyStats` to record the timings of each
+                          stage in, or None for new ones
+            :returns: (OCR'ed PDF filename, filing folder or "None")
         """
-        ocr_pdffilename = self.run_conversion(pdf_filename)
-        if self.config.enable_filing:
-            filing = self.file_converted_file(ocr_pdffilename, pdf_filename)
-        else:
-            filing = "None"
+        if stats is None:
+            stats = PyStats(pdf_filename)
+        try:
+            with use_stats(stats):
+                ocr_pdffilename = self._run_cached_conversion(pdf_filename)
+                stats.count('bytes_in', os.path.getsize(pdf_filename))
+                stats.count('bytes_out', os.path.getsize(ocr_pdffilename))
+                if self.config.enable_filing:
+                    with timed('filing'):
+                        filing = self.file_converted_file(ocr_pdffilename,
+                                                          pdf_filename)
+                else:
+                    filing = "None"
+
+                if self.config.enable_email:
+                    with timed('email'):
+                        self._send_email(pdf_filename, ocr_pdffilename,
+                                         filing)
+        finally:
+            stats.finish()
+            self._report_stats(stats)
+        return ocr_pdffilename, filing
 
-        if self.config.enable_email:
-            self._send_email(pdf_filename, ocr_pdffilename, filing)
+    def _report_stats(self, stats):
+        """
+            Log how long each stage of a conversion took, add its timings to
+            the histograms, and write both to the stats directory if there
+            is one.
+        """
+        logging.info("Timings of %s: %s", stats.name, stats.get_summary())
+        if self.histograms is None:
+            return
+        self.histograms.add(stats)
+        if not self.config.stats_dir:
+            return
+        basename = os.path.splitext(os.path.basename(stats.name))[0]
+        # Same named pdfs from different directories get reports of their own
+        report_filename = os.path.join(
+            self.config.stats_dir, '%s_%s_%s.json'
+            % (basename, time.strftime('%Y%m%d-%H%M%S',
+                                       time.localtime(stats.start)),
+               uuid.uuid4().hex[:8]))
+        try:
+            write_report(stats.get_report(), report_filename)
+            write_report(self.histograms.get_report(), os.path.join(
+                self.config.stats_dir, 'histograms.json'))
+        except (IOError, OSError) as err:
+            logging.warning("Could not write stats to %s: %s",
+                            self.config.stats_dir, err)
 
 
 def main(): # pragma: no cover
@@ -0,0 +1,204 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Find the pdfs of a batch conversion, and keep a manifest of how each one
+    went, so an interrupted batch can pick up where it left off
+"""
+
+import glob
+import io
+import json
+import logging
+import os
+import sys
+import time
+from threading import Lock
+
+# Outputs of earlier conversions, which are never converted again
+SKIP_SUFFIXES = ('_ocr.pdf', '_test.pdf')
+
+
+class PyBatch(object):
+    """
+        The pdfs given on the command line (files, directories and glob
+        patterns) and the manifest of the batch.
+
+        The manifest is a file of JSON records, one line per pdf, appended
+        as each pdf is done.  When it already exists, its records tell which
+        pdfs were converted by an earlier run of the batch.
+    """
+
+    def __init__(self, paths, manifest_filename=None):
+        """
+            :param paths: pdf filenames, directories to search for pdfs,
+                          and glob patterns
+            :param manifest_filename: File to append the result of each pdf
+                                      to, if any
+        """
+        self.paths = paths
+        self.manifest_filename = manifest_filename
+        self.records = {}
+        self.lock = Lock()
+        self.manifest = None
+        if manifest_filename:
+            self.records = self.read_manifest(manifest_filename)
+            self.manifest = io.open(manifest_filename, 'a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the manifest."""
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+
+    @staticmethod
+    def read_file_list(filename):
+        """
+            :param filename: File with one path per line, or "-" for stdin
+            :returns: list of the paths in it
+        """
+        if filename == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with io.open(filename, encoding='utf-8') as f:
+                lines = f.readlines()
+        return [line.strip() for line in lines if line.strip()]
+
+    @staticmethod
+    def read_manifest(filename):
+        """
+            :returns: dict of the last record of each pdf in the manifest,
+                      by absolute filename
+        """
+        records = {}
+        try:
+            with io.open(filename, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        records[record['pdf']] = record
+                    except (ValueError, KeyError, TypeError):
+                        # e.g. the last line of a run that was killed
+                        logging.warning("Ignoring bad line in manifest %s:"
+                                        " %s", filename, line.strip())
+        except IOError:
+            pass
+        return records
+
+    def iter_pdfs(self):
+        """
+            Yield the absolute filename of every pdf of the batch, once
+            each, skipping the outputs of earlier conversions.
+        """
+        seen = set()
+        for path in self.paths:
+            for pdf_filename in self._expand_path(path):
+                pdf_filename = os.path.abspath(pdf_filename)
+                if pdf_filename not in seen:
+                    seen.add(pdf_filename)
+                    yield pdf_filename
+
+    def _expand_path(self, path):
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if _is_input_pdf(filename):
+                        yield os.path.join(dirpath, filename)
+        elif glob.has_magic(path):
+            try:
+                matches = glob.glob(path, recursive=True)
+            except TypeError:  # Python 2 has no ** patterns
+                matches = glob.glob(path)
+            for match in sorted(matches):
+                if os.path.isdir(match):
+                    for pdf_filename in self._expand_path(match):
+                        yield pdf_filename
+                elif _is_input_pdf(match):
+                    yield match
+        elif os.path.isfile(path):
+            yield path
+        else:
+            logging.warning("Could not find %s", path)
+
+    def is_up_to_date(self, pdf_filename):
+        """
+            Check whether a pdf has been converted since it last changed:
+            either the manifest says it was converted and the pdf is the
+            same size and age as it was then, or its _ocr.pdf is newer
+            than it.
+
+            :returns: the OCR'ed pdf filename if so, otherwise None
+        """
+        try:
+            stat = os.stat(pdf_filename)
+        except OSError:
+            return None
+        record = self.records.get(pdf_filename)
+        if (record and record.get('status') in ('converted', 'skipped') and
+                record.get('size') == stat.st_size and
+                record.get('mtime') == stat.st_mtime and
+                (record.get('filing') or
+                 os.path.exists(record.get('output') or ''))):
+            return record.get('output')
+        ocr_pdf_filename = "%s_ocr.pdf" % os.path.splitext(pdf_filename)[0]
+        try:
+            if os.path.getmtime(ocr_pdf_filename) >= stat.st_mtime:
+                return ocr_pdf_filename
+        except OSError:
+            pass
+        return None
+
+    def record(self, pdf_filename, status, output=None, filing=None,
+               error=None, seconds=None, stats=None):
+        """
+            Append the result of one pdf to the manifest.
+
+            :param status: "converted", "skipped" or "failed"
+            :param stats: Timings report of the conversion, from
+                          :func:`PyStats.get_report`
+        """
+        record = {'pdf': pdf_filename, 'status': status, 'output': output,
+                  'filing': filing, 'error': error, 'seconds': seconds,
+                  'stats': stats, 'time': time.time()}
+        try:
+            stat = os.stat(pdf_filename)
+            record['size'] = stat.st_size
+            record['mtime'] = stat.st_mtime
+        except OSError:
+            pass
+        with self.lock:
+            self.records[pdf_filename] = record
+            if self.manifest is not None:
+                line = json.dumps(record, sort_keys=True)
+                if not isinstance(line, type(u'')):  # Python 2
+                    line = line.decode('utf-8')
+                self.manifest.write(line + u'\n')
+                # Keep the manifest complete up to the last finished pdf,
+                # in case the batch is killed
+                self.manifest.flush()
+        return record
+
+
+def _is_input_pdf(filename):
+    """Check if a file is a pdf, and not the output of a conversion."""
+    filename = filename.lower()
+    return filename.endswith('.pdf') and not filename.endswith(SKIP_SUFFIXES)
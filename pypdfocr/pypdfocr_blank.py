@@ -0,0 +1,89 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Find the blank pages of a scan (e.g. the backsides of duplex scans), so
+    they don't have to be OCR'ed
+"""
+
+import logging
+
+from PIL import Image
+
+# Pages are checked at this size, which is plenty to see text but blurs
+# away dust and other specks
+SAMPLE_SIZE = 512
+# How much darker than the paper a pixel has to be to count as ink, so
+# show-through from the other side doesn't
+INK_CONTRAST = 64
+
+
+class PyBlankDetector(object):
+    """
+        Decides whether page images are blank from how much of the page is
+        covered in ink, on a downsampled copy of the image.
+    """
+
+    def __init__(self, config):
+        """
+            :param config: dict from the ``blank`` section of the config
+                           file, with ``max_ink`` (the largest fraction of
+                           the page covered in ink that still counts as
+                           blank), ``margin`` (fraction of each edge to
+                           ignore, for punch holes and scanner shadows) and
+                           ``drop`` (leave blank pages out of the output)
+        """
+        self.enabled = config.get('detect', True)
+        self.max_ink = float(config.get('max_ink', 0.0005))
+        self.margin = float(config.get('margin', 0.05))
+        self.drop = config.get('drop', False)
+
+    def get_ink_coverage(self, img_filename):
+        """
+            :returns: fraction of the page (inside the margins) covered in
+                      ink
+        """
+        img = Image.open(img_filename)
+        # Lets JPEG pages be decoded straight at a fraction of their size
+        img.draft('L', (SAMPLE_SIZE, SAMPLE_SIZE))
+        img = img.convert('L')
+        img.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS)
+        width, height = img.size
+        left, top = int(width*self.margin), int(height*self.margin)
+        img = img.crop((left, top, width - left, height - top))
+
+        histogram = img.histogram()
+        total = sum(histogram)
+        if not total:
+            return 0.0
+        # Most of any page is paper, so the median is the paper colour
+        count = 0
+        for paper, level_count in enumerate(histogram):
+            count += level_count
+            if count*2 >= total:
+                break
+        ink = sum(histogram[:max(paper - INK_CONTRAST, 0)])
+        return float(ink) / total
+
+    def is_blank(self, img_filename):
+        """
+            Check one page image, logging the decision.
+
+            :returns: True if the page is blank
+        """
+        coverage = self.get_ink_coverage(img_filename)
+        blank = coverage <= self.max_ink
+        logging.info("%s: %.3f%% ink, %s", img_filename, coverage*100,
+                     'blank' if blank else 'not blank')
+        return blank
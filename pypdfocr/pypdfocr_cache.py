@@ -0,0 +1,182 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    On-disk cache of files, addressed by a hash of whatever they were made
+    from, so the same work doesn't have to be done twice.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+
+
+class PyCache(object):
+    """
+        Size-bounded store of files, keyed by content hash.
+
+        Entries are kept in least recently used order, and the oldest ones
+        are deleted once the total size goes over max_size.  A hit
+        refreshes the entry's modification time, so the order survives
+        between runs.
+    """
+
+    def __init__(self, cache_dir, max_size, suffix=''):
+        """
+            :param cache_dir: Directory for the cached files (created if
+                              needed)
+            :param max_size: Maximum total size of the cached files in bytes
+            :param suffix: Extension given to the cached files
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.entries = self._load_entries()
+        self.size = sum(self.entries.values())
+        logging.debug("Cache %s has %d entries (%d bytes)", cache_dir,
+                      len(self.entries), self.size)
+
+    def __getstate__(self):
+        # Locks can't be pickled for multiprocessing workers
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    @staticmethod
+    def hash_file(filename, *extra):
+        """
+            Hash the contents of a file, together with any extra strings
+            that change what would be made from it (versions, options...).
+
+            :returns: hex digest to use as a cache key
+        """
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        for value in extra:
+            digest.update(b'\0')
+            digest.update(str(value).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _load_entries(self):
+        """Index the files already in the cache, oldest first."""
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix) or name.startswith('.'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((stat.st_mtime, name[:len(name)-len(self.suffix)],
+                          stat.st_size))
+        found.sort()
+        return OrderedDict((key, size) for _, key, size in found)
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key, filename):
+        """
+            Copy the cached file for key to filename.
+
+            :returns: True on a hit, False on a miss
+        """
+        path = self._get_path(key)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            try:
+                shutil.copyfile(path, filename)
+                os.utime(path, None)
+            except (IOError, OSError) as err:
+                # Removed behind our back, e.g. by another process
+                logging.debug(str(err))
+                self.size -= self.entries.pop(key)
+                self.misses += 1
+                return False
+            # Most recently used goes to the end
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+        logging.debug("Cache hit for %s", key)
+        return True
+
+    def put(self, key, filename):
+        """
+            Store a copy of filename under key, evicting the least recently
+            used entries if the cache gets too big.
+        """
+        size = os.path.getsize(filename)
+        if size > self.max_size:
+            return
+        # Copy under a temporary name first, so other readers never see a
+        # partly written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.')
+        os.close(fd)
+        shutil.copyfile(filename, tmp_path)
+        path = self._get_path(key)
+        with self.lock:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp_path, path)
+            except OSError as err:
+                logging.debug(str(err))
+                os.remove(tmp_path)
+                return
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self._evict()
+
+    def _evict(self):
+        """Delete the oldest entries until the cache fits in max_size."""
+        while self.size > self.max_size and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._get_path(key))
+            except OSError:
+                pass
+            logging.debug("Evicted %s from cache", key)
+
+    def stats(self):
+        """:returns: dict of hit/miss statistics and the cache size"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'size': self.size,
+            }
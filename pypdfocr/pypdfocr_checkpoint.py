@@ -0,0 +1,142 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Checkpoints of long conversions, so a conversion that dies half way
+    through can be picked up where it stopped
+"""
+
+import io
+import json
+import logging
+import os
+from threading import Lock
+
+from .pypdfocr_cache import PyCache
+from .pypdfocr_scratch import PyScratch
+
+
+class PyCheckpoint(PyScratch):
+    """
+        A scratch directory that is kept when its conversion fails, with a
+        log of the pages that are done with each step.
+
+        The directory is named after the pdf and a hash of its contents and
+        the conversion settings, so running the same conversion again finds
+        it, and only has to render and OCR the pages that are missing from
+        the log.  The log has one JSON record per line, appended (and
+        flushed) as each page finishes a step, so it is complete up to the
+        moment the conversion died.
+    """
+    log_name = 'checkpoint.jsonl'
+
+    def __init__(self, root, pdf_filename, *settings):
+        """
+            :param root: Directory to keep the checkpoints in
+            :param pdf_filename: pdf being converted
+            :param settings: Everything else that changes the output, as for
+                             :func:`PyCache.hash_file`
+        """
+        # Not calling PyScratch.__init__, as the directory is not temporary
+        self.root = os.path.expanduser(root)
+        key = PyCache.hash_file(pdf_filename, *settings)
+        name = os.path.splitext(os.path.basename(pdf_filename))[0]
+        self.path = os.path.join(self.root, '%s_%s' % (name, key[:16]))
+        self.pages = {}
+        self.lock = Lock()
+        log_filename = os.path.join(self.path, self.log_name)
+        if os.path.isdir(self.path):
+            self._load(log_filename)
+            logging.info("Resuming from checkpoint %s: %d pages rendered,"
+                         " %d OCR'ed", self.path,
+                         len(self.get_pages('image')),
+                         len(self.get_pages('hocr')))
+        else:
+            os.makedirs(self.path)
+            logging.debug("Created checkpoint directory %s", self.path)
+        self.log = io.open(log_filename, 'a', encoding='utf-8')
+
+    def _load(self, log_filename):
+        try:
+            with io.open(log_filename, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.pages.setdefault(record['page'], {})[
+                            record['step']] = record['filename']
+                    except (ValueError, KeyError, TypeError):
+                        # e.g. the last line of a run that was killed
+                        logging.debug("Ignoring bad checkpoint line %s",
+                                      line.strip())
+        except IOError:
+            pass
+
+    def get_pages(self, step):
+        """
+            :param step: "image" or "hocr"
+            :returns: dict of the filename of each page done with the step,
+                      by page number, leaving out any whose file is gone
+        """
+        with self.lock:
+            page_nums = list(self.pages)
+        done = {}
+        for page_num in page_nums:
+            filename = self.get_page(page_num, step)
+            if filename is not None:
+                done[page_num] = filename
+        return done
+
+    def get_page(self, page_num, step):
+        """
+            :returns: filename of the page made by the step, or None if the
+                      page is not done with it
+        """
+        with self.lock:
+            filename = self.pages.get(page_num, {}).get(step)
+        if filename is None:
+            return None
+        filename = os.path.join(self.path, filename)
+        if not os.path.exists(filename):
+            return None
+        return filename
+
+    def set_page(self, page_num, step, filename):
+        """
+            Record that a page is done with a step.
+
+            :param filename: File made by the step, inside the checkpoint
+                             directory
+        """
+        filename = os.path.basename(filename)
+        line = json.dumps({'page': page_num, 'step': step,
+                           'filename': filename}, sort_keys=True)
+        if not isinstance(line, type(u'')):  # Python 2
+            line = line.decode('utf-8')
+        with self.lock:
+            self.pages.setdefault(page_num, {})[step] = filename
+            if self.log is not None:
+                self.log.write(line + u'\n')
+                self.log.flush()
+
+    def close(self):
+        """Close the log, keeping the checkpoint to resume from."""
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    def cleanup(self, delete_queue=None):
+        """Remove the checkpoint, once its conversion is done."""
+        self.close()
+        PyScratch.cleanup(self, delete_queue)
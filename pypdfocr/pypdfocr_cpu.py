@@ -0,0 +1,140 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Work out how many CPUs we may use, and share them out between the gs,
+    convert and tesseract processes of all the documents being converted
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+from contextlib import contextmanager
+from threading import Condition
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def get_cpu_count(cgroup_root=CGROUP_ROOT):
+    """
+        Number of CPUs this process can use: the ones it is allowed to run
+        on, limited by any cgroup CPU quota (e.g. ``docker run --cpus``).
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # Python 2, or not on Linux
+        try:
+            count = multiprocessing.cpu_count()
+        except NotImplementedError:
+            count = 1
+    quota = get_cgroup_quota(cgroup_root)
+    if quota is not None:
+        count = min(count, int(math.ceil(quota)))
+    return max(1, count)
+
+
+def get_cgroup_quota(cgroup_root=CGROUP_ROOT):
+    """:returns: the cgroup CPU quota in CPUs, or None if there is none"""
+    # cgroup v2: "<quota> <period>", or "max <period>" for no limit
+    try:
+        with open(os.path.join(cgroup_root, 'cpu.max')) as f:
+            quota, period = f.read().split()[:2]
+        if quota == 'max':
+            return None
+        return float(quota) / float(period)
+    except (IOError, OSError, ValueError):
+        pass
+    # cgroup v1: a quota of -1 means no limit
+    try:
+        with open(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return float(quota) / period
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class PyCpuBudget(object):
+    """
+        A fixed number of CPU tokens, shared by every stage and document.
+
+        Each gs, convert or tesseract run holds as many tokens as the
+        threads it uses while it runs, and waits for them if they are all
+        in use, so the work in flight never needs more CPUs than there are.
+    """
+
+    def __init__(self, tokens):
+        """:param tokens: Number of CPUs to share out"""
+        self.tokens = max(1, int(tokens))
+        self.free = self.tokens
+        self.condition = Condition()
+
+    def acquire(self, count=1):
+        """
+            Wait for count tokens (at most the whole budget) and take them.
+
+            :returns: number of tokens taken
+        """
+        count = max(1, min(count, self.tokens))
+        with self.condition:
+            while self.free < count:
+                self.condition.wait()
+            self.free -= count
+        return count
+
+    def release(self, count=1):
+        """Give back tokens taken with :func:`acquire`."""
+        with self.condition:
+            self.free += count
+            self.condition.notify_all()
+
+    @contextmanager
+    def use(self, count=1):
+        """Hold count tokens for the duration of a with block."""
+        count = self.acquire(count)
+        try:
+            yield count
+        finally:
+            self.release(count)
+
+
+@contextmanager
+def use_cpus(budget, count=1):
+    """
+        Hold count tokens of budget, if there is one, for the duration of a
+        with block.
+
+        :returns: number of CPUs the work in the block may use
+    """
+    if budget is None:
+        yield count
+        return
+    with budget.use(count) as count:
+        yield count
+
+
+def get_thread_env(threads):
+    """
+        :returns: environment for a child process that limits the threads
+                  of OpenMP (tesseract) and ImageMagick to threads
+    """
+    env = dict(os.environ)
+    env['OMP_THREAD_LIMIT'] = str(threads)
+    env['MAGICK_THREAD_LIMIT'] = str(threads)
+    logging.debug("Limiting child process to %d threads", threads)
+    return env
@@ -21,8 +21,20 @@
 import fnmatch
 import glob
 import logging
+import math
 import os
+import re
 import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.pdf import ContentStream
+
+from .pypdfocr_cpu import get_cpu_count, use_cpus
+from .pypdfocr_interrupts import WorkerExit, exit_as_exception
+from .pypdfocr_orientation import PyOrientation
+from .pypdfocr_stats import add_time, bind_stats, count, timed
 
 
 def error(text):
@@ -33,6 +45,10 @@ def error(text):
 
 class PyGs(object):
     """Class to wrap all the ghostscript calls"""
+    # gs reports every page it starts rendering unless run with -q
+    regex_page = re.compile(r'^Page\s+\d+')
+    # Content stream operators that show text
+    text_operators = (b'Tj', b'TJ', b"'", b'"')
 
     def __init__(self, config):
         self.msgs = {
@@ -44,7 +60,14 @@ class PyGs(object):
                                  ' place; please specify it using your config'
                                  ' file',
             }
-        self.threads = config.get('threads', 4)
+        self.threads = config.get('threads', get_cpu_count())
+        # Render page ranges in separate gs processes, up to self.threads
+        self.parallel = config.get('parallel', False)
+        # Long-lived thread pool shared with the other stages, if any
+        self.pool = None
+        # PyCpuBudget shared with the other stages, if any; each gs
+        # process holds one of its tokens
+        self.budget = None
 
         if "binary" in config:  # Override location of binary
             binary = config['binary']
@@ -59,12 +82,36 @@ class PyGs(object):
                 binary = "gs"
         self.binary = binary
 
+        # Render dpi for pages without images, and the lowest dpi any page
+        # is rendered at
         self.output_dpi = 300
-        self.greyscale = True
+        # Cheapest device for each kind of page, so only colour pages pay
+        # for 24-bit output
+        self.page_formats = {
+            'mono': 'pnggrey',
+            'grey': 'jpggrey',
+            'colour': 'jpg',
+        }
+        self.default_format = 'jpggrey'
+        # Optionally pick each page's dpi from the size of its text instead,
+        # measured on a quick low resolution render: just enough for the
+        # x-height to come out at x_height pixels, within min_dpi and
+        # max_dpi, and never more than the page would get otherwise
+        self.adaptive_dpi = config.get('adaptive_dpi', False)
+        self.min_dpi = int(config.get('min_dpi', 200))
+        self.max_dpi = int(config.get('max_dpi', 600))
+        self.x_height = float(config.get('x_height', 20))
+        self.probe_dpi = 100
+        # Adapted dpis are rounded up to this, so pages with similar text
+        # still share a gs run
+        self.dpi_step = 50
+        # Pages that already have text (born-digital or already OCR'ed) are
+        # left alone instead of being rendered and OCR'ed again
+        self.skip_text_pages = True
         # Tiff is used for the ocr, so just fix it at 300dpi
         #  The other formats will be used to create the final OCR'ed image,
-        #  so determine the DPI by using pdfimages if available, o/w default
-        #  to 200.
+        #  so determine the DPI from the images in the pdf if possible,
+        #  o/w default to 300.
         self.gs_options = {
             'tiff': ['tiff', ['-sDEVICE=tiff24nc', '-r%(dpi)s']],
             'jpg': ['jpg', ['-sDEVICE=jpeg', '-dJPEGQ=75', '-r%(dpi)s']],
@@ -96,74 +143,196 @@ class PyGs(object):
                     return os.path.join(base, max(bin_paths))
         error(self.msgs['GS_MISSING_BINARY'])
 
-    def _get_dpi(self, pdf_filename):
+    def _get_render_settings(self, pdf_filename):
+        """Choose the image format and dpi to render each page with.
+
+        Each page is rendered at the resolution of its largest image (but at
+        least output_dpi), through the cheapest device that keeps its
+        colour: mono pages through pngmono, greyscale pages through
+        jpeggray, and only colour pages through the 24-bit jpeg device.
+        Pages without images get the defaults.  Pages that already have
+        text are not rendered at all if skip_text_pages is set.
+
+        :returns: list with an (img_format, dpi) tuple for each page, or
+                  None for pages that are skipped; or None if the pages
+                  can't be read
+        """
         if not os.path.exists(pdf_filename):
             error(self.msgs['GS_MISSING_PDF'] + " %s" % pdf_filename)
 
-        cmd = 'pdfimages -list "%s"' % pdf_filename
-        logging.info("Running pdfimages to figure out DPI...")
-        logging.debug(cmd)
-        try:
-            out = subprocess.check_output(
-                cmd, shell=True, universal_newlines=True)
-        except subprocess.CalledProcessError:
-            logging.warning("Could not execute pdfimages to calculate DPI"
-                            " (try installing xpdf or poppler?), so defaulting"
-                            " to %sdpi", self.output_dpi)
-            return
+        logging.info("Reading page images to figure out DPI...")
+        page_settings = self._get_page_settings(pdf_filename)
+        if page_settings is None:
+            return None
+        if not any(dpi for dpi, _, _ in page_settings):
+            logging.warning("No images found in pdf, so defaulting to %sdpi",
+                            self.output_dpi)
+        render_settings = []
+        for page_num, (dpi, colour, page_type) in \
+                enumerate(page_settings, 1):
+            if self.skip_text_pages and page_type in ('text', 'mixed'):
+                logging.info("Page %d already has text, skipping OCR",
+                             page_num)
+                render_settings.append(None)
+                continue
+            render_settings.append(
+                (self.page_formats.get(colour, self.default_format),
+                 max(dpi or 0, self.output_dpi)))
+        return render_settings
 
-        # Need the second line of output
-        # Make sure it exists (in case this is an empty pdf)
-        results = out.splitlines()
-        if len(results) < 3:
-            logging.warning("Empty pdf, cannot determine dpi using pdfimages")
-            return
-        results = results[2]
-        logging.debug(results)
-        results = results.split()
-        if results[2] != 'image':
-            logging.warning("Could not understand output of pdfimages, "
-                            "please rerun with -d option and file an issue at"
-                            " http://github.com/virantha/pypdfocr/issues")
-            return
-        x_pt, y_pt, greyscale = \
-            int(results[3]), int(results[4]), results[5] == 'gray'
-        self.greyscale = greyscale
+    def _get_page_settings(self, pdf_filename):
+        """Find the resolution and colour of the images on each page, and
+        whether the page already has text.
 
-        # Now, run imagemagick identify to get pdf width/height/density
+        This only reads the image dictionaries, page sizes and (for pages
+        with fonts) content streams, and doesn't decode any image data.
 
-        if os.name == 'nt':
-            cmd = ('magick identify -format "%%w %%x %%h %%y\\n" "%s"'
-                   % pdf_filename)
-        else:
-            cmd = 'identify -format "%%w %%x %%h %%y\n" "%s"' % pdf_filename
+        :returns: list with a (dpi, colour, page_type) tuple for each page,
+                  where colour is one of 'mono', 'grey' or 'colour' (dpi
+                  and colour are None for pages without images), and
+                  page_type is one of 'text', 'image', 'mixed' or None for
+                  pages with neither; or None if the pdf can't be read
+        """
+        page_settings = []
         try:
-            out = subprocess.check_output(
-                cmd, shell=True, universal_newlines=True)
-        except subprocess.CalledProcessError as err:
+            with open(pdf_filename, 'rb') as f:
+                reader = PdfFileReader(f)
+                for page_num in range(reader.getNumPages()):
+                    page = reader.getPage(page_num)
+                    dpi, colour = self._get_page_setting(page, page_num + 1)
+                    page_type = self._get_page_type(reader, page,
+                                                    dpi is not None)
+                    page_settings.append((dpi, colour, page_type))
+        except Exception as err:
             logging.debug(str(err))
-            logging.warning("Could not execute identify to calculate DPI"
-                            " (try installing imagemagick?), so defaulting to"
-                            " %sdpi", self.output_dpi)
-            return
-        results = out.splitlines()[0]
-        results = results.replace("Undefined", "")
-        width, xdensity, height, ydensity = [float(x) for x in results.split()]
-        xdpi = round(x_pt/width*xdensity)
-        ydpi = round(y_pt/height*ydensity)
-        self.output_dpi = max(xdpi, ydpi, 300)
+            logging.warning("Could not read the images in %s to calculate"
+                            " DPI, so defaulting to %sdpi", pdf_filename,
+                            self.output_dpi)
+            return None
+        return page_settings
+
+    def _get_page_setting(self, page, page_num):
+        """:returns: (dpi, colour) of the largest image on the page"""
+        images = list(self._iter_images(page.get('/Resources')))
+        if not images:
+            return (None, None)
+        width, height, colour = max(images, key=lambda i: i[0]*i[1])
+
+        page_width = float(page.mediaBox.getWidth())
+        page_height = float(page.mediaBox.getHeight())
+        # Scans are sometimes stored sideways and rotated into place, so line
+        # up the long side of the image with the long side of the page
+        if (width > height) != (page_width > page_height):
+            width, height = height, width
+        xdpi = int(round(width/page_width*72))
+        ydpi = int(round(height/page_height*72))
+        dpi = max(xdpi, ydpi)
         if abs(xdpi-ydpi) > xdpi*.05:  # Make sure the two dpi's are within 5%
-            logging.warning("DPI mismatch: X:%d, Y:%d, defaulting to %d",
-                            xdpi, ydpi, self.output_dpi)
-        else:
-            logging.info("Using %d DPI", self.output_dpi)
+            logging.warning("DPI mismatch on page %d: X:%d, Y:%d, using %d",
+                            page_num, xdpi, ydpi, dpi)
+        logging.debug("Page %d: %s image at %d DPI", page_num, colour, dpi)
+        return (dpi, colour)
+
+    def _get_page_type(self, reader, page, has_images):
+        """:returns: 'text', 'image', 'mixed' or None"""
+        has_text = self._has_text(reader, page.get('/Contents'),
+                                  page.get('/Resources'))
+        if has_text:
+            return 'mixed' if has_images else 'text'
+        return 'image' if has_images else None
+
+    def _has_text(self, reader, contents, resources, seen=None):
+        """Check if a content stream, or any form it draws, shows text.
+
+        Only content streams with fonts in their resources are parsed.
+        """
+        if seen is None:
+            seen = set()
+        if not contents or not resources:
+            return False
+        resources = resources.getObject()
+        if resources.get('/Font'):
+            for _, operator in ContentStream(contents.getObject(),
+                                             reader).operations:
+                if operator in self.text_operators:
+                    return True
+        xobjects = resources.get('/XObject')
+        if not xobjects:
+            return False
+        for xobject in xobjects.getObject().values():
+            if hasattr(xobject, 'idnum'):
+                if xobject.idnum in seen:
+                    continue
+                seen.add(xobject.idnum)
+            form = xobject.getObject()
+            if form.get('/Subtype') == '/Form' and self._has_text(
+                    reader, form, form.get('/Resources'), seen):
+                return True
+        return False
+
+    def _iter_images(self, resources, seen=None):
+        """Yield (width, height, colour) for each image in a resource
+        dictionary, including the ones inside form xobjects."""
+        if seen is None:
+            seen = set()
+        if not resources:
+            return
+        xobjects = resources.getObject().get('/XObject')
+        if not xobjects:
+            return
+        for xobject in xobjects.getObject().values():
+            if hasattr(xobject, 'idnum'):
+                if xobject.idnum in seen:
+                    continue
+                seen.add(xobject.idnum)
+            xobject = xobject.getObject()
+            subtype = xobject.get('/Subtype')
+            if subtype == '/Image':
+                yield (int(xobject['/Width']), int(xobject['/Height']),
+                       self._get_image_colour(xobject))
+            elif subtype == '/Form':
+                for image in self._iter_images(xobject.get('/Resources'),
+                                               seen):
+                    yield image
+
+    def _get_image_colour(self, image):
+        """:returns: 'mono', 'grey' or 'colour' for an image xobject"""
+        if image.get('/ImageMask') or image.get('/BitsPerComponent') == 1:
+            return 'mono'
+        if self._get_colour_channels(image.get('/ColorSpace')) == 1:
+            return 'grey'
+        return 'colour'
+
+    def _get_colour_channels(self, colour_space):
+        """:returns: number of colour channels in a colour space, or None
+                     if it can't be worked out"""
+        if colour_space is None:
+            # JPXDecode images carry their own colour space
+            return None
+        colour_space = colour_space.getObject()
+        if isinstance(colour_space, list):
+            family = colour_space[0]
+            if family == '/ICCBased':
+                return int(colour_space[1].getObject().get('/N', 3))
+            if family == '/Indexed':
+                return self._get_colour_channels(colour_space[1])
+            if family == '/Separation':
+                return 1
+            if family == '/DeviceN':
+                return len(colour_space[1].getObject())
+            colour_space = family
+        return {'/DeviceGray': 1, '/CalGray': 1, '/G': 1,
+                '/DeviceRGB': 3, '/CalRGB': 3, '/RGB': 3, '/Lab': 3,
+                '/DeviceCMYK': 4, '/CMYK': 4}.get(colour_space)
 
     def _run_gs(self, options, output_filename, pdf_filename):
         try:
             cmd = ('%s -q -dNOPAUSE %s -sOutputFile="%s" "%s" -c quit' %
                    (self.binary, options, output_filename, pdf_filename))
             logging.info(cmd)
-            subprocess.check_output(cmd, shell=True, universal_newlines=True)
+            with use_cpus(self.budget):
+                subprocess.check_output(cmd, shell=True,
+                                        universal_newlines=True)
 
         except subprocess.CalledProcessError as err:
             logging.error(err.output)
@@ -172,35 +341,383 @@ class PyGs(object):
             else:
                 error(self.msgs['GS_FAILED'])
 
-    def make_img_from_pdf(self, pdf_filename):
-        """Convert pdf to jpg"""
-        self._get_dpi(pdf_filename)  # No need to bother anymore
+    def _prepare_img_output(self, pdf_filename, output_dir=None,
+                            skip_pages=()):
+        """Work out the gs runs needed to render a pdf.
+
+        The images go next to the pdf, or into output_dir if given.
+        Consecutive pages with the same image format and dpi are rendered by
+        one gs run.  With parallel rendering on, these are split further so
+        each thread gets its own range of pages.  Any image files left over
+        from a previous run are deleted, except those of skip_pages.
+
+        :param skip_pages: Numbers of pages not to render, e.g. because
+                           their images are left from an interrupted run
+
+        :returns: (highest dpi, list of (first page, last page, gs options,
+                  output filename pattern) tuples), where the pages are
+                  None if a single run renders the whole document.  The
+                  list is empty if no page needs rendering.
+        """
+        with timed('dpi_probe'):
+            settings = self._get_render_settings(pdf_filename)
+            if settings and skip_pages:
+                settings = [None if page_num in skip_pages else setting
+                            for page_num, setting in enumerate(settings, 1)]
+            if any(settings or []) and self.adaptive_dpi:
+                settings = self._adapt_render_dpi(pdf_filename, settings,
+                                                  output_dir)
+        if settings:
+            groups = self._group_pages(
+                settings, self._get_parallel_page_ranges(pdf_filename))
+        elif settings is None:
+            groups = [(None, None, self.default_format, self.output_dpi)]
+        else:
+            groups = []
+        if settings is not None and len(groups) == 1 and \
+                groups[0][:2] == (1, len(settings)):
+            groups = [(None, None) + groups[0][2:]]
+        if not groups:
+            logging.info("All pages already have text or images, nothing"
+                         " to render")
+            return self.output_dpi, []
+
+        filename = os.path.splitext(pdf_filename)[0]
+        if output_dir is not None:
+            filename = os.path.join(output_dir, os.path.basename(filename))
+        # Delete any img files already existing
+        for img_file_ext in set(self.gs_options[img_format][0]
+                                for _, _, img_format, _ in groups):
+            keep = set('%s_%d.%s' % (filename, page_num, img_file_ext)
+                       for page_num in skip_pages)
+            for fname in glob.glob('%s_*.%s' % (filename, img_file_ext)):
+                if fname not in keep:
+                    os.remove(fname)
+
+        jobs = []
+        for first, last, img_format, dpi in groups:
+            img_file_ext, options = self.gs_options[img_format]
+            if first is None:
+                logging.info("Rendering all pages as %s at %d DPI",
+                             img_format, dpi)
+            else:
+                logging.info("Rendering pages %d-%d as %s at %d DPI",
+                             first, last, img_format, dpi)
+            jobs.append((first, last, ' '.join(options) % {'dpi': dpi},
+                         '%s_%%d.%s' % (filename, img_file_ext)))
+        return max(dpi for _, _, _, dpi in groups), jobs
+
+    def _adapt_render_dpi(self, pdf_filename, settings, output_dir=None):
+        """Lower the dpi of each page to what the size of its text needs.
+
+        The pages are rendered at probe_dpi first, and the x-height of the
+        text measured on that.  Pages without any text lines keep their
+        settings.
 
+        :returns: the render settings, with the dpis adapted
+        """
         filename = os.path.splitext(pdf_filename)[0]
+        if output_dir is not None:
+            filename = os.path.join(output_dir, os.path.basename(filename))
+        probe_filename = '%s_probe_%%d.png' % filename
+        logging.info("Rendering pages at %d DPI to measure their text",
+                     self.probe_dpi)
+        self._run_gs('-sDEVICE=pnggray -r%d' % self.probe_dpi,
+                     probe_filename, pdf_filename)
 
-        # Create ancillary jpeg files to use later to calculate image dpi etc
-        #   We no longer use these for the final image. Instead the text is
-        #   merged directly with the original PDF.  Yay!
-        if self.greyscale:
-            img_format = 'jpggrey'
-            logging.info("Detected greyscale")
+        probes = [probe_filename % page_num
+                  for page_num, setting in enumerate(settings, 1)
+                  if setting is not None]
+        probes = [probe for probe in probes if os.path.exists(probe)]
+        if self.pool is not None:
+            x_heights = self.pool.map(PyOrientation.get_x_height, probes)
         else:
-            img_format = 'jpg'
-            logging.info("Detected color")
+            x_heights = [PyOrientation.get_x_height(probe)
+                         for probe in probes]
+        x_heights = dict(zip(probes, x_heights))
+        for probe in glob.glob(probe_filename.replace('%d', '*')):
+            os.remove(probe)
 
-        img_file_ext = self.gs_options[img_format][0]
+        adapted = []
+        for page_num, setting in enumerate(settings, 1):
+            x_height = x_heights.get(probe_filename % page_num)
+            if not x_height:
+                adapted.append(setting)
+                continue
+            img_format, dpi = setting
+            # x-height in points, then the dpi that makes it x_height pixels
+            x_height = x_height * 72.0 / self.probe_dpi
+            text_dpi = self.x_height * 72.0 / x_height
+            text_dpi = int(math.ceil(text_dpi / self.dpi_step)) * self.dpi_step
+            text_dpi = max(self.min_dpi, min(text_dpi, self.max_dpi, dpi))
+            logging.info("Page %d: text x-height %.1fpt, rendering at %d"
+                         " DPI instead of %d", page_num, x_height, text_dpi,
+                         dpi)
+            adapted.append((img_format, text_dpi))
+        return adapted
 
-        # The possible output files glob
-        globable_filename = '%s_*.%s' % (filename, img_file_ext)
-        # Delete any img files already existing
-        for fname in glob.glob(globable_filename):
-            os.remove(fname)
-
-        options = (' '.join(self.gs_options[img_format][1])
-                   % {'dpi': self.output_dpi})
-        output_filename = '%s_%%d.%s' % (filename, img_file_ext)
-        logging.debug(output_filename)
-        self._run_gs(options, output_filename, pdf_filename)
-        for filename in glob.glob(globable_filename):
-            logging.info("Created image %s", filename)
-        return (self.output_dpi, globable_filename)
+    @staticmethod
+    def _group_pages(settings, page_ranges=None):
+        """Group consecutive pages with the same settings.
+
+        :param settings: list of (img_format, dpi) tuples, one per page, or
+                         None for pages that are skipped
+        :param page_ranges: optional list of (first, last) page ranges that
+                            no group may cross
+        :returns: list of (first page, last page, img_format, dpi) tuples
+        """
+        range_starts = set(first for first, _ in page_ranges or [])
+        groups = []
+        for page_num, setting in enumerate(settings, 1):
+            if setting is None:
+                continue
+            if groups and groups[-1][1] == page_num - 1 \
+                    and groups[-1][2:] == tuple(setting) \
+                    and page_num not in range_starts:
+                groups[-1] = (groups[-1][0], page_num) + tuple(setting)
+            else:
+                groups.append((page_num, page_num) + tuple(setting))
+        return groups
+
+    def _get_page_ranges(self, pdf_filename):
+        """Split the document into one contiguous page range per thread.
+
+        :returns: list of (first page, last page) tuples, 1-based and
+                  inclusive, or None if the pages can't be counted
+        """
+        try:
+            with open(pdf_filename, 'rb') as f:
+                num_pages = PdfFileReader(f).getNumPages()
+        except Exception as err:
+            logging.debug(str(err))
+            logging.warning("Could not count pages, rendering %s with a"
+                            " single Ghostscript process", pdf_filename)
+            return None
+        if num_pages == 0:
+            return None
+        num_ranges = max(1, min(self.threads, num_pages))
+        range_size = (num_pages + num_ranges - 1) // num_ranges
+        return [(first, min(first + range_size - 1, num_pages))
+                for first in range(1, num_pages + 1, range_size)]
+
+    @exit_as_exception
+    def _render_page_range(self, pdf_filename, job):
+        """Render the pages of one job with its own gs process.
+
+        gs numbers its output files from 1 for every run, so each page range
+        renders to its own set of files that are then renamed to their page
+        numbers in the whole document.
+
+        :returns: list of image filenames for the pages in the job
+        """
+        first, last, options, output_filename = job
+        if first is None:
+            with timed('render'):
+                self._run_gs(options, output_filename, pdf_filename)
+            filenames = []
+            while os.path.exists(output_filename % (len(filenames) + 1)):
+                filenames.append(output_filename % (len(filenames) + 1))
+            count('pages', len(filenames))
+            return filenames
+
+        range_output_filename = output_filename.replace(
+            '%d', 'r%d_%%d' % first)
+        with timed('render'):
+            self._run_gs('%s -dFirstPage=%d -dLastPage=%d'
+                         % (options, first, last),
+                         range_output_filename, pdf_filename)
+        filenames = []
+        for page_num in range(first, last + 1):
+            range_filename = range_output_filename % (page_num - first + 1)
+            if not os.path.exists(range_filename):
+                logging.warning("Ghostscript did not render page %d of %s",
+                                page_num, pdf_filename)
+                continue
+            filename = output_filename % page_num
+            os.rename(range_filename, filename)
+            filenames.append(filename)
+        count('pages', len(filenames))
+        return filenames
+
+    def _run_render_jobs(self, pdf_filename, jobs):
+        """Run the gs jobs for a document, in parallel if turned on.
+
+        :returns: iterator of image filenames in page order, yielding the
+                  pages of each job once that job is done
+        """
+        if self.parallel and len(jobs) > 1:
+            for filename in self._run_gs_page_ranges(pdf_filename, jobs):
+                yield filename
+            return
+        try:
+            for job in jobs:
+                for filename in self._render_page_range(pdf_filename, job):
+                    logging.info("Created image %s", filename)
+                    yield filename
+        except WorkerExit as err:
+            exit(err.code)
+
+    def _run_gs_page_ranges(self, pdf_filename, jobs):
+        """Render the page ranges in parallel.
+
+        Uses the shared pool if there is one, otherwise a pool just for
+        this document.
+
+        :returns: iterator of image filenames in page order, yielding the
+                  pages of each range once that range is done
+        """
+        if self.pool is not None:
+            try:
+                for filename in self._iter_page_ranges(
+                        self.pool, pdf_filename, jobs):
+                    yield filename
+            except WorkerExit as err:
+                exit(err.code)
+            return
+
+        logging.debug("Making pool for ghostscript")
+        pool = ThreadPool(processes=min(self.threads, len(jobs)))
+        try:
+            for filename in self._iter_page_ranges(pool, pdf_filename, jobs):
+                yield filename
+            pool.close()
+        except WorkerExit as err:
+            pool.terminate()
+            exit(err.code)
+        except (KeyboardInterrupt, GeneratorExit, Exception):
+            logging.info("Caught keyboard interrupt... terminating")
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _iter_page_ranges(self, pool, pdf_filename, jobs):
+        """Yield the rendered images of each range in order, as they finish.
+        """
+        results = pool.imap(
+            bind_stats(lambda job: self._render_page_range(pdf_filename,
+                                                           job)),
+            jobs)
+        for filenames in results:
+            for filename in filenames:
+                logging.info("Created image %s", filename)
+                yield filename
+
+    def _get_parallel_page_ranges(self, pdf_filename):
+        """Return the page ranges to render in parallel, or None if the
+        document should be rendered by one gs process."""
+        if not self.parallel:
+            return None
+        page_ranges = self._get_page_ranges(pdf_filename)
+        if page_ranges and len(page_ranges) > 1:
+            logging.info("Rendering page ranges %s in parallel", page_ranges)
+            return page_ranges
+        return None
+
+    def make_img_from_pdf(self, pdf_filename, output_dir=None,
+                          skip_pages=()):
+        """Convert pdf to images, one per page.
+
+        :param output_dir: Directory for the images, instead of the
+                           directory of the pdf
+        :param skip_pages: Numbers of pages not to render
+        :returns: (highest render dpi, list of image filenames in page order)
+        """
+        dpi, jobs = self._prepare_img_output(pdf_filename, output_dir,
+                                             skip_pages)
+        return (dpi, list(self._run_render_jobs(pdf_filename, jobs)))
+
+    def iter_img_from_pdf(self, pdf_filename, output_dir=None,
+                          skip_pages=()):
+        """Convert pdf to images, handing out each page as soon as it is done.
+
+        Ghostscript is started in the background, and the returned iterator
+        yields the image filename of each page as soon as gs has moved on to
+        the next page (or exited), so the caller can start working on page
+        images while the rest of the document is still being rendered.
+
+        If the pages need different render settings, or parallel rendering
+        is on, each page range gets its own gs process and the pages of a
+        range are handed out once the range is done.
+
+        :param output_dir: Directory for the images, instead of the
+                           directory of the pdf
+        :param skip_pages: Numbers of pages not to render
+        :returns: (highest render dpi, iterator of image filenames in page
+                  order)
+        """
+        dpi, jobs = self._prepare_img_output(pdf_filename, output_dir,
+                                             skip_pages)
+        if len(jobs) != 1 or jobs[0][0] is not None:
+            return (dpi, self._run_render_jobs(pdf_filename, jobs))
+        _, _, options, output_filename = jobs[0]
+        # Leave out -q, as we need gs to report each page it starts on
+        cmd = ('%s -dNOPAUSE %s -sOutputFile="%s" "%s" -c quit' %
+               (self.binary, options, output_filename, pdf_filename))
+        logging.info(cmd)
+        tokens = self.budget.acquire() if self.budget is not None else 0
+        try:
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        except Exception:
+            if tokens:
+                self.budget.release(tokens)
+            raise
+        return (dpi, self._iter_gs_pages(proc, output_filename, tokens))
+
+    def _iter_gs_pages(self, proc, output_filename, tokens=0):
+        """Yield rendered page images while the gs process is running.
+
+        gs prints "Page N" when it starts on a page, and closes the image
+        file of the previous page before that, so each new page message
+        means the image before it is complete.
+
+        If the caller stops iterating early, or fails, the gs process is
+        killed rather than left rendering the rest of the document.
+
+        :param tokens: CPU tokens held for the gs process, given back to
+                       self.budget once it has exited
+        """
+        output = []
+        pages_started = 0
+        start = time.time()
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                output.append(line)
+                if self.regex_page.match(line):
+                    if pages_started:
+                        yield self._get_rendered_page(output_filename,
+                                                      pages_started)
+                    pages_started += 1
+            proc.stdout.close()
+            returncode = proc.wait()
+        finally:
+            if proc.poll() is None:
+                logging.info("Stopping Ghostscript")
+                try:
+                    proc.kill()
+                except OSError:  # Exited just now
+                    pass
+                proc.wait()
+                proc.stdout.close()
+            if tokens:
+                self.budget.release(tokens)
+        add_time('render', time.time() - start)
+        count('pages', pages_started)
+        if returncode != 0:
+            output = ''.join(output)
+            logging.error(output)
+            if "undefined in .getdeviceparams" in output:
+                error(self.msgs['GS_OUTDATED'])
+            else:
+                error(self.msgs['GS_FAILED'])
+        if pages_started:
+            yield self._get_rendered_page(output_filename, pages_started)
+
+    @staticmethod
+    def _get_rendered_page(output_filename, page_num):
+        """Return the image filename gs used for the given output page."""
+        filename = output_filename % page_num
+        logging.info("Created image %s", filename)
+        return filename
@@ -0,0 +1,111 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Streaming reader for tesseract's hocr output.
+
+    The hocr is read element by element, and every word comes out as a small
+    record, so a page never has to sit in memory as a whole element tree.
+"""
+
+from xml.etree.ElementTree import iterparse
+
+# Classes tesseract uses for the different kinds of text lines
+LINE_CLASSES = ('ocr_line', 'ocr_header', 'ocr_caption', 'ocr_textfloat')
+
+
+class HocrLine(object):
+    """A line of text, shared by all the words on it."""
+    __slots__ = ('bbox', 'baseline', 'textangle')
+
+    def __init__(self, bbox, baseline, textangle):
+        self.bbox = bbox
+        self.baseline = baseline
+        self.textangle = textangle
+
+
+class HocrWord(object):
+    """A single OCR'ed word."""
+    __slots__ = ('page', 'line', 'bbox', 'font_size', 'text')
+
+    def __init__(self, page, line, bbox, font_size, text):
+        self.page = page
+        self.line = line
+        self.bbox = bbox
+        self.font_size = font_size
+        self.text = text
+
+    def __repr__(self):
+        return "HocrWord(%d, %r, %r)" % (self.page, self.bbox, self.text)
+
+
+def parse_title(title):
+    """
+        Split an hocr title attribute such as
+        ``bbox 10 20 30 40; x_wconf 95`` into a dict of property name to
+        value string.
+    """
+    props = {}
+    for prop in title.split(';'):
+        name, _, value = prop.strip().partition(' ')
+        props[name] = value
+    return props
+
+
+def _get_bbox(props):
+    return tuple(float(i) for i in props['bbox'].split())
+
+
+def iter_hocr_words(hocrfile):
+    """
+        Generator to return the words in an hocr file, in document order.
+
+        Pages are numbered from 1.  Lines without a baseline get a
+        ``(0, 0)`` baseline, and words without font info get a font_size
+        of None.
+
+        :param hocrfile: hocr filename or file object
+        :returns: iterator of :class:`HocrWord`
+    """
+    page = 0
+    line = None
+    for event, elem in iterparse(hocrfile, events=('start', 'end')):
+        elem_class = elem.get('class')
+        if event == 'start':
+            if elem_class == 'ocr_page':
+                page += 1
+            elif elem_class in LINE_CLASSES:
+                props = parse_title(elem.get('title', ''))
+                baseline = props.get('baseline')
+                baseline = tuple(float(i) for i in baseline.split()) \
+                    if baseline else (0.0, 0.0)
+                line = HocrLine(_get_bbox(props), baseline,
+                                int(props.get('textangle', 0)))
+            continue
+
+        if elem_class == 'ocrx_word' and line is not None:
+            word_text = ' '.join(child.text for child in elem.iter()
+                                 if child.text).strip()
+            if word_text:
+                props = parse_title(elem.get('title', ''))
+                font_size = props.get('x_fsize')
+                yield HocrWord(page, line, _get_bbox(props),
+                               int(font_size) if font_size else None,
+                               word_text)
+        elif elem_class in LINE_CLASSES:
+            line = None
+            # Done with this line, so let go of its words
+            elem.clear()
+        elif elem_class == 'ocr_page':
+            elem.clear()
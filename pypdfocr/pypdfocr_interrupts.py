@@ -16,6 +16,10 @@
 
 import signal
 import logging
+import sys
+from functools import wraps
+
+from .pypdfocr_stats import bind_stats
 
 # Used for handling keyboard interrupts in Pools.
 # Basically, throw an Exception when we see the ctrl-c, so that it
@@ -35,3 +39,37 @@ def signal_handle(_signal, frame):
 def init_worker():
     """Used for catching ctrl-c"""
     signal.signal(signal.SIGINT, signal_handle)
+
+
+class WorkerExit(Exception):
+    """Exception used to carry a ``sys.exit`` out of a pool worker."""
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+def exit_as_exception(func):
+    """Decorator for functions run in a thread pool.
+
+    Our error handling calls ``sys.exit``, which would silently kill a
+    thread pool worker and leave the caller waiting forever for its result.
+    Turn it into a :class:`WorkerExit` instead, so it is re-raised on ``get``.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        """Call func and convert SystemExit."""
+        try:
+            return func(*args, **kwargs)
+        except SystemExit as err:
+            raise WorkerExit(err.code)
+    return wrapper
+
+
+def map_in_shared_pool(pool, func, iterable):
+    """Map func over iterable in a long-lived pool that the caller does not
+    own, so the pool is left running even if a worker fails.  The workers
+    record their timings into the caller's stats."""
+    try:
+        return pool.map(exit_as_exception(bind_stats(func)), iterable)
+    except WorkerExit as err:
+        sys.exit(err.code)
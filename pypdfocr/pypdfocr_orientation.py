@@ -0,0 +1,401 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Turn sideways, upside down and skewed pages upright before OCR, and map
+    the OCR'ed text back onto the page as it was scanned
+"""
+
+import io
+import logging
+import math
+import os
+import re
+
+from PIL import Image
+
+from .pypdfocr_hocr import LINE_CLASSES, parse_title
+
+# Pages are checked at this size, which keeps text lines apart but is
+# quick to go over a few times
+SAMPLE_SIZE = 1024
+# How much darker than the paper a pixel has to be to count as ink
+INK_CONTRAST = 64
+# Skew angles tried, in degrees either way, and the smallest one worth
+# straightening (tesseract copes with less)
+MAX_SKEW = 5.0
+SKEW_STEP = 0.5
+MIN_SKEW = 1.0
+# How much more level the lines have to be sideways to turn a page
+MIN_RATIO = 1.2
+# How much more ink has to be below the lines than above them to turn a
+# page upside down (upright text usually has about half as much)
+MIN_UPSIDE_DOWN_RATIO = 1.5
+# Width of the strips the ink above and below the lines is measured in.  Over
+# the whole width, what skew is left after leveling smears the ascenders and
+# descenders of each line into each other, but not over a narrow strip.
+UPSIDE_DOWN_STRIP = 64
+
+# Ways to turn a page counterclockwise by a right angle, without resampling
+TRANSPOSE = {90: Image.ROTATE_90, 180: Image.ROTATE_180,
+             270: Image.ROTATE_270}
+
+_regex_tag = re.compile(r'<[^>]*\btitle=[^>]*>')
+_regex_class = re.compile(r'''\bclass=(['"])(.*?)\1''')
+_regex_title = re.compile(r'''\btitle=(['"])(.*?)\1''')
+
+
+class PyOrientation(object):
+    """
+        Finds the orientation (in right angles) and skew of the text on page
+        images, from projection profiles of a downsampled copy: text lines
+        make the ink in each row vary much more than the ink in each column,
+        and most more when they are level.  Latin text has more ascenders
+        than descenders, which tells upside down text apart.
+    """
+
+    def __init__(self, config):
+        """
+            :param config: dict from the ``orientation`` section of the
+                           config file, with ``detect`` (False to turn this
+                           off) and ``deskew`` (False to only fix right
+                           angles)
+        """
+        self.enabled = config.get('detect', True)
+        self.deskew = config.get('deskew', True)
+
+    def get_orientation(self, img_filename):
+        """
+            :returns: (angle, skew), how far counterclockwise in degrees the
+                      text on the page is turned, as a multiple of 90 and
+                      then the small angle left over
+        """
+        ink, _ = _get_ink(img_filename)
+        if ink.getbbox() is None:
+            return 0, 0.0
+        angle, skew, ink = _level(ink.crop(ink.getbbox()), self.deskew)
+        if _is_upside_down(ink):
+            angle += 180
+        return angle, skew
+
+    @staticmethod
+    def get_x_height(img_filename):
+        """
+            Estimate the size of the text on a page from the height of the
+            middle band of its lines, whichever way they run.
+
+            :returns: median x-height in pixels of the image, or None if
+                      there are no text lines
+        """
+        ink, scale = _get_ink(img_filename)
+        if ink.getbbox() is None:
+            return None
+        # Even a slight skew smears the lines together across a whole page
+        _, _, ink = _level(ink.crop(ink.getbbox()), True, 0)
+        heights = sorted(len(core) for _, core in
+                         _iter_lines(_get_row_profile(ink)) if len(core) > 1)
+        if not heights:
+            return None
+        return heights[len(heights)//2] * scale
+
+    def make_upright(self, img_filename):
+        """
+            Turn the page image so the text on it is level and upright,
+            writing the result to <name>_upright<ext>.
+
+            :returns: (filename of the upright image, angle, skew), with the
+                      same image filename if it was upright already
+        """
+        angle, skew = self.get_orientation(img_filename)
+        logging.info("%s: text turned %d degrees, skewed %.1f degrees",
+                     img_filename, angle, skew)
+        if not angle and not skew:
+            return img_filename, 0, 0.0
+
+        img = Image.open(img_filename)
+        dpi = img.info.get('dpi')
+        if angle:
+            img = img.transpose(TRANSPOSE[360 - angle])
+            if dpi and angle != 180:
+                dpi = (dpi[1], dpi[0])
+        if skew:
+            if img.mode == '1':
+                img = img.convert('L')
+            img = img.rotate(-skew, Image.BILINEAR,
+                             fillcolor=_get_paper_colour(img))
+
+        basename, ext = os.path.splitext(img_filename)
+        upright_filename = '%s_upright%s' % (basename, ext)
+        options = {}
+        if dpi:
+            options['dpi'] = dpi
+        if img.format == 'JPEG' or ext.lower() in ('.jpg', '.jpeg'):
+            options['quality'] = 90
+        img.save(upright_filename, **options)
+        return upright_filename, angle, skew
+
+
+def restore_hocr(hocr_filename, angle, skew):
+    """
+        Rewrite the hocr of an upright image made by
+        :func:`PyOrientation.make_upright` in place, so its boxes are on the
+        page image as it was before, and its lines carry the angle the text
+        is turned by.
+    """
+    if not angle and not skew:
+        return
+    with io.open(hocr_filename, encoding='utf-8') as f:
+        hocr = f.read()
+
+    page_size = _get_page_size(hocr)
+    if page_size is None:
+        # Nothing tesseract could make sense of, so nothing to move
+        return
+    mapping = _HocrMapping(page_size[0], page_size[1], angle, skew)
+
+    def fix_tag(tag_match):
+        tag = tag_match.group(0)
+        class_match = _regex_class.search(tag)
+        elem_class = class_match.group(2) if class_match else None
+        title_match = _regex_title.search(tag)
+        if title_match is None:
+            return tag
+        props = parse_title(title_match.group(2))
+        title = mapping.fix_title(elem_class, props)
+        return '%s%s%s' % (tag[:title_match.start(2)], title,
+                           tag[title_match.end(2):])
+
+    with io.open(hocr_filename, 'w', encoding='utf-8') as f:
+        f.write(_regex_tag.sub(fix_tag, hocr))
+
+
+def _get_page_size(hocr):
+    """:returns: (width, height) of the first page in the hocr, or None"""
+    for tag_match in _regex_tag.finditer(hocr):
+        tag = tag_match.group(0)
+        class_match = _regex_class.search(tag)
+        title_match = _regex_title.search(tag)
+        if class_match and class_match.group(2) == 'ocr_page' and \
+                title_match:
+            bbox = parse_title(title_match.group(2)).get('bbox', '').split()
+            if len(bbox) == 4:
+                return float(bbox[2]), float(bbox[3])
+    return None
+
+
+class _HocrMapping(object):
+    """Maps boxes on the upright image back onto the original one."""
+
+    def __init__(self, width, height, angle, skew):
+        self.width, self.height = width, height
+        self.angle = angle
+        if angle in (90, 270):
+            self.orig_size = (height, width)
+        else:
+            self.orig_size = (width, height)
+        # The upright image was turned clockwise by skew about its centre
+        # after the right angle turn, so turn it back counterclockwise
+        rad = math.radians(skew)
+        self.cos, self.sin = math.cos(rad), math.sin(rad)
+
+    def point(self, x, y):
+        """Map a point on the upright image to the original one."""
+        # Undo the skew, about the centre
+        dx, dy = x - self.width/2.0, y - self.height/2.0
+        x = self.width/2.0 + dx*self.cos + dy*self.sin
+        y = self.height/2.0 - dx*self.sin + dy*self.cos
+        # Undo the right angle turn (the original was turned clockwise by
+        # angle to make the upright image)
+        width, height = self.width, self.height
+        if self.angle == 90:
+            return y, width - x
+        elif self.angle == 180:
+            return width - x, height - y
+        elif self.angle == 270:
+            return height - y, x
+        return x, y
+
+    def bbox(self, bbox):
+        """Map a box, keeping its size but moving its centre."""
+        x0, y0, x1, y1 = bbox
+        cx, cy = self.point((x0 + x1)/2.0, (y0 + y1)/2.0)
+        w, h = x1 - x0, y1 - y0
+        if self.angle in (90, 270):
+            w, h = h, w
+        return (cx - w/2.0, cy - h/2.0, cx + w/2.0, cy + h/2.0)
+
+    def fix_title(self, elem_class, props):
+        """:returns: the title attribute, with everything mapped"""
+        if 'bbox' not in props:
+            return _format_title(props)
+        bbox = tuple(float(i) for i in props['bbox'].split())
+        if elem_class == 'ocr_page':
+            new_bbox = (0, 0) + self.orig_size
+        else:
+            new_bbox = self.bbox(bbox)
+        props['bbox'] = ' '.join('%d' % round(i) for i in new_bbox)
+
+        if elem_class in LINE_CLASSES:
+            textangle = (int(props.get('textangle', 0)) + self.angle) % 360
+            if textangle:
+                props['textangle'] = str(textangle)
+            else:
+                props.pop('textangle', None)
+            if not self.angle:
+                props['baseline'] = self._baseline(bbox, new_bbox,
+                                                   props.get('baseline'))
+        return _format_title(props)
+
+    def _baseline(self, bbox, new_bbox, baseline):
+        """Tilt the line's baseline by the skew, through the same points."""
+        slope, offset = (0.0, 0.0)
+        if baseline:
+            slope, offset = [float(i) for i in baseline.split()]
+        x0, y0 = self.point(bbox[0], bbox[3] + offset)
+        x1, y1 = self.point(bbox[2], bbox[3] + offset + slope*(bbox[2] -
+                                                                bbox[0]))
+        new_slope = (y1 - y0)/(x1 - x0) if x1 != x0 else 0.0
+        new_offset = y0 + new_slope*(new_bbox[0] - x0) - new_bbox[3]
+        return '%.4f %.1f' % (new_slope, new_offset)
+
+
+def _format_title(props):
+    return '; '.join(('%s %s' % (name, value)).strip()
+                     for name, value in props.items() if name)
+
+
+def _get_ink(img_filename):
+    """
+        :returns: (downsampled mask of the ink on the page as an L image,
+                  size of the page image relative to the mask)
+    """
+    img = Image.open(img_filename)
+    width = img.size[0]
+    img.draft('L', (SAMPLE_SIZE, SAMPLE_SIZE))
+    img = img.convert('L')
+    img.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS)
+    paper = _get_median(img.histogram())
+    threshold = paper - INK_CONTRAST
+    return (img.point(lambda level: 255 if level < threshold else 0),
+            float(width) / img.size[0])
+
+
+def _get_paper_colour(img):
+    histogram = img.convert('L').histogram()
+    paper = _get_median(histogram)
+    if img.mode == 'RGB':
+        return (paper, paper, paper)
+    return paper
+
+
+def _get_median(histogram):
+    total = sum(histogram)
+    count = 0
+    for level, level_count in enumerate(histogram):
+        count += level_count
+        if count*2 >= total:
+            return level
+    return 255
+
+
+def _get_row_profile(ink):
+    """:returns: the amount of ink in each row"""
+    return list(ink.resize((1, ink.size[1]), Image.BOX).getdata())
+
+
+def _get_score(ink):
+    """How much the ink varies from row to row, relative to the average."""
+    profile = _get_row_profile(ink)
+    mean = float(sum(profile)) / len(profile)
+    if not mean:
+        return 0.0
+    return sum((i - mean)**2 for i in profile) / len(profile) / mean**2
+
+
+def _level(ink, deskew, min_skew=MIN_SKEW):
+    """
+        Find which way the lines of text run, and level them.  Each way is
+        leveled before they are compared, as skew blurs the difference.
+
+        :returns: (0 or 90, skew, leveled ink) where 90 means the text runs
+                  up the page, and is upright once turned clockwise
+    """
+    skew, score = _get_skew(ink, deskew, min_skew)
+    sideways = ink.transpose(Image.ROTATE_270)
+    sideways_skew, sideways_score = _get_skew(sideways, deskew, min_skew)
+    angle = 0
+    if sideways_score > score * MIN_RATIO:
+        angle, skew, ink = 90, sideways_skew, sideways
+    if skew:
+        ink = ink.rotate(-skew, Image.BILINEAR, expand=True)
+    return angle, skew, ink
+
+
+def _get_skew(ink, deskew, min_skew):
+    """
+        :returns: (skew, score), the skew (in degrees counterclockwise) that
+                  levels the lines best, or 0 if that is less than min_skew,
+                  and how well it levels them
+    """
+    if not deskew:
+        return 0.0, _get_score(ink)
+    # Half the size is still plenty to level the lines
+    ink = ink.resize((max(ink.size[0]//2, 1), max(ink.size[1]//2, 1)),
+                     Image.BOX)
+    steps = int(MAX_SKEW / SKEW_STEP)
+    scores = dict((i*SKEW_STEP,
+                   _get_score(ink.rotate(-i*SKEW_STEP, Image.BILINEAR,
+                                         expand=True)))
+                  for i in range(-steps, steps + 1))
+    # Straightest first, so ties go to the smallest turn
+    skew = max(sorted(scores, key=abs), key=lambda i: scores[i])
+    if not skew or abs(skew) < min_skew:
+        return 0.0, scores[skew]
+    return skew, scores[skew]
+
+
+def _iter_lines(profile):
+    """
+        Split a row profile into text lines.
+
+        :returns: iterator of (line, core), where line is the profile of the
+                  rows of a line, and core the indexes of the rows in its
+                  middle band (at least half as much ink as its busiest row)
+    """
+    row = 0
+    while row < len(profile):
+        if not profile[row]:
+            row += 1
+            continue
+        start = row
+        while row < len(profile) and profile[row]:
+            row += 1
+        line = profile[start:row]
+        peak = max(line)
+        yield line, [i for i, level in enumerate(line) if level*2 >= peak]
+
+
+def _is_upside_down(ink):
+    """Compare the ink above and below the middle band of each text line,
+       as ascenders are more common than descenders.  Unless there is much
+       more below, the page is taken to be upright."""
+    above = below = 0
+    width, height = ink.size
+    for left in range(0, width, UPSIDE_DOWN_STRIP):
+        strip = ink.crop((left, 0, min(left + UPSIDE_DOWN_STRIP, width),
+                          height))
+        for line, core in _iter_lines(_get_row_profile(strip)):
+            above += sum(line[:core[0]])
+            below += sum(line[core[-1] + 1:])
+    return below > above * MIN_UPSIDE_DOWN_RATIO
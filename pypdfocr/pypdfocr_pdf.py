@@ -22,59 +22,31 @@
     Wrap pdf generation and text addition code
 """
 
+import io
 import logging
 import math
 import os
 import re
-from functools import partial
-import xml.etree
-from xml.etree.ElementTree import ElementTree
+import time
 
-from cgi import escape
 # Pkg to read multiple image tiffs
 from PIL import Image
+from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfgen.canvas import Canvas
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.enums import TA_LEFT
-from reportlab.platypus.paragraph import Paragraph
 
-from PyPDF2 import PdfFileMerger, PdfFileReader, PdfFileWriter, utils
+from PyPDF2 import PdfFileReader, PdfFileWriter, utils
 
-from .pypdfocr_util import Retry
+from .pypdfocr_hocr import iter_hocr_words
+from .pypdfocr_stats import PyTimedIterator, add_time, count, timed
 
-
-class RotatedPara(Paragraph):
-    """
-        Used for rotating text, since the low-level rotate method in
-        textobject's don't seem to do anything.
-    """
-
-    def __init__(self, text, style, angle):
-        Paragraph.__init__(self, text, style)
-        self.angle = angle
-
-    def draw(self):
-        """Draw rotated canvas"""
-        self.canv.saveState()
-        self.canv.translate(0, 0)
-        self.canv.rotate(self.angle)
-        Paragraph.draw(self)
-        self.canv.restoreState()
-
-    def beginText(self, x, y):
-        """Render text on canvas"""
-        text = self.canv.beginText(x, y)
-        text.setTextRenderMode(3)  # Set to zero if you want the text to appear
-        return text
+# The text is invisible, so any of the standard fonts will do
+FONT_NAME = "Helvetica"
+# For words tesseract gave no font size for
+DEFAULT_FONT_SIZE = 8
 
 
 class PyPdf(object):
     """Class to create pdfs from images"""
-    # Some regexes to compile once
-    regex_bbox = re.compile(r'bbox((\s+\d+){4})')
-    regex_baseline = re.compile(r'baseline((\s+[\d\.\-]+){2})')
-    regex_fontspec = re.compile(r'x_font\s+(.+);\s+x_fsize\s+(\d+)')
-    regex_textangle = re.compile(r'textangle\s+(\d+)')
 
     def __init__(self, gs):
         self.gs = gs # Pointer to ghostscript object
@@ -125,62 +97,99 @@ class PyPdf(object):
                                                  ctm[1][0], ctm[1][1],
                                                  ctm[2][0], ctm[2][1]])
 
-    def overlay_hocr_pages(self, dpi, hocr_filenames, orig_pdf_filename):
+    def overlay_hocr_pages(self, dpi, hocr_filenames, orig_pdf_filename,
+                           drop_pages=()):
         """Overlay OCRed text onto pdf file."""
         logging.debug("Going to overlay following files onto %s", orig_pdf_filename)
         # Sort the hocr_filenames into natural keys!
         hocr_filenames.sort(key=lambda x: self.natural_keys(x[0]))
         logging.debug(hocr_filenames)
 
-        pdf_dir, pdf_basename = os.path.split(orig_pdf_filename)
-        basename = os.path.splitext(pdf_basename)[0]
-        pdf_filename = os.path.join(pdf_dir, "%s_ocr.pdf" % (basename))
-
-        text_pdf_filenames = []
+        text_layer = self.start_text_layer(orig_pdf_filename)
         for img_filename, hocr_filename in hocr_filenames:
-            text_pdf_filename = self.overlay_hocr_page(
-                dpi, hocr_filename, img_filename)
-            logging.info(
-                "Created temp OCR'ed pdf containing only the text as %s", text_pdf_filename)
-            text_pdf_filenames.append(text_pdf_filename)
-
-        # Now, concatenate this text_pdfs into one single file.
-        # This is a hack to save memory/running time when we have to do the
-        # actual merge with a writer.
-
-        all_text_filename = os.path.join(pdf_dir, "%s_text.pdf" % (basename))
-        merger = PdfFileMerger()
-        for text_pdf_filename in text_pdf_filenames:
-            with open(text_pdf_filename, 'rb') as f:
-                merger.append(PdfFileReader(f))
-        merger.write(all_text_filename)
-        merger.close()
-        del merger
+            self.add_text_page(text_layer, dpi, hocr_filename, img_filename)
 
+        return self.merge_text_layer(text_layer, orig_pdf_filename,
+                                     drop_pages)
 
-        writer = PdfFileWriter()
-        orig = open(orig_pdf_filename, 'rb')
-        text_file = open(all_text_filename, 'rb')
-
-        for orig_pg, text_pg in zip(self.iter_pdf_page(orig), self.iter_pdf_page(text_file)):
-            orig_pg = self._get_merged_single_page(orig_pg, text_pg)
-            writer.addPage(orig_pg)
+    @staticmethod
+    def start_text_layer(orig_pdf_filename):
+        """Start an in-memory pdf holding just the invisible text, one page
+           per OCR'ed page.  Add the pages in order with
+           :func:`add_text_page`.
 
-        with open(pdf_filename, 'wb') as f:
-            # Flush out this page merge so we can close the text_file
-            writer.write(f)
+           :returns: (canvas, buffer the canvas writes to, list of the
+                     original page numbers of the pages added so far)
+        """
+        text_buffer = io.BytesIO()
+        pdf = Canvas(text_buffer, pageCompression=1)
+        pdf.setCreator('pypdfocr')
+        pdf.setTitle(os.path.basename(orig_pdf_filename))
+        pdf.setPageCompression(1)
+        return pdf, text_buffer, []
+
+    def add_text_page(self, text_layer, dpi, hocr_filename, img_filename):
+        """Add the text of one OCR'ed page as the next page of the text layer.
+
+           Pages can be rendered at different resolutions, so the resolution
+           stored in the page image is used, and dpi only if it has none.
+           The page number in the original pdf is taken from the image
+           filename.
+        """
+        pdf, _, page_nums = text_layer
+        page_nums.append(self._get_page_num(img_filename))
+        width, height, dpi_img = self._get_img_dims(img_filename, dpi)
+        pdf.setPageSize((width, height))
+        logging.info("Adding text from %s, page width=%f, height=%f",
+                     hocr_filename, width, height)
+        self.add_text_layer(pdf, hocr_filename, 1, height, dpi_img[0])
+        pdf.showPage()
+
+    def merge_text_layer(self, text_layer, orig_pdf_filename, drop_pages=()):
+        """Merge the text layer onto the pages of the original pdf.
+
+           Pages without a text page, e.g. the ones that already had text,
+           are copied over unchanged.
+
+           :param drop_pages: Numbers of the pages to leave out, e.g. blank
+                              ones.  Ignored if it covers every page.
+           :returns: Filename of the OCR'ed pdf
+        """
+        pdf, text_buffer, page_nums = text_layer
+        text_pages = {}
+        if page_nums:
+            with timed('text_layer'):
+                pdf.save()
+            text_buffer.seek(0)
+            text_pages = dict(zip(page_nums, self.iter_pdf_page(text_buffer)))
 
-        orig.close()
-        text_file.close()
+        pdf_dir, pdf_basename = os.path.split(orig_pdf_filename)
+        basename = os.path.splitext(pdf_basename)[0]
+        pdf_filename = os.path.join(pdf_dir, "%s_ocr.pdf" % (basename))
 
-        # Windows sometimes locks the temp text file for no reason, so we need
-        # to retry a few times to delete.
-        for filename in text_pdf_filenames:
-            Retry(partial(os.remove, filename), tries=10, pause=3).call_with_retry()
+        writer = PdfFileWriter()
+        with open(orig_pdf_filename, 'rb') as orig:
+            reader = PdfFileReader(orig)
+            drop_pages = set(drop_pages)
+            if len(drop_pages) >= reader.getNumPages():
+                logging.info("Not dropping every page of %s",
+                             orig_pdf_filename)
+                drop_pages = set()
+            with timed('merge'):
+                for page_num in range(1, reader.getNumPages() + 1):
+                    if page_num in drop_pages:
+                        logging.info("Dropping page %d", page_num)
+                        continue
+                    orig_pg = reader.getPage(page_num - 1)
+                    if page_num in text_pages:
+                        orig_pg = self._get_merged_single_page(
+                            orig_pg, text_pages[page_num])
+                    writer.addPage(orig_pg)
+
+            with open(pdf_filename, 'wb') as f, timed('write'):
+                writer.write(f)
 
-        os.remove(all_text_filename)
         logging.info("Created OCR'ed pdf as %s", pdf_filename)
-
         return pdf_filename
 
     def _get_merged_single_page(self, original_page, ocr_text_page):
@@ -202,55 +211,24 @@ class PyPdf(object):
         return original_page
 
     @staticmethod
-    def _get_img_dims(img_filename):
+    def _get_img_dims(img_filename, default_dpi=None):
         """
             :rval: (width, height, dpi)
         """
         img = Image.open(img_filename)
         w, h = img.size
-        dpi = img.info['dpi']
+        dpi = img.info.get('dpi') or (default_dpi, default_dpi)
         width = w*72.0/dpi[0]
         height = h*72.0/dpi[1]
         del img
         return (width, height, dpi)
 
-    def overlay_hocr_page(self, dpi, hocr_filename, img_filename):
-        """Overlay OCR output on page"""
-        hocr_dir, hocr_basename = os.path.split(hocr_filename)
-        img_dir, img_basename = os.path.split(img_filename)
-        logging.debug("hocr_filename:%s, hocr_dir:%s, hocr_basename:%s",
-                      hocr_filename, hocr_dir, hocr_basename)
-        assert img_dir == hocr_dir
-
-        #basename = hocr_basename.split('.')[0]
-        basename = os.path.splitext(hocr_basename)[0]
-        pdf_filename = os.path.join("text_%s_ocr.pdf" % (basename))
-
-        # Switch to the hocr directory to make this easier
-        cwd = os.getcwd()
-        if hocr_dir != "":
-            os.chdir(hocr_dir)
-
-        with open(pdf_filename, "wb") as f:
-            logging.info("Overlaying hocr and creating text pdf %s", pdf_filename)
-            pdf = Canvas(f, pageCompression=1)
-            pdf.setCreator('pypdfocr')
-            pdf.setTitle(os.path.basename(hocr_filename))
-            pdf.setPageCompression(1)
-
-            width, height, dpi_jpg = self._get_img_dims(img_basename)
-            pdf.setPageSize((width, height))
-            logging.info("Page width=%f, height=%f", width, height)
-
-            pg_num = 1
-
-            logging.info("Adding text to page %s", pdf_filename)
-            self.add_text_layer(pdf, hocr_basename, pg_num, height, dpi)
-            pdf.showPage()
-            pdf.save()
-
-        os.chdir(cwd)
-        return os.path.join(hocr_dir, pdf_filename)
+    @staticmethod
+    def _get_page_num(img_filename):
+        """The page images are named <pdf name>_<page number>.<ext> (with
+           a suffix for preprocessed ones), so the last number in the
+           filename is the page number."""
+        return int(re.findall(r'\d+', os.path.basename(img_filename))[-1])
 
     @staticmethod
     def iter_pdf_page(filepath):
@@ -275,93 +253,78 @@ class PyPdf(object):
     def add_text_layer(self, pdf, hocrfile, page_num, height, dpi):
         """Draw an invisible text layer for OCR data.
 
-           This function really needs to get cleaned up
+           The hocr is streamed word by word, with one text object per line.
+           The time spent parsing the hocr and drawing the words are
+           recorded as separate stages.
         """
-        hocr = ElementTree()
+        start = time.time()
+        words = PyTimedIterator(iter_hocr_words(hocrfile))
+        num_words = 0
+        text = None
+        line = None
         try:
+            for word in words:
+                if word.page != page_num:
+                    continue
+                if word.line is not line:
+                    if text is not None:
+                        pdf.drawText(text)
+                    line = word.line
+                    text = pdf.beginText()
+                    text.setTextRenderMode(3)  # Set to zero if you want the text to appear
+                self._add_word(text, word, height, dpi)
+                num_words += 1
+        except Exception:
             # It's possible tesseract has failed and written garbage to this
             # hocr file, so we need to catch any exceptions
-            hocr.parse(hocrfile)
-        except Exception:
-            logging.info("Error loading hocr, not adding any text")
-            return
-
-        # logging.debug(xml.etree.ElementTree.tostring(hocr.getroot()))
-        for elem in hocr.getroot():  # Find the <body> tag
-            if elem.tag != 'body':
-                continue
-        for page in elem: # Each child in the body is a page tag
-            if page.attrib['class'] != "ocr_page":
-                assert "Why is this hocr not paging properly??"
-            if page.attrib['id'] == 'page_%d' %(page_num):
-                break
-
-        for line in page.findall(".//{http://www.w3.org/1999/xhtml}span"):
-            if line.attrib['class'] != 'ocr_line':
-                continue
-            linebox = self.regex_bbox.search(line.attrib['title']).group(1).split()
-            textangle = self.regex_textangle.search(line.attrib['title'])
-            if textangle:
-                textangle = self._atoi(textangle.group(1))
-            else:
-                textangle = 0
-
-            try:
-                baseline = self.regex_baseline.search(line.attrib['title']).group(1).split()
-            except AttributeError:
-                baseline = [0, 0]
-
-            linebox = [float(i) for i in linebox]
-            baseline = [float(i) for i in baseline]
-
-            for word in line:
-                if word.attrib['class'] != 'ocrx_word':
-                    continue
-                word_text = []
-                for child in word.iter():
-                    if child.text:
-                        word_text.append(child.text)
-                word.text = ' '.join(word_text)
-                if word.text is None:
-                    continue
-                # logging.debug("word: %s, angle: %d", word.text.strip(), textangle)
-
+            logging.info("Error loading hocr, not adding any more text")
+        if text is not None:
+            pdf.drawText(text)
+        add_time('hocr_parse', words.seconds)
+        add_time('text_layer', time.time() - start - words.seconds)
+        count('words', num_words)
 
-                box = self.regex_bbox.search(word.attrib['title']).group(1).split()
-                box = [float(i) for i in box]
-
-                # Transform angle to x,y co-ords needed for proper text placement
-                # We only support 0, 90, 180, 270!.  Anything else, we'll just
-                # use the normal orientation for now.
-
-                coords = {0: (box[0], box[1]),
-                          90: (box[0], box[3]),  # facing right
-                          180: (box[2], box[3]), # upside down
-                          270: (box[2], box[1]), # facing left
-                         }
-                x, y = coords.get(textangle, (box[0], box[1]))
-
-                style = getSampleStyleSheet()
-                normal = style["BodyText"]
-                normal.alignment = TA_LEFT
-                normal.leading = 0
-                font_name, font_size = self._get_font_spec(word.attrib['title'])
-                normal.fontName = "Helvetica"
-                normal.fontSize = font_size
+    @staticmethod
+    def _add_word(text, word, height, dpi):
+        """Place one word on the line's text object.
 
-                para = RotatedPara(escape(word.text.strip()), normal, textangle)
-                para.wrapOn(pdf, para.minWidth(), 100)  # Not sure what to use as the height  here
-                para.drawOn(pdf, x*72/dpi, height - y*72/dpi)
+           The text matrix rotates the word to the line's text angle and puts
+           it at the start of its bounding box, and horizontal scaling
+           stretches it to the width of the box.
+        """
+        box = word.bbox
+        textangle = word.line.textangle
+        font_size = word.font_size or DEFAULT_FONT_SIZE
+        # Transform angle to x,y co-ords needed for proper text placement
+        # We only support 0, 90, 180, 270!.  Anything else, we'll just
+        # use the normal orientation for now.
+        if textangle in (90, 270):
+            box_width = box[3] - box[1]
+        else:
+            box_width = box[2] - box[0]
+        coords = {90: (box[2], box[3]),  # facing right
+                  180: (box[2], box[1]), # upside down
+                  270: (box[0], box[1]), # facing left
+                 }
+        if textangle in coords:
+            x, y = coords[textangle]
+        else:
+            textangle = 0
+            # Sit the word on the line's baseline
+            linebox, baseline = word.line.bbox, word.line.baseline
+            x = box[0]
+            y = linebox[3] + baseline[1] + baseline[0]*(box[0] - linebox[0])
+
+        text.setFont(FONT_NAME, font_size)
+        word_width = pdfmetrics.stringWidth(word.text, FONT_NAME, font_size)
+        if word_width > 0:
+            text.setHorizScale(100.0*box_width*72/dpi/word_width)
+        angle = math.radians(textangle)
+        text.setTextTransform(math.cos(angle), math.sin(angle),
+                              -math.sin(angle), math.cos(angle),
+                              x*72/dpi, height - y*72/dpi)
+        text.textOut(word.text)
 
     @staticmethod
     def polyval(poly, x):
         return x * poly[0] + poly[1]
-
-    def _get_font_spec(self, tag):
-        try:
-            fontspec = self.regex_fontspec.search(tag).groups()
-            fontname, fontsize = fontspec
-        except Exception:
-            fontname = ""
-            fontsize = "8"
-        return (fontname, self._atoi(fontsize))
@@ -18,6 +18,8 @@
 
 """
     Wrap ImageMagick calls.  Yes, this is ugly.
+
+    If numpy is installed, the same cleanup can be done in-process instead.
 """
 
 import logging
@@ -25,7 +27,25 @@ import os
 import subprocess
 
 from multiprocessing import Pool
-from .pypdfocr_interrupts import init_worker
+from PIL import Image, ImageFilter
+from .pypdfocr_cpu import get_cpu_count, get_thread_env, use_cpus
+from .pypdfocr_interrupts import init_worker, map_in_shared_pool
+from .pypdfocr_stats import timed
+
+try:
+    import numpy
+    NUMPY_ENABLED = True
+except ImportError:
+    NUMPY_ENABLED = False
+
+# Side of the neighbourhood the local threshold averages over, and how much
+# darker than its neighbourhood a pixel has to be to count as ink (the
+# equivalent of convert's -lat 15x15+5%)
+THRESHOLD_WINDOW = 15
+THRESHOLD_OFFSET = 0.05
+# Vertical lines at least this long are removed, as tesseract < 3.03
+# ignores text close to them (e.g. in tables)
+MIN_LINE_LENGTH = 60
 
 
 def unwrap_self(arg, **kwarg):
@@ -42,7 +62,17 @@ class PyPreprocess(object):
     def __init__(self, config):
         self.msgs = {
             'CV_FAILED': 'convert execution failed', }
-        self.threads = config.get('threads', 4)
+        self.threads = config.get('threads', get_cpu_count())
+        # Long-lived thread pool shared with the other stages, if any
+        self.pool = None
+        # PyCpuBudget shared with the other stages, if any; each image
+        # being cleaned up holds one of its tokens
+        self.budget = None
+        self.engine = config.get('engine', 'convert')
+        if self.engine == 'numpy' and not NUMPY_ENABLED:
+            logging.warning("Could not find numpy, so preprocessing with"
+                            " ImageMagick convert")
+            self.engine = 'convert'
 
     def cmd(self, cmd_list):
         """Run command as subprocess and return output."""
@@ -50,8 +80,11 @@ class PyPreprocess(object):
             cmd_list = ' '.join(cmd_list)
         logging.debug("Running cmd: %s", cmd_list)
         try:
-            out = subprocess.check_output(
-                cmd_list, stderr=subprocess.STDOUT, shell=True)
+            with use_cpus(self.budget) as threads:
+                # Stop ImageMagick from using every core for each image
+                out = subprocess.check_output(
+                    cmd_list, stderr=subprocess.STDOUT, shell=True,
+                    env=get_thread_env(threads))
             logging.debug(out)
             return out
         except subprocess.CalledProcessError as err:
@@ -61,6 +94,10 @@ class PyPreprocess(object):
     def _run_preprocess(self, in_filename):
         basename, filext = os.path.splitext(in_filename)
         out_filename = '%s_preprocess%s' % (basename, filext)
+        if self.engine == 'numpy':
+            with use_cpus(self.budget), timed('preprocess'):
+                return self._run_preprocess_numpy(in_filename, out_filename)
+
         # When using Windows, can't use backslash parenthesis in the shell
         if str(os.name) == 'nt':
             backslash = ''
@@ -96,15 +133,43 @@ class PyPreprocess(object):
         if str(os.name) == 'nt':
             cmd_list = ['magick'] + cmd_list
         logging.info("Preprocessing image %s for better OCR", in_filename)
-        res = self.cmd(cmd_list)
+        with timed('preprocess'):
+            res = self.cmd(cmd_list)
         if res is None:
             return in_filename
         return out_filename
 
+    @staticmethod
+    def _run_preprocess_numpy(in_filename, out_filename):
+        """Clean up the image with :func:`clean_image`, without starting
+           a convert process."""
+        logging.info("Preprocessing image %s for better OCR", in_filename)
+        try:
+            img = Image.open(in_filename)
+            img.load()
+        except IOError as err:
+            logging.warning("Could not read image %s: %s", in_filename, err)
+            return in_filename
+        options = {}
+        if 'dpi' in img.info:
+            # The text layer is sized from the resolution in the image
+            options['dpi'] = img.info['dpi']
+        if img.format == 'JPEG':
+            options['quality'] = 90
+        clean_image(img).save(out_filename, **options)
+        return out_filename
+
     def preprocess(self, in_filenames):
         """Preprocess multiple files."""
         fns = in_filenames
 
+        if self.pool is not None:
+            logging.info("Starting preprocessing parallel execution")
+            preprocessed_filenames = map_in_shared_pool(
+                self.pool, unwrap_self, list(zip([self]*len(fns), fns)))
+            logging.info("Completed preprocessing")
+            return preprocessed_filenames
+
         pool = Pool(processes=self.threads, initializer=init_worker)
         try:
             logging.info("Starting preprocessing parallel execution")
@@ -121,3 +186,66 @@ class PyPreprocess(object):
         logging.info("Completed preprocessing")
         logging.debug("Output filenames: %s", preprocessed_filenames)
         return preprocessed_filenames
+
+
+def clean_image(img, window=THRESHOLD_WINDOW, offset=THRESHOLD_OFFSET,
+                min_line_length=MIN_LINE_LENGTH):
+    """
+        Same cleanup as the convert command, on numpy arrays: keep the pixels
+        that are darker than their neighbourhood, whiten the rest, soften
+        and sharpen the result, and remove long vertical lines.
+
+        :param img: PIL image of a page
+        :returns: cleaned greyscale PIL image
+    """
+    grey = numpy.asarray(img.convert('L'), dtype=numpy.float64)
+    ink = grey < local_mean(grey, window) - offset*255
+    pixels = numpy.where(ink, grey, 255).astype(numpy.uint8)
+
+    cleaned = Image.fromarray(pixels)
+    cleaned = cleaned.filter(ImageFilter.GaussianBlur(1))
+    cleaned = cleaned.filter(ImageFilter.UnsharpMask(radius=2, percent=100,
+                                                     threshold=0))
+
+    pixels = numpy.array(cleaned)
+    pixels[vertical_runs(pixels < 128, min_line_length)] = 255
+    return Image.fromarray(pixels)
+
+
+def local_mean(pixels, window):
+    """
+        Mean of the window x window neighbourhood of every pixel, with the
+        edges padded by repeating the border.
+
+        Uses an integral image, so the cost doesn't depend on the window.
+    """
+    before = window // 2
+    after = window - 1 - before
+    padded = numpy.pad(pixels, ((before, after), (before, after)), 'edge')
+    integral = numpy.zeros((padded.shape[0]+1, padded.shape[1]+1))
+    integral[1:, 1:] = padded.cumsum(0).cumsum(1)
+    total = (integral[window:, window:] - integral[:-window, window:]
+             - integral[window:, :-window] + integral[:-window, :-window])
+    return total / (window*window)
+
+
+def vertical_runs(mask, length):
+    """
+        :returns: mask of the pixels that are part of a vertical run of at
+                  least length set pixels
+    """
+    height = mask.shape[0]
+    if height < length:
+        return numpy.zeros_like(mask)
+    # Set pixels above each row, in every column
+    counts = numpy.zeros((height+1, mask.shape[1]), dtype=numpy.int64)
+    counts[1:] = mask.cumsum(0)
+    # Runs of length starting at each row, and how many start above it
+    full = (counts[length:] - counts[:-length]) == length
+    starts = numpy.zeros((full.shape[0]+1, mask.shape[1]), dtype=numpy.int64)
+    starts[1:] = full.cumsum(0)
+    # A pixel is covered if a run starts in the length rows ending at it
+    rows = numpy.arange(height)
+    last = numpy.minimum(rows, height - length) + 1
+    first = numpy.maximum(rows - length + 1, 0)
+    return (starts[last] - starts[first]) > 0
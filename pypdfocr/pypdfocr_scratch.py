@@ -0,0 +1,211 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Scratch directories for the intermediate files of a conversion, and a
+    background queue to delete them with
+"""
+
+import errno
+import heapq
+import itertools
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from threading import Thread
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class PyScratch(object):
+    """
+        Owns the scratch directory of one conversion job.
+
+        Every intermediate file of the job (page images, preprocessed
+        images, tesseract output) is written inside the directory, so
+        :func:`cleanup` removes all of them at once.  The directory name
+        carries the process id, so directories left behind by a process
+        that crashed can be found and removed by :func:`sweep`.
+    """
+    prefix = 'pypdfocr_'
+    regex_dir = re.compile(r'^pypdfocr_(\d+)_')
+
+    def __init__(self, root=None):
+        """
+            :param root: Directory to make the scratch directory in, e.g.
+                         a tmpfs like /dev/shm.  Defaults to the system
+                         temporary directory.
+        """
+        self.root = self.get_root(root)
+        self.path = tempfile.mkdtemp(
+            prefix='%s%d_' % (self.prefix, os.getpid()), dir=self.root)
+        logging.debug("Created scratch directory %s", self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    @staticmethod
+    def get_root(root=None):
+        """:returns: the root directory, expanded, or the system default"""
+        if root:
+            return os.path.expanduser(root)
+        return tempfile.gettempdir()
+
+    def cleanup(self, delete_queue=None):
+        """
+            Remove the scratch directory with everything in it.
+
+            :param delete_queue: Optional :class:`PyDeleteQueue` to hand the
+                                 removal to, instead of waiting for it
+        """
+        if delete_queue is not None:
+            delete_queue.delete(self.path)
+            return
+        logging.debug("Removing scratch directory %s", self.path)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    @classmethod
+    def sweep(cls, root=None):
+        """
+            Remove the scratch directories of processes that are no longer
+            running, e.g. because they crashed half way through a job.
+
+            :returns: list of the directories removed
+        """
+        root = cls.get_root(root)
+        removed = []
+        try:
+            names = os.listdir(root)
+        except OSError:
+            return removed
+        for name in names:
+            match = cls.regex_dir.match(name)
+            if not match or _is_running(int(match.group(1))):
+                continue
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                logging.info("Removing leftover scratch directory %s", path)
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+        return removed
+
+
+class PyDeleteQueue(object):
+    """
+        Deletes files and directories in a background thread.
+
+        Deleting usually just works, but on some systems a file stays locked
+        for a moment after the program that wrote it has exited.  Failed
+        deletes are retried with exponential backoff, so the only waiting
+        is for paths that actually failed, and nobody else waits at all.
+    """
+    # Sentinel asking the worker to finish up
+    _stop = object()
+
+    def __init__(self, tries=8, pause=0.1, max_pause=5):
+        """
+            :param tries: Attempts per path before giving up
+            :param pause: Wait before the first retry, doubled for each one
+            :param max_pause: Longest wait between retries
+        """
+        self.tries = tries
+        self.pause = pause
+        self.max_pause = max_pause
+        self.queue = queue.Queue()
+        self.failed = []
+        self.thread = Thread(target=self._run, name='pypdfocr-delete')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def delete(self, path):
+        """Queue a file or directory for deletion."""
+        self.queue.put(path)
+
+    def close(self, timeout=None):
+        """
+            Wait for the queued deletes (and their retries) to finish.
+
+            :returns: True if they all finished within the timeout
+        """
+        self.queue.put(self._stop)
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def _run(self):
+        # Heap of (when, sequence number, path, tries so far)
+        retries = []
+        counter = itertools.count()
+        stopping = False
+        while not stopping or retries:
+            timeout = None
+            if retries:
+                timeout = max(0, retries[0][0] - time.time())
+            if stopping:
+                time.sleep(timeout)
+                item = None
+            else:
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+            if item is self._stop:
+                stopping = True
+            elif item is not None:
+                self._try_delete(retries, counter, item, 0)
+            while retries and retries[0][0] <= time.time():
+                _, _, path, tries = heapq.heappop(retries)
+                self._try_delete(retries, counter, path, tries)
+
+    def _try_delete(self, retries, counter, path, tries):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            logging.debug("Deleted %s", path)
+        except OSError as err:
+            tries += 1
+            if tries >= self.tries:
+                logging.warning("Could not delete %s: %s", path, err)
+                self.failed.append(path)
+                return
+            pause = min(self.pause * 2 ** (tries - 1), self.max_pause)
+            logging.debug("Could not delete %s (%s), retrying in %.1fs",
+                          path, err, pause)
+            heapq.heappush(retries,
+                           (time.time() + pause, next(counter), path, tries))
+
+
+def _is_running(pid):
+    """Check if a process is still running."""
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        # No cheap way to check, so leave the directory alone
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        # EPERM means it's running, just not ours
+        return err.errno == errno.EPERM
+    return True
@@ -0,0 +1,387 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    A persistent queue of conversion jobs, and the HTTP API to submit jobs,
+    check on them and fetch their results
+"""
+
+import heapq
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import time
+import uuid
+from threading import Condition
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import socketserver
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    import SocketServer as socketserver
+
+try:
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # Python 2
+    from urlparse import parse_qs, urlparse
+
+
+class PyJobQueue(object):
+    """
+        Conversion jobs, handed out highest priority first (and oldest first
+        for the same priority).
+
+        Each job is kept as a JSON file in the jobs directory, rewritten on
+        every change of status, so the queue survives a restart.  Jobs that
+        were still running when the service stopped are queued again.
+        Uploaded pdfs are kept in the uploads subdirectory, where their
+        OCR'ed pdfs are written too.
+    """
+
+    def __init__(self, jobs_dir):
+        """:param jobs_dir: Directory to keep the jobs and uploads in"""
+        self.jobs_dir = os.path.expanduser(jobs_dir)
+        self.uploads_dir = os.path.join(self.jobs_dir, 'uploads')
+        for dirname in (self.jobs_dir, self.uploads_dir):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        self.jobs = {}
+        # Heap of (-priority, submitted, job id) of the queued jobs
+        self.queue = []
+        self.condition = Condition()
+        self.stopping = False
+        self._load()
+
+    def _load(self):
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with io.open(os.path.join(self.jobs_dir, name),
+                             encoding='utf-8') as f:
+                    job = json.load(f)
+            except (IOError, ValueError) as err:
+                logging.warning("Could not read job %s: %s", name, err)
+                continue
+            self.jobs[job['id']] = job
+            if job['status'] == 'running':
+                logging.info("Queueing interrupted job %s again", job['id'])
+                job['status'] = 'queued'
+                self._save(job)
+            if job['status'] == 'queued':
+                heapq.heappush(self.queue, self._get_queue_key(job))
+        logging.info("Loaded %d jobs, %d queued", len(self.jobs),
+                     len(self.queue))
+
+    @staticmethod
+    def _get_queue_key(job):
+        return (-job['priority'], job['submitted'], job['id'])
+
+    def _save(self, job):
+        """Write a job file, so it is never seen half written."""
+        filename = os.path.join(self.jobs_dir, '%s.json' % job['id'])
+        tmp_filename = filename + '.tmp'
+        with io.open(tmp_filename, 'wb') as f:
+            f.write(json.dumps(job, sort_keys=True).encode('utf-8'))
+        try:
+            os.replace(tmp_filename, filename)
+        except AttributeError:  # Python 2
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp_filename, filename)
+
+    @staticmethod
+    def new_job_id():
+        """:returns: a new unique job id"""
+        return uuid.uuid4().hex
+
+    def get_upload_filename(self, job_id):
+        """:returns: filename to save the uploaded pdf of a job as"""
+        return os.path.join(self.uploads_dir, '%s.pdf' % job_id)
+
+    def submit(self, pdf_filename, priority=0, job_id=None):
+        """
+            Queue a pdf for conversion.
+
+            :param priority: Jobs with a higher priority go first
+            :param job_id: Id from :func:`new_job_id`, if the pdf was
+                           uploaded with it
+            :returns: the job, as a dict
+        """
+        job = {'id': job_id or self.new_job_id(),
+               'pdf': os.path.abspath(pdf_filename),
+               'upload': job_id is not None,
+               'priority': int(priority),
+               'status': 'queued',
+               'submitted': time.time(),
+               'started': None,
+               'finished': None,
+               'output': None,
+               'filing': None,
+               'error': None,
+               'stats': None}
+        with self.condition:
+            self.jobs[job['id']] = job
+            self._save(job)
+            heapq.heappush(self.queue, self._get_queue_key(job))
+            self.condition.notify()
+        logging.info("Queued job %s for %s with priority %d", job['id'],
+                     job['pdf'], job['priority'])
+        return dict(job)
+
+    def get(self, job_id):
+        """:returns: a copy of the job, or None if there is no such job"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_all(self):
+        """:returns: copies of all the jobs, oldest first"""
+        with self.condition:
+            jobs = [dict(job) for job in self.jobs.values()]
+        return sorted(jobs, key=lambda job: job['submitted'])
+
+    def next_job(self):
+        """
+            Wait for the next job to run, and mark it running.
+
+            :returns: a copy of the job, or None once the queue is stopped
+        """
+        with self.condition:
+            while not self.queue and not self.stopping:
+                # Waiting with a timeout keeps the wait interruptible
+                self.condition.wait(1)
+            if self.stopping:
+                return None
+            job = self.jobs[heapq.heappop(self.queue)[2]]
+            job['status'] = 'running'
+            job['started'] = time.time()
+            self._save(job)
+            return dict(job)
+
+    def finish(self, job_id, output=None, filing=None, error=None,
+               stats=None):
+        """
+            Mark a job done, or failed if there is an error.
+
+            :param stats: Timings report of the conversion, from
+                          :func:`PyStats.get_report`
+        """
+        with self.condition:
+            job = self.jobs[job_id]
+            job['status'] = 'failed' if error is not None else 'done'
+            job['finished'] = time.time()
+            job['output'] = output
+            job['filing'] = filing
+            job['error'] = error
+            job['stats'] = stats
+            self._save(job)
+        logging.info("Job %s %s", job_id, job['status'])
+
+    def stop(self):
+        """Stop handing out jobs, and wake up the workers waiting for one."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+
+class PyJobServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+        HTTP API of a :class:`PyJobQueue`, on a TCP port.
+
+        - ``POST /jobs`` queues a job, given either a JSON body with the
+          ``path`` of a pdf (and optionally its ``priority``), or the pdf
+          itself as an ``application/pdf`` body, with the priority as a
+          ``priority`` query parameter.  Returns the job.
+        - ``GET /jobs`` returns all the jobs.
+        - ``GET /jobs/<id>`` returns one job, with its status.
+        - ``GET /jobs/<id>/result`` returns the OCR'ed pdf of a job that is
+          done.
+        - ``GET /stats`` returns the histograms of the stage timings of all
+          the conversions since the service started.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, jobs, histograms=None):
+        """
+            :param address: (host, port) to listen on
+            :param jobs: :class:`PyJobQueue` to serve
+            :param histograms: :class:`PyHistograms` to serve, if any
+        """
+        self.jobs = jobs
+        self.histograms = histograms
+        HTTPServer.__init__(self, address, _JobRequestHandler)
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class PyUnixJobServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+        """The same API as :class:`PyJobServer`, on a Unix socket."""
+        daemon_threads = True
+
+        def __init__(self, path, jobs, histograms=None):
+            """
+                :param path: Filename of the socket
+                :param jobs: :class:`PyJobQueue` to serve
+                :param histograms: :class:`PyHistograms` to serve, if any
+            """
+            self.jobs = jobs
+            self.histograms = histograms
+            if os.path.exists(path):
+                os.remove(path)
+            socketserver.UnixStreamServer.__init__(self, path,
+                                                   _JobRequestHandler)
+else:  # Windows
+    PyUnixJobServer = None
+
+
+def make_server(address, jobs, histograms=None, allow_remote=False):
+    """
+        :param address: "HOST:PORT", just "PORT" for localhost, or
+                        "unix:PATH" for a Unix socket
+        :param histograms: :class:`PyHistograms` to serve, if any
+        :param allow_remote: Whether HOST may be other than localhost.  The
+                             API has no authentication, and lets any client
+                             have any pdf the service can read OCR'ed.
+        :returns: :class:`PyJobServer` or :class:`PyUnixJobServer` listening
+                  on the address
+    """
+    if address.startswith('unix:'):
+        if PyUnixJobServer is None:
+            raise ValueError("Unix sockets are not available here")
+        return PyUnixJobServer(os.path.expanduser(address[5:]), jobs,
+                               histograms)
+    host, _, port = address.rpartition(':')
+    host = host or '127.0.0.1'
+    if not is_loopback(host):
+        if not allow_remote:
+            raise ValueError("Refusing to take jobs on %s, which is not"
+                             " localhost, as anyone who can reach it could"
+                             " read any pdf this service can" % host)
+        logging.warning("Taking jobs on %s without any authentication",
+                        address)
+    return PyJobServer((host, int(port)), jobs, histograms)
+
+
+def is_loopback(host):
+    """:returns: True if every address the host name stands for is a
+       loopback address, so only clients on this machine can connect"""
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return bool(addresses) and all(
+        info[4][0].startswith('127.') or info[4][0] == '::1'
+        for info in addresses)
+
+
+class _JobRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of the job API."""
+    regex_job = re.compile(r'^/jobs/([0-9a-f]+)(/result)?/?$')
+
+    def log_message(self, fmt, *args):
+        logging.info("%s", fmt % args)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        jobs = self.server.jobs
+        if path.rstrip('/') == '/jobs':
+            self._send_json(200, jobs.get_all())
+            return
+        if path.rstrip('/') == '/stats':
+            if self.server.histograms is None:
+                self._send_json(404, {'error': 'No stats'})
+            else:
+                self._send_json(200, self.server.histograms.get_report())
+            return
+        match = self.regex_job.match(path)
+        job = jobs.get(match.group(1)) if match else None
+        if job is None:
+            self._send_json(404, {'error': 'No such job'})
+        elif not match.group(2):
+            self._send_json(200, job)
+        elif job['status'] != 'done':
+            self._send_json(409, {'error': 'Job is %s' % job['status']})
+        elif not job['output'] or not os.path.exists(job['output']):
+            self._send_json(410, {'error': 'Output is gone (filed?)'})
+        else:
+            self._send_file(job['output'])
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        jobs = self.server.jobs
+        length = int(self.headers.get('Content-Length') or 0)
+        content_type = self.headers.get('Content-Type') or ''
+        try:
+            if content_type.startswith('application/pdf'):
+                priority = parse_qs(url.query).get('priority', [0])[0]
+                priority = int(priority)
+                job_id = jobs.new_job_id()
+                upload_filename = jobs.get_upload_filename(job_id)
+                self._save_body(length, upload_filename)
+                job = jobs.submit(upload_filename, priority, job_id)
+            else:
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                if not os.path.isfile(request['path']):
+                    self._send_json(400, {'error': 'No such file %s'
+                                                   % request['path']})
+                    return
+                job = jobs.submit(request['path'],
+                                  int(request.get('priority', 0)))
+        except (ValueError, KeyError, TypeError) as err:
+            self._send_json(400, {'error': 'Bad request: %s' % err})
+            return
+        self._send_json(201, job)
+
+    def _save_body(self, length, filename):
+        with open(filename, 'wb') as f:
+            while length > 0:
+                chunk = self.rfile.read(min(length, 1 << 16))
+                if not chunk:
+                    break
+                f.write(chunk)
+                length -= len(chunk)
+
+    def _send_json(self, code, data):
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, filename):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(os.path.getsize(filename)))
+        self.send_header('Content-Disposition', 'attachment; filename="%s"'
+                         % os.path.basename(filename))
+        self.end_headers()
+        with open(filename, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
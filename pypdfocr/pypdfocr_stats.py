@@ -0,0 +1,274 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Timings of the stages of each conversion, counters of what went through
+    them, and histograms of the timings over all conversions
+
+    The stages record into the :class:`PyStats` of the job the current
+    thread works for, set with :func:`use_stats`.  Work handed to a pool
+    thread is wrapped with :func:`bind_stats` to keep recording into the
+    same job.  Without any, nothing is recorded.
+"""
+
+import io
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+# Upper bounds of the histogram buckets, in seconds: 1ms doubling up to
+# about 17 minutes
+BUCKETS = tuple(0.001 * 2 ** i for i in range(21))
+
+_current = local()
+
+
+class PyStats(object):
+    """Timings of the stages of one conversion, and its counters."""
+
+    def __init__(self, name=None):
+        """:param name: What is being converted, for the report"""
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        # Stage name -> list of the seconds of each time it ran
+        self.timings = {}
+        self.counters = {}
+        self.lock = Lock()
+
+    def add_time(self, stage, seconds):
+        """Record one run of a stage."""
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    def count(self, counter, amount=1):
+        """Add to a counter, e.g. of pages or bytes."""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def finish(self):
+        """Stop the clock of the whole conversion."""
+        self.end = time.time()
+
+    def get_report(self):
+        """
+            :returns: dict with the total seconds, the count, total, min and
+                      max seconds of each stage, and the counters
+        """
+        with self.lock:
+            stages = dict((stage, _summarize(seconds))
+                          for stage, seconds in self.timings.items())
+            counters = dict(self.counters)
+        return {'name': self.name,
+                'seconds': (self.end or time.time()) - self.start,
+                'stages': stages,
+                'counters': counters}
+
+    def get_summary(self):
+        """:returns: one line with the total seconds of each stage"""
+        report = self.get_report()
+        stages = sorted(report['stages'].items(),
+                        key=lambda item: -item[1]['total'])
+        return ', '.join(['%.2fs total' % report['seconds']] +
+                         ['%s %.2fs' % (stage, summary['total'])
+                          for stage, summary in stages])
+
+
+class PyHistograms(object):
+    """
+        Histograms of the stage timings of all the conversions, to show up
+        slow stages and regressions over many documents.
+    """
+
+    def __init__(self):
+        self.jobs = 0
+        # Stage name -> dict with count, total, min, max and bucket counts
+        self.stages = {}
+        self.counters = {}
+        self.lock = Lock()
+
+    def add(self, stats):
+        """Add the timings and counters of a finished conversion."""
+        with stats.lock:
+            timings = dict((stage, list(seconds))
+                           for stage, seconds in stats.timings.items())
+            counters = dict(stats.counters)
+        timings['total'] = [(stats.end or time.time()) - stats.start]
+        with self.lock:
+            self.jobs += 1
+            for stage, all_seconds in timings.items():
+                histogram = self.stages.setdefault(stage, {
+                    'count': 0, 'total': 0.0, 'min': None, 'max': None,
+                    'buckets': [0] * (len(BUCKETS) + 1)})
+                for seconds in all_seconds:
+                    if not histogram['count']:
+                        histogram['min'] = histogram['max'] = seconds
+                    histogram['count'] += 1
+                    histogram['total'] += seconds
+                    histogram['min'] = min(seconds, histogram['min'])
+                    histogram['max'] = max(seconds, histogram['max'])
+                    histogram['buckets'][_get_bucket(seconds)] += 1
+            for counter, amount in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def get_report(self):
+        """
+            :returns: dict with the number of conversions, the summed
+                      counters, and for each stage its count, total, min,
+                      max, approximate median/90th/99th percentile, and the
+                      number of runs in each bucket (by upper bound in
+                      seconds)
+        """
+        with self.lock:
+            stages = {}
+            for stage, histogram in self.stages.items():
+                buckets = histogram['buckets']
+                stages[stage] = {
+                    'count': histogram['count'],
+                    'total': histogram['total'],
+                    'min': histogram['min'],
+                    'max': histogram['max'],
+                    'p50': _get_percentile(buckets, 0.5, histogram['max']),
+                    'p90': _get_percentile(buckets, 0.9, histogram['max']),
+                    'p99': _get_percentile(buckets, 0.99, histogram['max']),
+                    'buckets': dict(
+                        (_get_bucket_label(i), runs)
+                        for i, runs in enumerate(buckets) if runs)}
+            return {'jobs': self.jobs, 'stages': stages,
+                    'counters': dict(self.counters)}
+
+
+class PyTimedIterator(object):
+    """
+        Iterator over another one that adds up the time spent getting its
+        items, e.g. parsing them, apart from the time spent using them.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.time() - start
+
+    next = __next__  # Python 2
+
+
+def write_report(report, filename):
+    """Write a report as JSON, replacing any earlier one at once."""
+    tmp_filename = filename + '.tmp'
+    with io.open(tmp_filename, 'wb') as f:
+        f.write(json.dumps(report, indent=2, sort_keys=True).encode('utf-8'))
+    try:
+        os.replace(tmp_filename, filename)
+    except AttributeError:  # Python 2
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+
+
+def get_current():
+    """:returns: the :class:`PyStats` the current thread records into"""
+    return getattr(_current, 'stats', None)
+
+
+@contextmanager
+def use_stats(stats):
+    """Record into stats in the current thread for a with block."""
+    previous = get_current()
+    _current.stats = stats
+    try:
+        yield stats
+    finally:
+        _current.stats = previous
+
+
+def bind_stats(func):
+    """
+        Wrap func to record into the stats of the calling thread, wherever
+        it runs, e.g. in a pool thread.
+    """
+    stats = get_current()
+    if stats is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        """Call func with the stats of the thread that wrapped it."""
+        with use_stats(stats):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def timed(stage):
+    """Record how long a with block takes as one run of stage."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(stage, time.time() - start)
+
+
+def add_time(stage, seconds):
+    """Record one run of a stage, if the thread has stats."""
+    stats = get_current()
+    if stats is not None:
+        stats.add_time(stage, seconds)
+
+
+def count(counter, amount=1):
+    """Add to a counter, if the thread has stats."""
+    stats = get_current()
+    if stats is not None:
+        stats.count(counter, amount)
+
+
+def _summarize(all_seconds):
+    return {'count': len(all_seconds), 'total': sum(all_seconds),
+            'min': min(all_seconds), 'max': max(all_seconds)}
+
+
+def _get_bucket(seconds):
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(BUCKETS)
+
+
+def _get_bucket_label(i):
+    return '%g' % BUCKETS[i] if i < len(BUCKETS) else '+Inf'
+
+
+def _get_percentile(buckets, fraction, largest):
+    """:returns: upper bound of the bucket the percentile falls in"""
+    total = sum(buckets)
+    if not total:
+        return None
+    seen = 0
+    for i, count_in_bucket in enumerate(buckets):
+        seen += count_in_bucket
+        if seen >= fraction * total:
+            return BUCKETS[i] if i < len(BUCKETS) else largest
+    return largest
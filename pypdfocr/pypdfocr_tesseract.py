@@ -19,14 +19,42 @@
    Run Tesseract to generate hocr file
 """
 
+import io
 import logging
 import os
 import subprocess
 import sys
 
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 from packaging import version
-from .pypdfocr_interrupts import init_worker
+from .pypdfocr_cpu import get_cpu_count, get_thread_env, use_cpus
+from .pypdfocr_interrupts import init_worker, map_in_shared_pool
+from .pypdfocr_stats import count, timed
+
+try:
+    import tesserocr
+    TESSEROCR_ENABLED = True
+except ImportError:
+    TESSEROCR_ENABLED = False
+
+# tesserocr only returns the ocr_page div, so wrap it the same way the
+# tesseract hocr renderer does
+HOCR_HEADER = u"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+  <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
+  <meta name='ocr-system' content='tesseract' />
+ </head>
+ <body>
+"""
+HOCR_FOOTER = u""" </body>
+</html>
+"""
 
 
 class TesseractException(Exception):
@@ -48,6 +76,42 @@ def unwrap_self(arg, **kwarg):
     return PyTesseract.make_hocr_from_pnm(*arg, **kwarg)
 
 
+class PyTessEngines(object):
+    """
+    Loaded tesseract engines (via tesserocr), kept around between pages and
+    documents so the language models are only loaded once.  An engine is
+    only used by one thread at a time; more engines get loaded as needed.
+    """
+    def __init__(self):
+        self.idle = {}
+        self.lock = Lock()
+
+    def acquire(self, lang):
+        """Return an idle engine for lang, loading a new one if needed."""
+        with self.lock:
+            engines = self.idle.setdefault(lang, [])
+            if engines:
+                return engines.pop()
+        logging.info("Loading tesseract engine for language %s", lang)
+        engine = tesserocr.PyTessBaseAPI(lang=lang,
+                                         psm=tesserocr.PSM.AUTO_OSD)
+        engine.SetVariable("hocr_font_info", "1")
+        return engine
+
+    def release(self, lang, engine):
+        """Put an engine back for reuse."""
+        with self.lock:
+            self.idle[lang].append(engine)
+
+    def close(self):
+        """Unload all the idle engines."""
+        with self.lock:
+            for engines in self.idle.values():
+                for engine in engines:
+                    engine.End()
+            self.idle = {}
+
+
 class PyTesseract(object):
     """Class to wrap all the tesseract calls"""
     def __init__(self, config):
@@ -60,8 +124,31 @@ class PyTesseract(object):
             self.required = "3.02"
         else:
             self.required = "3.02.02"
-        self.threads = config.get('threads', 4)
+        self.threads = config.get('threads', get_cpu_count())
+        # OpenMP threads of each tesseract run.  Several single-threaded
+        # pages at once use the cores better than one page on all of them.
+        self.omp_threads = int(config.get('omp_threads', 1))
         self._ts_version = None
+        # Long-lived thread pool shared with the other stages, if any
+        self.pool = None
+        # PyCpuBudget shared with the other stages, if any; each page being
+        # OCR'ed holds omp_threads of its tokens
+        self.budget = None
+        # Optional PyCache of hocr output, keyed by page image
+        self.cache = None
+        self.ocr_options = '-psm 1 -c hocr_font_info=1'
+
+        # Keep engines loaded instead of running tesseract for each page
+        self.engines = None
+        if config.get('persistent', False):
+            if TESSEROCR_ENABLED:
+                # OpenMP reads this once, when the first engine is loaded
+                os.environ.setdefault('OMP_THREAD_LIMIT',
+                                      str(self.omp_threads))
+                self.engines = PyTessEngines()
+            else:
+                logging.warning("Could not find tesserocr, so running a"
+                                " tesseract process for every page")
 
         if "binary" in config:  # Override location of binary
             binary = config['binary']
@@ -89,6 +176,14 @@ class PyTesseract(object):
             'TS_FAILED': 'Tesseract-OCR execution failed!',
         }
 
+    @property
+    def engine(self):
+        """What runs the OCR, for cache keys: "tesserocr" for the
+        persistent engines, otherwise the options of the tesseract binary"""
+        if self.engines is not None:
+            return 'tesserocr'
+        return self.ocr_options
+
     @property
     def ts_version(self):
         """Return the tesseract version string"""
@@ -99,6 +194,9 @@ class PyTesseract(object):
     def _get_ts_version(self):
         """Return the tesseract version string"""
         logging.info("Checking tesseract version")
+        if self.engines is not None:
+            ret_output = tesserocr.tesseract_version()
+            return ret_output.splitlines()[0].split(' ')[1]
         cmd = "%s -v" % self.binary
         logging.debug(cmd)
         try:
@@ -137,8 +235,17 @@ class PyTesseract(object):
         if not uptodate:
             error(self.msgs['TS_VERSION'] + " (found %s, required %s)" % (ver, self.required))
 
+        if self.pool is not None:
+            hocr_filenames = map_in_shared_pool(
+                self.pool, unwrap_self, list(zip([self]*len(fns), fns)))
+            return list(zip(fns, hocr_filenames))
+
         logging.debug("Making pool for tesseract")
-        pool = Pool(processes=self.threads, initializer=init_worker)
+        if self.engines is not None:
+            # The engines live in this process, so share them among threads
+            pool = ThreadPool(processes=self.threads)
+        else:
+            pool = Pool(processes=self.threads, initializer=init_worker)
 
         try:
             hocr_filenames = pool.map(unwrap_self,
@@ -167,13 +274,44 @@ class PyTesseract(object):
         if not os.path.exists(img_filename):
             error(self.msgs['TS_img_MISSING'] + " %s" % (img_filename))
 
+        key = None
+        if self.cache is not None:
+            key = self._get_cache_key(img_filename)
+            if self.cache.get(key, hocr_filename):
+                logging.info("Using cached OCR of %s for %s",
+                             img_filename, hocr_filename)
+                count('pages_ocr_cached')
+                return hocr_filename
+
         logging.info("Running OCR on %s to create %s",
                      img_filename, hocr_filename)
-        cmd = '%s "%s" "%s" -psm 1 -c hocr_font_info=1 -l %s hocr' % (
-            self.binary, img_filename, basename, self.lang)
+        with timed('tesseract'):
+            if self.engines is not None:
+                self._make_hocr_with_engine(img_filename, hocr_filename)
+            else:
+                self._make_hocr_with_binary(img_filename, basename,
+                                            hocr_filename)
+        count('pages_ocr')
+        if key is not None:
+            self.cache.put(key, hocr_filename)
+        return hocr_filename
+
+    def _get_cache_key(self, img_filename):
+        """Cache key for the OCR of a page image: the image contents, plus
+        everything else that changes the hocr tesseract makes from it."""
+        return self.cache.hash_file(img_filename, self.lang, self.ts_version,
+                                    self.engine)
+
+    def _make_hocr_with_binary(self, img_filename, basename, hocr_filename):
+        """Run OCR on single file with a tesseract process."""
+        cmd = '%s "%s" "%s" %s -l %s hocr' % (
+            self.binary, img_filename, basename, self.ocr_options, self.lang)
         logging.debug(cmd)
         try:
-            subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+            with use_cpus(self.budget, self.omp_threads) as threads:
+                subprocess.check_output(cmd, shell=True,
+                                        stderr=subprocess.STDOUT,
+                                        env=get_thread_env(threads))
         except subprocess.CalledProcessError as err:
             # Could not run tesseract
             logging.error(err.output)
@@ -183,3 +321,23 @@ class PyTesseract(object):
             logging.info("Created %s", hocr_filename)
             return hocr_filename
         error(self.msgs['TS_FAILED'])
+
+    def _make_hocr_with_engine(self, img_filename, hocr_filename):
+        """Run OCR on single file with one of the loaded engines."""
+        engine = self.engines.acquire(self.lang)
+        try:
+            with use_cpus(self.budget, self.omp_threads):
+                engine.SetImageFile(img_filename)
+                hocr = engine.GetHOCRText(0)
+        except RuntimeError as err:
+            logging.error(str(err))
+            error(self.msgs['TS_FAILED'])
+        finally:
+            self.engines.release(self.lang, engine)
+
+        with io.open(hocr_filename, 'w', encoding='utf-8') as f:
+            f.write(HOCR_HEADER)
+            f.write(hocr)
+            f.write(HOCR_FOOTER)
+        logging.info("Created %s", hocr_filename)
+        return hocr_filename
@@ -46,8 +46,8 @@ class PyPdfWatcher(FileSystemEventHandler):
         while True:
             logging.info("Sleeping for %d seconds", self.scan_interval)
             time.sleep(self.scan_interval)
-            newfile = self.check_queue()
-            if newfile:
+            # Hand out everything that is ready, not just one file per scan
+            for newfile in self.check_queue_all():
                 yield newfile
         self.observer.join()
 
@@ -140,10 +140,33 @@ class PyPdfWatcher(FileSystemEventHandler):
 
             :returns: Filename if available to process, otherwise None.
         """
+        ready_files = self._pop_ready_files(limit=1)
+        if ready_files:
+            return ready_files[0]
+        return None
+
+    def check_queue_all(self):
+        """
+            Like :func:`check_queue`, but returns every file that is ready
+            to process.
+
+            :returns: List of filenames (possibly empty).
+        """
+        return self._pop_ready_files()
+
+    def _pop_ready_files(self, limit=None):
+        """
+            Return up to limit files whose timestamp is older than the
+            scan_interval, marking each one with -1 for purging on the next
+            call.
+        """
         now = time.time()
+        ready_files = []
         self.events_lock.acquire()
         self.events = {file:ts for file, ts in self.events.items() if ts != -1}
-        for monitored_file, timestamp in self.events.items():
+        for monitored_file, timestamp in list(self.events.items()):
+            if limit is not None and len(ready_files) >= limit:
+                break
             if now - timestamp > self.scan_interval:
                 logging.info("Processing new file %s", monitored_file)
                 # Remove this file from the dict
@@ -151,7 +174,6 @@ class PyPdfWatcher(FileSystemEventHandler):
                 monitored_file = self.rename_file_with_spaces(monitored_file)
                 # Add back into queue and mark as not needing further action in the event handler
                 self.events[monitored_file] = -1
-                self.events_lock.release()
-                return monitored_file
+                ready_files.append(monitored_file)
         self.events_lock.release()
-        return None
+        return ready_files
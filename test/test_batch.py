@@ -0,0 +1,81 @@
+import io
+import json
+import os
+
+import pytest
+
+from pypdfocr.pypdfocr_batch import PyBatch
+
+
+@pytest.fixture
+def scans(tmpdir):
+    """A directory tree of pdfs, and the output of an earlier conversion."""
+    for name in ['a.pdf', 'b.PDF', 'a_ocr.pdf', 'notes.txt',
+                 os.path.join('sub', 'c.pdf'), os.path.join('sub', 'd.pdf')]:
+        tmpdir.join('scans', name).write(name, ensure=True)
+    return tmpdir.join('scans')
+
+
+class TestBatch:
+
+    def test_directory(self, scans):
+        batch = PyBatch([str(scans)])
+        assert list(batch.iter_pdfs()) == [
+            str(scans.join(name))
+            for name in ['a.pdf', 'b.PDF', 'sub/c.pdf', 'sub/d.pdf']]
+
+    def test_glob(self, scans):
+        batch = PyBatch([str(scans.join('sub', '*.pdf')),
+                         str(scans.join('*_ocr.pdf'))])
+        assert list(batch.iter_pdfs()) == [
+            str(scans.join('sub', 'c.pdf')), str(scans.join('sub', 'd.pdf'))]
+
+    def test_once_each(self, scans, monkeypatch, caplog):
+        monkeypatch.chdir(str(scans))
+        batch = PyBatch(['a.pdf', str(scans.join('a.pdf')), 'sub',
+                         'sub/c.pdf', 'missing.pdf'])
+        assert list(batch.iter_pdfs()) == [
+            str(scans.join('a.pdf')), str(scans.join('sub', 'c.pdf')),
+            str(scans.join('sub', 'd.pdf'))]
+        assert "Could not find missing.pdf" in caplog.text
+
+    def test_file_list(self, tmpdir):
+        file_list = tmpdir.join('list.txt')
+        file_list.write("a.pdf\n  \n b.pdf \n")
+        assert PyBatch.read_file_list(str(file_list)) == ['a.pdf', 'b.pdf']
+
+    def test_up_to_date(self, scans):
+        """A pdf is up to date if its _ocr.pdf is newer than it."""
+        batch = PyBatch([str(scans)])
+        a_pdf = str(scans.join('a.pdf'))
+        os.utime(a_pdf, (1000, 1000))
+        assert batch.is_up_to_date(a_pdf) == str(scans.join('a_ocr.pdf'))
+        os.utime(a_pdf, None)
+        os.utime(str(scans.join('a_ocr.pdf')), (1000, 1000))
+        assert batch.is_up_to_date(a_pdf) is None
+        assert batch.is_up_to_date(str(scans.join('b.PDF'))) is None
+
+    def test_manifest(self, scans, tmpdir):
+        """The manifest records each pdf, and a pdf converted in an earlier
+        run is up to date until it changes."""
+        manifest = str(tmpdir.join('manifest.jsonl'))
+        c_pdf = str(scans.join('sub', 'c.pdf'))
+        output = str(tmpdir.join('c_ocr.pdf'))
+        tmpdir.join('c_ocr.pdf').write('')
+        with PyBatch([str(scans)], manifest) as batch:
+            batch.record(c_pdf, 'converted', output, seconds=1.5)
+            batch.record(str(scans.join('b.PDF')), 'failed', error='Boom')
+        with io.open(manifest) as f:
+            lines = [json.loads(line) for line in f]
+        assert [line['status'] for line in lines] == ['converted', 'failed']
+        assert lines[0]['seconds'] == 1.5
+        assert lines[1]['error'] == 'Boom'
+
+        with io.open(manifest, 'a') as f:
+            f.write(u'{"pdf": "half a line')
+        batch = PyBatch([str(scans)], manifest)
+        assert batch.is_up_to_date(c_pdf) == output
+        assert batch.is_up_to_date(str(scans.join('b.PDF'))) is None
+        scans.join('sub', 'c.pdf').write('changed')
+        assert batch.is_up_to_date(c_pdf) is None
+        batch.close()
@@ -0,0 +1,62 @@
+import pytest
+from PIL import Image, ImageDraw
+
+from pypdfocr.pypdfocr_blank import PyBlankDetector
+
+
+@pytest.fixture
+def detector():
+    return PyBlankDetector({})
+
+
+def make_page(tmpdir, name, draw=None, mode='L', paper=245):
+    """Write a letter-size page image at 100dpi, drawing on it with draw."""
+    img = Image.new(mode, (850, 1100), paper)
+    if draw is not None:
+        draw(ImageDraw.Draw(img))
+    filename = str(tmpdir.join(name))
+    img.save(filename)
+    return filename
+
+
+def test_config(detector):
+    assert detector.enabled
+    assert not detector.drop
+    detector = PyBlankDetector({'max_ink': '0.01', 'drop': True})
+    assert detector.max_ink == 0.01
+    assert detector.drop
+
+
+def test_blank(detector, tmpdir):
+    assert detector.is_blank(make_page(tmpdir, 'blank.jpg'))
+
+
+def test_text(detector, tmpdir):
+    def text(draw):
+        for y in range(200, 500, 30):
+            draw.text((100, y), "The quick brown fox jumps over the lazy dog",
+                      fill=0)
+    filename = make_page(tmpdir, 'text.jpg', text)
+    assert detector.get_ink_coverage(filename) > detector.max_ink
+    assert not detector.is_blank(filename)
+
+
+def test_specks_and_show_through(detector, tmpdir):
+    """Dust, show-through from the back and punch holes in the margin
+    don't make a page not blank."""
+    def noise(draw):
+        for x, y in [(200, 300), (500, 700), (650, 150)]:
+            draw.point((x, y), fill=0)
+        draw.rectangle((100, 400, 700, 420), fill=200)
+        draw.ellipse((10, 500, 35, 525), fill=0)
+    assert detector.is_blank(make_page(tmpdir, 'noise.png', noise))
+
+
+def test_mono(detector, tmpdir):
+    """Pages rendered as 1-bit images work too."""
+    def line(draw):
+        draw.rectangle((100, 100, 700, 200), fill=0)
+    assert detector.is_blank(make_page(tmpdir, 'blank.png', mode='1',
+                                       paper=1))
+    assert not detector.is_blank(make_page(tmpdir, 'line.png', line,
+                                           mode='1', paper=1))
@@ -0,0 +1,79 @@
+import os
+import time
+
+import pytest
+
+from pypdfocr.pypdfocr_cache import PyCache
+
+
+@pytest.fixture
+def cache_dir(tmpdir):
+    return str(tmpdir.join('cache'))
+
+
+def make_file(tmpdir, name, contents):
+    tmpdir.join(name).write(contents)
+    return str(tmpdir.join(name))
+
+
+def test_hash_file(tmpdir):
+    a = make_file(tmpdir, 'a.jpg', 'page')
+    b = make_file(tmpdir, 'b.jpg', 'page')
+    assert PyCache.hash_file(a, 'eng') == PyCache.hash_file(b, 'eng')
+    assert PyCache.hash_file(a, 'eng') != PyCache.hash_file(a, 'deu')
+    assert PyCache.hash_file(a) != PyCache.hash_file(
+        make_file(tmpdir, 'c.jpg', 'other page'))
+
+
+def test_get_put(tmpdir, cache_dir):
+    cache = PyCache(cache_dir, 1000, '.hocr')
+    out = str(tmpdir.join('out.hocr'))
+    assert not cache.get('abc', out)
+    cache.put('abc', make_file(tmpdir, 'in.hocr', 'hocr text'))
+    assert cache.get('abc', out)
+    assert tmpdir.join('out.hocr').read() == 'hocr text'
+    assert os.listdir(cache_dir) == ['abc.hocr']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'],
+            stats['size']) == (1, 1, 1, 9)
+    assert stats['hit_rate'] == 0.5
+
+
+def test_lru_eviction(tmpdir, cache_dir):
+    """The least recently used entries go once the cache is too big."""
+    cache = PyCache(cache_dir, 25)
+    out = str(tmpdir.join('out'))
+    for key in ['a', 'b']:
+        cache.put(key, make_file(tmpdir, key, '0123456789'))
+    assert cache.get('a', out)
+    cache.put('c', make_file(tmpdir, 'c', '0123456789'))
+    assert sorted(os.listdir(cache_dir)) == ['a', 'c']
+    assert cache.stats()['evictions'] == 1
+    assert cache.size == 20
+    # Too big to ever fit
+    cache.put('d', make_file(tmpdir, 'd', 'x' * 30))
+    assert not cache.get('d', out)
+
+
+def test_reload(tmpdir, cache_dir):
+    """The cache contents and their order survive a restart."""
+    cache = PyCache(cache_dir, 25)
+    cache.put('old', make_file(tmpdir, 'old', '0123456789'))
+    old_time = time.time() - 100
+    os.utime(os.path.join(cache_dir, 'old'), (old_time, old_time))
+    cache.put('new', make_file(tmpdir, 'new', '0123456789'))
+
+    cache = PyCache(cache_dir, 25)
+    assert list(cache.entries) == ['old', 'new']
+    assert cache.size == 20
+    cache.put('newer', make_file(tmpdir, 'newer', '0123456789'))
+    assert sorted(os.listdir(cache_dir)) == ['new', 'newer']
+
+
+def test_missing_entry(tmpdir, cache_dir):
+    """An entry deleted behind the cache's back is a miss."""
+    cache = PyCache(cache_dir, 100)
+    cache.put('a', make_file(tmpdir, 'a', 'data'))
+    os.remove(os.path.join(cache_dir, 'a'))
+    assert not cache.get('a', str(tmpdir.join('out')))
+    assert cache.size == 0
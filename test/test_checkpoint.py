@@ -0,0 +1,59 @@
+import io
+import os
+
+import pytest
+
+from pypdfocr.pypdfocr_checkpoint import PyCheckpoint
+
+
+@pytest.fixture
+def pdf_filename(tmpdir):
+    tmpdir.join('scan.pdf').write('scan')
+    return str(tmpdir.join('scan.pdf'))
+
+
+class TestCheckpoint:
+
+    def test_resume(self, tmpdir, pdf_filename):
+        """The same pdf and settings find the pages recorded before."""
+        root = str(tmpdir.join('checkpoints'))
+        checkpoint = PyCheckpoint(root, pdf_filename, 'eng')
+        path = tmpdir.join('checkpoints', os.path.basename(checkpoint.path))
+        assert checkpoint.path == str(path)
+        assert path.basename.startswith('scan_')
+        for page_num in (1, 2):
+            img_filename = path.join('scan_%d.jpg' % page_num)
+            img_filename.write('')
+            checkpoint.set_page(page_num, 'image', str(img_filename))
+        path.join('scan_1.hocr').write('')
+        checkpoint.set_page(1, 'hocr', 'scan_1.hocr')
+        checkpoint.close()
+        # A line half written when the conversion was killed
+        with io.open(str(path.join('checkpoint.jsonl')), 'a') as f:
+            f.write(u'{"page": 2, "st')
+
+        resumed = PyCheckpoint(root, pdf_filename, 'eng')
+        assert resumed.path == checkpoint.path
+        assert resumed.get_pages('image') == {
+            1: str(path.join('scan_1.jpg')),
+            2: str(path.join('scan_2.jpg'))}
+        assert resumed.get_page(1, 'hocr') == \
+            str(path.join('scan_1.hocr'))
+        assert resumed.get_page(2, 'hocr') is None
+
+        # Pages whose files are gone have to be done again
+        path.join('scan_2.jpg').remove()
+        assert list(resumed.get_pages('image')) == [1]
+        resumed.cleanup()
+        assert not path.check()
+
+    def test_settings(self, tmpdir, pdf_filename):
+        """Other settings or a changed pdf start a new checkpoint."""
+        root = str(tmpdir.join('checkpoints'))
+        checkpoints = [PyCheckpoint(root, pdf_filename, 'eng'),
+                       PyCheckpoint(root, pdf_filename, 'deu')]
+        tmpdir.join('scan.pdf').write('other scan')
+        checkpoints.append(PyCheckpoint(root, pdf_filename, 'eng'))
+        assert len(set(checkpoint.path for checkpoint in checkpoints)) == 3
+        for checkpoint in checkpoints:
+            checkpoint.cleanup()
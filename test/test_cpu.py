@@ -0,0 +1,99 @@
+import threading
+import time
+
+import mock
+import pytest
+
+from pypdfocr import pypdfocr_cpu
+from pypdfocr.pypdfocr_cpu import PyCpuBudget, use_cpus
+
+
+@pytest.fixture
+def cgroup(tmpdir):
+    return tmpdir.mkdir('cgroup')
+
+
+class TestCpuCount:
+
+    def test_no_cgroup(self, tmpdir):
+        assert pypdfocr_cpu.get_cgroup_quota(str(tmpdir)) is None
+        assert pypdfocr_cpu.get_cpu_count(str(tmpdir)) >= 1
+
+    @pytest.mark.parametrize(("cpu_max", "quota"), [
+        ("max 100000\n", None),
+        ("150000 100000\n", 1.5),
+        ("50000 100000\n", 0.5),
+        ])
+    def test_cgroup_v2(self, cgroup, cpu_max, quota):
+        cgroup.join('cpu.max').write(cpu_max)
+        assert pypdfocr_cpu.get_cgroup_quota(str(cgroup)) == quota
+
+    @pytest.mark.parametrize(("cfs_quota", "quota"), [
+        ("-1\n", None),
+        ("200000\n", 2.0),
+        ])
+    def test_cgroup_v1(self, cgroup, cfs_quota, quota):
+        cgroup.mkdir('cpu')
+        cgroup.join('cpu', 'cpu.cfs_quota_us').write(cfs_quota)
+        cgroup.join('cpu', 'cpu.cfs_period_us').write("100000\n")
+        assert pypdfocr_cpu.get_cgroup_quota(str(cgroup)) == quota
+
+    def test_quota_limits_count(self, monkeypatch, cgroup):
+        """A fractional quota rounds up, as it still gets that many CPUs
+        some of the time."""
+        monkeypatch.setattr('multiprocessing.cpu_count',
+                            mock.Mock(return_value=16))
+        monkeypatch.setattr('os.sched_getaffinity',
+                            mock.Mock(return_value=set(range(8))),
+                            raising=False)
+        assert pypdfocr_cpu.get_cpu_count(str(cgroup)) == 8
+        cgroup.join('cpu.max').write("250000 100000\n")
+        assert pypdfocr_cpu.get_cpu_count(str(cgroup)) == 3
+        cgroup.join('cpu.max').write("10000 100000\n")
+        assert pypdfocr_cpu.get_cpu_count(str(cgroup)) == 1
+
+
+class TestCpuBudget:
+
+    def test_acquire_release(self):
+        budget = PyCpuBudget(4)
+        assert budget.acquire(3) == 3
+        assert budget.free == 1
+        budget.release(3)
+        assert budget.free == 4
+
+    def test_clamp(self):
+        """Asking for more than the whole budget takes all of it, instead
+        of waiting forever."""
+        budget = PyCpuBudget(2)
+        with budget.use(8) as count:
+            assert count == 2
+            assert budget.free == 0
+        assert budget.free == 2
+
+    def test_wait(self):
+        """A run waits until enough tokens are given back."""
+        budget = PyCpuBudget(2)
+        budget.acquire(2)
+        acquired = []
+
+        def worker():
+            with use_cpus(budget) as count:
+                acquired.append(count)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.1)
+        assert acquired == []
+        budget.release(2)
+        thread.join(5)
+        assert acquired == [1]
+        assert budget.free == 2
+
+    def test_no_budget(self):
+        with use_cpus(None, 3) as count:
+            assert count == 3
+
+    def test_thread_env(self):
+        env = pypdfocr_cpu.get_thread_env(2)
+        assert env['OMP_THREAD_LIMIT'] == '2'
+        assert env['MAGICK_THREAD_LIMIT'] == '2'
@@ -1,3 +1,4 @@
+import io
 import os
 import pytest
 import shutil
@@ -7,6 +8,9 @@ from pypdfocr import pypdfocr_gs as P
 from pypdfocr import pypdfocr_gs
 
 import mock
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen.canvas import Canvas
 
 
 @pytest.mark.skipif(os.name != 'nt', reason="Not on NT")
@@ -78,53 +82,101 @@ class TestGS:
             pygs.make_img_from_pdf("missing123.pdf")
         assert pygs.msgs['GS_MISSING_PDF'] in caplog.text
 
-    def test_get_dpi_pdf_missing(self, pygs):
+    def test_render_settings_pdf_missing(self, pygs):
         with pytest.raises(SystemExit):
-            pygs._get_dpi("/foo/bar.pdf")
+            pygs._get_render_settings("/foo/bar.pdf")
 
-    def test_get_dpi_fail(self, pygs, asset_dir, monkeypatch, caplog):
-        monkeypatch.setattr(
-            'subprocess.check_output',
-            mock.Mock(side_effect=subprocess.CalledProcessError(
-                returncode=2, cmd=['bad'])))
-        pygs._get_dpi(os.path.join(asset_dir, "test_recipe.pdf"))
-        assert "not execute" in caplog.text
-
-    def test_imagemagick_failed(self, pygs, asset_dir, monkeypatch, caplog):
-        """Test default DPI is used if imagemagick failes to run."""
-        monkeypatch.setattr(
-            'subprocess.check_output',
-            mock.Mock(side_effect=[
-                "_\n_\n_ _ image 5 5 gray",
-                subprocess.CalledProcessError(returncode=2, cmd=['bad'])]))
-        pygs._get_dpi(os.path.join(asset_dir, "test_recipe.pdf"))
-        assert "try installing imagemagick" in caplog.text
-        assert pygs.output_dpi == 300
+    def test_render_settings_fail(self, pygs, asset_dir, caplog):
+        assert pygs._get_render_settings(
+            os.path.join(asset_dir, "sample.jpg")) is None
+        assert "Could not read the images" in caplog.text
 
     def test_empty_pdf(self, pygs, asset_dir, caplog):
-        pygs._get_dpi(os.path.join(asset_dir, "blank.pdf"))
-        assert "Empty pdf" in caplog.text
-
-    def test_pdfimages_malformed_output(
-            self, pygs, asset_dir, monkeypatch, caplog):
-        """This isn't a good test - should make a better one"""
-        monkeypatch.setattr("subprocess.check_output",
-                            mock.Mock(return_value="0\n1\n2 3 None"))
-        # 1 0 image 1692 2194 icc 1 8 jpeg no 8 0 200 201 228K 6.3%
-        pygs._get_dpi(os.path.join(asset_dir, "test_recipe.pdf"))
-        assert "Could not understand" in caplog.text
-
-    def test_function_hi_dpi(self, pygs, asset_dir, caplog):
-        pygs._get_dpi(os.path.join(asset_dir, "test_sherlock.pdf"))
-        assert pygs.output_dpi == 400
-
-    def test_function_low_dpi(self, pygs, asset_dir, caplog):
-        pygs._get_dpi(os.path.join(asset_dir, "test_patent.pdf"))
-        assert pygs.output_dpi == 300
-
-    def test_functional_mismatched_dpi(self, pygs, asset_dir, caplog):
-        pygs._get_dpi(os.path.join(asset_dir, "test.pdf"))
-        assert pygs.output_dpi == 300
+        assert pygs._get_render_settings(
+            os.path.join(asset_dir, "blank.pdf")) == [('jpggrey', 300)]
+        assert "No images found" in caplog.text
+
+    def test_page_settings(self, pygs, asset_dir):
+        """Each page gets the resolution and colour of its own image."""
+        assert pygs._get_page_settings(
+            os.path.join(asset_dir, "test_patent.pdf")) == \
+            [(200, 'colour', 'image'), (400, 'mono', 'image')]
+        assert pygs._get_page_settings(
+            os.path.join(asset_dir, "test_recipe.pdf")) == \
+            [(200, 'grey', 'image')]
+        assert pygs._get_page_settings(
+            os.path.join(asset_dir, "1.pdf")) == [(200, 'grey', 'image')]
+        assert pygs._get_page_settings(
+            os.path.join(asset_dir, "blank.pdf")) == [(None, None, None)]
+
+    def test_text_pages(self, pygs, tmpdir):
+        """Pages that already have text are classified and skipped."""
+        pdf_filename = str(tmpdir.join('digital.pdf'))
+        canvas = Canvas(pdf_filename)
+        canvas.drawString(100, 100, "Born digital")
+        canvas.showPage()
+        canvas.drawImage(ImageReader(Image.new('L', (200, 200))), 0, 0,
+                         width=72, height=72)
+        canvas.showPage()
+        canvas.drawImage(ImageReader(Image.new('L', (200, 200))), 0, 0,
+                         width=72, height=72)
+        canvas.drawString(100, 100, "Header")
+        canvas.showPage()
+        canvas.save()
+        assert [page_type for _, _, page_type in
+                pygs._get_page_settings(pdf_filename)] == \
+            ['text', 'image', 'mixed']
+        assert pygs._get_render_settings(pdf_filename) == \
+            [None, ('jpggrey', 300), None]
+        pygs.skip_text_pages = False
+        assert pygs._get_render_settings(pdf_filename) == \
+            [('jpggrey', 300)] * 3
+
+    def test_image_colour(self, pygs):
+        from PyPDF2.generic import (ArrayObject, DictionaryObject,
+                                    NameObject, NumberObject)
+        def image(colour_space, bits=8):
+            return DictionaryObject({
+                NameObject('/ColorSpace'): colour_space,
+                NameObject('/BitsPerComponent'): NumberObject(bits)})
+        assert pygs._get_image_colour(
+            image(NameObject('/DeviceGray'), 1)) == 'mono'
+        assert pygs._get_image_colour(
+            image(NameObject('/DeviceGray'))) == 'grey'
+        assert pygs._get_image_colour(
+            image(NameObject('/DeviceCMYK'))) == 'colour'
+        assert pygs._get_image_colour(image(ArrayObject(
+            [NameObject('/Indexed'), NameObject('/DeviceGray'),
+             NumberObject(255), NameObject('/Lookup')]))) == 'grey'
+
+    def test_function_hi_dpi(self, pygs, asset_dir):
+        assert pygs._get_render_settings(
+            os.path.join(asset_dir, "test_sherlock.pdf")) == \
+            [('pnggrey', 400), ('pnggrey', 400)]
+
+    def test_function_low_dpi(self, pygs, asset_dir):
+        assert pygs._get_render_settings(
+            os.path.join(asset_dir, "test_recipe.pdf")) == [('jpggrey', 300)]
+
+    def test_function_mixed_pages(self, pygs, asset_dir):
+        """Each page gets its own device and dpi."""
+        assert pygs._get_render_settings(
+            os.path.join(asset_dir, "test_patent.pdf")) == \
+            [('jpg', 300), ('pnggrey', 400)]
+
+    def test_functional_rotated_dpi(self, pygs, asset_dir, caplog):
+        """A landscape page with a landscape image isn't a mismatch."""
+        assert pygs._get_render_settings(
+            os.path.join(asset_dir, "test.pdf")) == [('jpg', 300)] * 2
+        assert "mismatch" not in caplog.text
+
+    def test_mismatched_dpi(self, pygs, caplog):
+        page = mock.MagicMock()
+        page.mediaBox.getWidth.return_value = 612
+        page.mediaBox.getHeight.return_value = 792
+        pygs._iter_images = mock.Mock(
+            return_value=iter([(1700, 3300, 'grey')]))
+        assert pygs._get_page_setting(page, 1) == (300, 'grey')
         assert "mismatch" in caplog.text
 
     def test_run_gs_error(self, pygs, caplog, monkeypatch):
@@ -148,12 +200,14 @@ class TestGS:
 
     def test_functional_make_img(self, pygs, asset_dir):
         out = pygs.make_img_from_pdf(os.path.join(asset_dir, "test.pdf"))
-        assert out == (300, os.path.join(asset_dir, "test_*.jpg"))
+        assert out == (300, [os.path.join(asset_dir, "test_1.jpg"),
+                             os.path.join(asset_dir, "test_2.jpg")])
 
     def test_functional_greyscale(self, pygs, asset_dir):
         out = pygs.make_img_from_pdf(
             os.path.join(asset_dir, "test_sherlock.pdf"))
-        assert out[1] == os.path.join(asset_dir, "test_sherlock_*.jpg")
+        assert out[1] == [os.path.join(asset_dir, "test_sherlock_1.png"),
+                          os.path.join(asset_dir, "test_sherlock_2.png")]
 
     def test_existing_img(self, pygs, asset_dir):
         """Existing jpg files in folder should be removed."""
@@ -161,7 +215,183 @@ class TestGS:
             with open(os.path.join(asset_dir, fname), 'w') as f:
                 f.write("")
         out = pygs.make_img_from_pdf(os.path.join(asset_dir, "test.pdf"))
-        assert out == (300, os.path.join(asset_dir, "test_*.jpg"))
+        assert out[0] == 300
         with open(os.path.join(asset_dir, "test_1.jpg"), 'rb') as f:
             assert f.read()
         assert not os.path.exists(os.path.join(asset_dir, "test_A.jpg"))
+
+    def test_iter_gs_pages(self, pygs):
+        """Each page is handed out once gs reports the next page."""
+        proc = mock.Mock()
+        proc.stdout = io.StringIO(
+            u"Processing pages 1 through 3.\nPage 1\nPage 2\nPage 3\n")
+        proc.wait.return_value = 0
+        pages = pygs._iter_gs_pages(proc, "out_%d.jpg")
+        assert next(pages) == "out_1.jpg"
+        assert next(pages) == "out_2.jpg"
+        assert list(pages) == ["out_3.jpg"]
+
+    def test_iter_gs_pages_stopped(self, pygs):
+        """gs is killed if the pages stop being taken before it is done."""
+        proc = mock.Mock()
+        proc.stdout = io.StringIO(u"Page 1\nPage 2\nPage 3\n")
+        proc.poll.return_value = None
+        pages = pygs._iter_gs_pages(proc, "out_%d.jpg")
+        assert next(pages) == "out_1.jpg"
+        pages.close()
+        proc.kill.assert_called_once_with()
+        assert proc.wait.called
+
+    def test_iter_gs_pages_error(self, pygs, caplog):
+        proc = mock.Mock()
+        proc.stdout = io.StringIO(u"Page 1\nundefined in .getdeviceparams\n")
+        proc.wait.return_value = 1
+        with pytest.raises(SystemExit):
+            list(pygs._iter_gs_pages(proc, "out_%d.jpg"))
+        assert 'out of date' in caplog.text
+
+    def test_page_ranges(self, asset_dir):
+        pygs = P.PyGs({'threads': 2})
+        assert pygs._get_page_ranges(
+            os.path.join(asset_dir, "test_patent.pdf")) == [(1, 1), (2, 2)]
+        pygs.threads = 4
+        assert pygs._get_page_ranges(
+            os.path.join(asset_dir, "test_recipe.pdf")) == [(1, 1)]
+        assert pygs._get_page_ranges(
+            os.path.join(asset_dir, "sample.jpg")) is None
+
+    def test_parallel_render(self, tmpdir, monkeypatch):
+        """Page ranges are rendered separately and renamed to page numbers."""
+        pygs = P.PyGs({'threads': 2, 'parallel': True})
+        monkeypatch.setattr(pygs, '_get_render_settings',
+                            mock.Mock(return_value=[('jpg', 300)] * 3))
+        monkeypatch.setattr(pygs, '_get_page_ranges',
+                            mock.Mock(return_value=[(1, 2), (3, 3)]))
+
+        def run_gs(options, output_filename, pdf_filename):
+            first = int(options.split('-dFirstPage=')[1].split()[0])
+            last = int(options.split('-dLastPage=')[1].split()[0])
+            for i in range(last - first + 1):
+                tmpdir.join(os.path.basename(output_filename % (i + 1))).write('')
+        monkeypatch.setattr(pygs, '_run_gs', run_gs)
+
+        pdf_filename = str(tmpdir.join('doc.pdf'))
+        out = pygs.make_img_from_pdf(pdf_filename)
+        assert out == (300, [str(tmpdir.join('doc_%d.jpg' % i))
+                             for i in (1, 2, 3)])
+        assert sorted(os.listdir(str(tmpdir))) == \
+            ['doc_1.jpg', 'doc_2.jpg', 'doc_3.jpg']
+
+    def test_all_text_pages(self, pygs, monkeypatch):
+        monkeypatch.setattr(pygs, '_get_render_settings',
+                            mock.Mock(return_value=[None, None]))
+        assert pygs.make_img_from_pdf('doc.pdf') == (300, [])
+        dpi, pages = pygs.iter_img_from_pdf('doc.pdf')
+        assert list(pages) == []
+
+    def test_unreadable_pdf(self, pygs, tmpdir, monkeypatch):
+        """A pdf whose pages can't be read is rendered whole, with the
+        default settings."""
+        monkeypatch.setattr(pygs, '_get_render_settings',
+                            mock.Mock(return_value=None))
+        dpi, jobs = pygs._prepare_img_output(str(tmpdir.join('doc.pdf')))
+        assert dpi == pygs.output_dpi
+        assert jobs == [(None, None,
+                         ' '.join(pygs.gs_options[pygs.default_format][1])
+                         % {'dpi': pygs.output_dpi},
+                         str(tmpdir.join('doc_%d.'))
+                         + pygs.gs_options[pygs.default_format][0])]
+
+    def test_output_dir(self, pygs, tmpdir, monkeypatch):
+        """Images can go to a scratch directory instead of next to the pdf."""
+        monkeypatch.setattr(pygs, '_get_render_settings',
+                            mock.Mock(return_value=[('jpg', 300)]))
+        tmpdir.mkdir('scratch')
+        dpi, jobs = pygs._prepare_img_output('/share/scans/doc.pdf',
+                                             str(tmpdir.join('scratch')))
+        assert jobs[0][3] == str(tmpdir.join('scratch', 'doc_%d.jpg'))
+
+    def test_skip_pages(self, pygs, tmpdir, monkeypatch):
+        """Pages left from an earlier run are neither rendered nor deleted.
+        """
+        monkeypatch.setattr(pygs, '_get_render_settings', mock.Mock(
+            return_value=[('jpg', 300), ('jpg', 300), ('jpg', 300)]))
+        for page_num in (1, 2, 3):
+            tmpdir.join('doc_%d.jpg' % page_num).write('')
+        dpi, jobs = pygs._prepare_img_output(str(tmpdir.join('doc.pdf')),
+                                             skip_pages={1: 'doc_1.jpg'})
+        assert [job[:2] for job in jobs] == [(2, 3)]
+        assert tmpdir.listdir() == [tmpdir.join('doc_1.jpg')]
+
+    def test_group_skipped_pages(self):
+        settings = [('jpg', 300), None, ('jpg', 300), ('jpg', 300)]
+        assert P.PyGs._group_pages(settings) == [
+            (1, 1, 'jpg', 300), (3, 4, 'jpg', 300)]
+
+    def test_group_pages(self):
+        settings = [('jpg', 300), ('jpg', 300), ('pnggrey', 400),
+                    ('pnggrey', 400), ('jpg', 300)]
+        assert P.PyGs._group_pages(settings) == [
+            (1, 2, 'jpg', 300), (3, 4, 'pnggrey', 400), (5, 5, 'jpg', 300)]
+        assert P.PyGs._group_pages(settings, [(1, 3), (4, 5)]) == [
+            (1, 2, 'jpg', 300), (3, 3, 'pnggrey', 400),
+            (4, 4, 'pnggrey', 400), (5, 5, 'jpg', 300)]
+
+    def test_mixed_render(self, tmpdir, monkeypatch):
+        """Pages with different settings get their own gs runs and devices."""
+        pygs = P.PyGs({})
+        monkeypatch.setattr(pygs, '_get_render_settings', mock.Mock(
+            return_value=[('jpg', 300), ('pnggrey', 400), ('pnggrey', 400)]))
+        runs = []
+
+        def run_gs(options, output_filename, pdf_filename):
+            runs.append(options)
+            first = int(options.split('-dFirstPage=')[1].split()[0])
+            last = int(options.split('-dLastPage=')[1].split()[0])
+            for i in range(last - first + 1):
+                tmpdir.join(os.path.basename(output_filename % (i + 1))).write('')
+        monkeypatch.setattr(pygs, '_run_gs', run_gs)
+
+        dpi, pages = pygs.iter_img_from_pdf(str(tmpdir.join('doc.pdf')))
+        assert dpi == 400
+        assert list(pages) == [str(tmpdir.join('doc_1.jpg')),
+                               str(tmpdir.join('doc_2.png')),
+                               str(tmpdir.join('doc_3.png'))]
+        assert runs == [
+            '-sDEVICE=jpeg -dJPEGQ=75 -r300 -dFirstPage=1 -dLastPage=1',
+            '-sDEVICE=pngmono -r400 -dFirstPage=2 -dLastPage=3']
+
+    def test_adaptive_dpi(self, tmpdir, monkeypatch):
+        """Pages with large text are rendered at a lower dpi, within the
+        floor and the dpi the page would get anyway."""
+        pygs = P.PyGs({'adaptive_dpi': True, 'min_dpi': 150})
+        recipe = os.path.join(os.path.dirname(__file__), 'pdfs',
+                              'test_recipe.pdf')
+        with open(recipe, 'rb') as f:
+            page = P.PdfFileReader(f).getPage(0)
+            data = page['/Resources']['/XObject']['/Im1'].getObject()._data
+        # The scan is at about 200dpi
+        scan = Image.open(io.BytesIO(data))
+        width, height = scan.size
+        probes = [scan.resize((width//2, height//2)),  # as rendered at 100dpi
+                  scan,
+                  scan,  # twice the size, so big text
+                  Image.new('L', (width//2, height//2), 255)]
+        monkeypatch.setattr(pygs, '_get_render_settings', mock.Mock(
+            return_value=[('jpggrey', 300), None, ('jpggrey', 600),
+                          ('pnggrey', 300)]))
+
+        def run_gs(options, output_filename, pdf_filename):
+            assert options == '-sDEVICE=pnggray -r100'
+            for page_num, probe in enumerate(probes, 1):
+                probe.save(output_filename % page_num)
+        monkeypatch.setattr(pygs, '_run_gs', run_gs)
+
+        settings = pygs._adapt_render_dpi(str(tmpdir.join('doc.pdf')),
+                                          pygs._get_render_settings(),
+                                          str(tmpdir))
+        # Body text of about 11pt needs 300dpi, twice that size 150dpi, and
+        # a page without text keeps its setting
+        assert settings == [('jpggrey', 300), None, ('jpggrey', 150),
+                            ('pnggrey', 300)]
+        assert tmpdir.listdir() == []
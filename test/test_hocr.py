@@ -0,0 +1,59 @@
+import io
+
+from pypdfocr import pypdfocr_hocr
+
+
+HOCR = u"""<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <body>
+  <div class='ocr_page' id='page_1' title='bbox 0 0 600 800; ppageno 0'>
+   <div class='ocr_carea' id='block_1_1' title="bbox 10 10 300 60">
+    <span class='ocr_line' id='line_1_1' title="bbox 10 10 300 30; baseline 0.01 -3">
+     <span class='ocrx_word' id='word_1_1' title='bbox 10 10 90 30; x_wconf 95; x_font Times; x_fsize 12'>Hello</span>
+     <span class='ocrx_word' id='word_1_2' title='bbox 100 10 190 30; x_wconf 93'><strong>world</strong></span>
+     <span class='ocrx_word' id='word_1_3' title='bbox 200 10 210 30; x_wconf 10'> </span>
+    </span>
+    <span class='ocr_header' id='line_1_2' title="bbox 10 40 300 60; textangle 90">
+     <span class='ocrx_word' id='word_1_4' title='bbox 10 40 90 60'>Title</span>
+    </span>
+   </div>
+  </div>
+  <div class='ocr_page' id='page_2' title='bbox 0 0 600 800; ppageno 1'>
+   <span class='ocr_line' id='line_2_1' title="bbox 10 10 300 30">
+    <span class='ocrx_word' id='word_2_1' title='bbox 10 10 90 30'>Again</span>
+   </span>
+  </div>
+ </body>
+</html>
+"""
+
+
+def words():
+    return list(pypdfocr_hocr.iter_hocr_words(
+        io.BytesIO(HOCR.encode('utf-8'))))
+
+
+def test_words():
+    result = words()
+    assert [(w.page, w.text) for w in result] == \
+        [(1, 'Hello'), (1, 'world'), (1, 'Title'), (2, 'Again')]
+    hello, world, title, again = result
+    assert hello.bbox == (10, 10, 90, 30)
+    assert hello.font_size == 12
+    assert world.font_size is None
+
+
+def test_lines():
+    """Words on the same line share one line record."""
+    hello, world, title, again = words()
+    assert hello.line is world.line
+    assert hello.line.bbox == (10, 10, 300, 30)
+    assert hello.line.baseline == (0.01, -3)
+    assert hello.line.textangle == 0
+    assert title.line.textangle == 90
+    assert again.line.baseline == (0, 0)
+
+
+def test_parse_title():
+    assert pypdfocr_hocr.parse_title("bbox 1 2 3 4; x_font Times New Roman") \
+        == {'bbox': '1 2 3 4', 'x_font': 'Times New Roman'}
@@ -68,6 +68,31 @@ class TestOptions:
         assert config.watch_dir == "watch_dir"
         # assert pdfocr.watch is True
 
+    def test_batch(self, pdfocr, tmpdir):
+        """Batch mode takes several paths, or a file listing them"""
+        config = pdfocr.get_options(["-b", "a.pdf", "scans", "*.pdf"])
+        assert config.pdf_filename is None
+        assert config.batch_paths == ["a.pdf", "scans", "*.pdf"]
+        assert config.manifest == "pypdfocr_manifest.jsonl"
+
+        file_list = tmpdir.join('list.txt')
+        file_list.write("a.pdf\n\nscans\n")
+        config = pdfocr.get_options(
+            ["--batch-list", str(file_list), "--manifest", "done.jsonl"])
+        assert config.batch_paths == ["a.pdf", "scans"]
+        assert config.manifest == "done.jsonl"
+
+        with pytest.raises(SystemExit):
+            pdfocr.get_options(["foo.pdf", "-b", "a.pdf"])
+
+    def test_serve(self, pdfocr):
+        """Service mode takes an address instead of files"""
+        config = pdfocr.get_options(["--serve", "unix:/run/pypdfocr.sock"])
+        assert config.serve_address == "unix:/run/pypdfocr.sock"
+        assert config.pdf_filename is None
+        with pytest.raises(SystemExit):
+            pdfocr.get_options(["foo.pdf", "--serve", "8080"])
+
     def test_preprocess(self, pdfocr):
         """Preprocess flag should disable skip_preprocessing"""
         opts = ["foo.pdf", "--preprocess"]
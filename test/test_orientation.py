@@ -0,0 +1,163 @@
+import io
+import os
+
+import mock
+import pytest
+from PIL import Image
+from PyPDF2 import PdfFileReader
+
+from pypdfocr import pypdfocr_orientation
+from pypdfocr.pypdfocr_hocr import iter_hocr_words
+from pypdfocr.pypdfocr_orientation import PyOrientation, restore_hocr
+
+
+HOCR = u"""<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <body>
+  <div class='ocr_page' id='page_1' title='image "x.jpg"; bbox 0 0 400 300; ppageno 0'>
+   <span class='ocr_line' id='line_1_1' title="bbox 100 50 300 80; baseline 0 -5; x_size 30">
+    <span class='ocrx_word' id='word_1_1' title='bbox 100 50 200 80; x_wconf 90'>upright</span>
+   </span>
+  </div>
+ </body>
+</html>
+"""
+
+
+@pytest.fixture
+def orientation():
+    return PyOrientation({})
+
+
+@pytest.fixture
+def scan(tmpdir):
+    """The scanned page of test_recipe.pdf, which is stored upside down."""
+    filename = os.path.join(os.path.dirname(__file__), 'pdfs',
+                            'test_recipe.pdf')
+    with open(filename, 'rb') as f:
+        page = PdfFileReader(f).getPage(0)
+        data = page['/Resources']['/XObject']['/Im1'].getObject()._data
+    return Image.open(io.BytesIO(data))
+
+
+@pytest.fixture
+def patent():
+    """The first page of test_patent.pdf as rendered: its scan is stored
+    upside down, and turned upright by the page."""
+    filename = os.path.join(os.path.dirname(__file__), 'pdfs',
+                            'test_patent.pdf')
+    with open(filename, 'rb') as f:
+        page = PdfFileReader(f).getPage(0)
+        data = page['/Resources']['/XObject']['/Im0'].getObject()._data
+    return Image.open(io.BytesIO(data)).convert('L').rotate(180)
+
+
+def save(tmpdir, img, name='page_1.jpg'):
+    filename = str(tmpdir.join(name))
+    img.save(filename, dpi=(200, 300))
+    return filename
+
+
+@pytest.mark.parametrize("turn", [0, 90, 180, 270])
+def test_orientation(orientation, scan, tmpdir, turn):
+    filename = save(tmpdir, scan.rotate(turn, expand=True))
+    assert orientation.get_orientation(filename) == ((180 + turn) % 360, 0)
+
+
+@pytest.mark.parametrize("deskew", [True, False])
+@pytest.mark.parametrize("skew", [-4, -3, -2, -1, 1, 2, 3, 4])
+def test_skewed_upright(orientation, patent, tmpdir, skew, deskew):
+    """Slightly skewed upright pages are never turned upside down."""
+    orientation.deskew = deskew
+    skewed = patent.rotate(skew, Image.BILINEAR, expand=True, fillcolor=255)
+    angle, _ = orientation.get_orientation(save(tmpdir, skewed))
+    assert angle == 0
+
+
+@pytest.mark.parametrize("deskew", [True, False])
+def test_upright_patent(orientation, patent, tmpdir, deskew):
+    orientation.deskew = deskew
+    assert orientation.get_orientation(save(tmpdir, patent)) == (0, 0)
+    upside_down = save(tmpdir, patent.rotate(180))
+    assert orientation.get_orientation(upside_down) == (180, 0)
+
+
+def test_skew(orientation, scan, tmpdir):
+    skewed = scan.rotate(183, Image.BILINEAR, expand=True,
+                         fillcolor=255)
+    assert orientation.get_orientation(save(tmpdir, skewed)) == (0, 3.0)
+    orientation.deskew = False
+    assert orientation.get_orientation(save(tmpdir, skewed)) == (0, 0)
+
+
+def test_blank(orientation, tmpdir):
+    filename = save(tmpdir, Image.new('L', (850, 1100), 255))
+    assert orientation.get_orientation(filename) == (0, 0)
+    assert orientation.make_upright(filename) == (filename, 0, 0)
+
+
+def test_make_upright(orientation, scan, tmpdir):
+    filename = save(tmpdir, scan.rotate(90, expand=True))
+    upright_filename, angle, skew = orientation.make_upright(filename)
+    assert upright_filename == str(tmpdir.join('page_1_upright.jpg'))
+    assert (angle, skew) == (270, 0)
+    upright = Image.open(upright_filename)
+    assert upright.size == scan.size
+    assert upright.info['dpi'] == (300, 200)
+    assert orientation.get_orientation(upright_filename) == (0, 0)
+
+
+@pytest.mark.parametrize("angle", [0, 90, 180, 270])
+def test_mapping(orientation, tmpdir, angle):
+    """Points on the upright image map back to where they were."""
+    img = Image.new('L', (400, 300), 255)
+    img.paste(0, (50, 200, 56, 206))
+    filename = save(tmpdir, img, 'dot_1.png')
+    with mock.patch.object(orientation, 'get_orientation',
+                           return_value=(angle, 2.0)):
+        upright_filename, _, _ = orientation.make_upright(filename)
+    upright = Image.open(upright_filename)
+    x0, y0, x1, y1 = upright.point(lambda i: 255 if i < 128 else 0).getbbox()
+    mapping = pypdfocr_orientation._HocrMapping(
+        upright.size[0], upright.size[1], angle, 2.0)
+    x, y = mapping.point((x0 + x1)/2.0, (y0 + y1)/2.0)
+    assert x == pytest.approx(53, abs=1.5)
+    assert y == pytest.approx(203, abs=1.5)
+
+
+def write_hocr(tmpdir):
+    filename = str(tmpdir.join('page_1_upright.hocr'))
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write(HOCR)
+    return filename
+
+
+def test_restore_hocr(tmpdir):
+    """Boxes move back onto the page as rendered, and lines get the angle
+    of the text."""
+    filename = write_hocr(tmpdir)
+    restore_hocr(filename, 90, 0)
+    word = list(iter_hocr_words(filename))[0]
+    assert word.text == 'upright'
+    # The start of the line is at the bottom, as the text reads upwards
+    assert word.bbox == (50, 200, 80, 300)
+    assert word.line.textangle == 90
+    with io.open(filename, encoding='utf-8') as f:
+        assert "bbox 0 0 300 400" in f.read()
+
+
+def test_restore_hocr_skew(tmpdir):
+    """Deskewed lines get their baseline tilted back."""
+    filename = write_hocr(tmpdir)
+    restore_hocr(filename, 0, 2.0)
+    word = list(iter_hocr_words(filename))[0]
+    assert word.line.textangle == 0
+    slope = word.line.baseline[0]
+    assert slope == pytest.approx(-0.0349, abs=0.001)
+
+
+def test_restore_hocr_upright(tmpdir):
+    filename = write_hocr(tmpdir)
+    restore_hocr(filename, 0, 0)
+    with io.open(filename, encoding='utf-8') as f:
+        assert f.read() == HOCR
@@ -0,0 +1,175 @@
+import io
+import os
+import shutil
+
+import pytest
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from reportlab.lib.rl_accel import fp_str
+from reportlab.pdfbase import pdfmetrics
+
+from pypdfocr import pypdfocr_hocr
+from pypdfocr import pypdfocr_pdf
+from pypdfocr import pypdfocr_stats
+
+
+HOCR = u"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+ </head>
+ <body>
+  <div class='ocr_page' id='page_1' title='bbox 0 0 609 790; ppageno 0'>
+   <div class='ocr_carea' id='block_1_1' title="bbox 50 50 400 120">
+    <p class='ocr_par' id='par_1_1' title="bbox 50 50 400 120">
+     <span class='ocr_line' id='line_1_1' title="bbox 50 50 400 80; {line_extra}x_size 30">
+      <span class='ocrx_word' id='word_1_1' title='bbox 50 50 200 80; x_wconf 90; x_font Times; x_fsize 24'>{word1}</span>
+      <span class='ocrx_word' id='word_1_2' title='bbox 220 50 400 80; x_wconf 90'><strong>{word2}</strong></span>
+     </span>
+    </p>
+   </div>
+  </div>
+ </body>
+</html>
+"""
+
+
+@pytest.fixture
+def pypdf():
+    return pypdfocr_pdf.PyPdf(None)
+
+
+@pytest.fixture
+def asset_dir(tmpdir):
+    """Copy the sample assets to a temporary directory and return path.
+    """
+    test_dir = str(tmpdir.join('source'))
+    assets = os.path.join(os.path.dirname(__file__), 'pdfs')
+    shutil.copytree(assets, test_dir)
+    return test_dir
+
+
+def make_page(asset_dir, name, words, line_extra='baseline 0 -5; '):
+    """Write a page image and its hocr, returning (img, hocr) filenames."""
+    img_filename = os.path.join(asset_dir, '%s.jpg' % name)
+    Image.new('L', (609, 790), 255).save(img_filename, dpi=(72, 72))
+    hocr_filename = os.path.join(asset_dir, '%s.hocr' % name)
+    with open(hocr_filename, 'wb') as f:
+        f.write(HOCR.format(word1=words[0], word2=words[1],
+                            line_extra=line_extra).encode('utf-8'))
+    return img_filename, hocr_filename
+
+
+def pdf_text(filename):
+    with open(filename, 'rb') as f:
+        reader = PdfFileReader(f)
+        return [reader.getPage(i).extractText()
+                for i in range(reader.getNumPages())]
+
+
+def test_overlay_hocr_pages(pypdf, asset_dir):
+    """The text of every page ends up in a single output pdf, in order."""
+    orig = os.path.join(asset_dir, 'test_patent.pdf')
+    pages = [make_page(asset_dir, 'test_patent_2', ['Second', 'Page']),
+             make_page(asset_dir, 'test_patent_1', ['Simply', 'Recipes'])]
+    before = set(os.listdir(asset_dir))
+    out = pypdf.overlay_hocr_pages(72, pages, orig)
+    assert out == os.path.join(asset_dir, 'test_patent_ocr.pdf')
+    # No temporary text pdfs left behind
+    assert set(os.listdir(asset_dir)) - before == set(['test_patent_ocr.pdf'])
+    text = pdf_text(out)
+    assert len(text) == 2
+    assert 'Simply' in text[0] and 'Recipes' in text[0]
+    assert 'Second' in text[1] and 'Page' in text[1]
+
+
+def test_overlay_skipped_pages(pypdf, asset_dir):
+    """Pages without a text page are copied over unchanged."""
+    orig = os.path.join(asset_dir, 'test_patent.pdf')
+    pages = [make_page(asset_dir, 'test_patent_2', ['Second', 'Page'])]
+    out = pypdf.overlay_hocr_pages(72, pages, orig)
+    text = pdf_text(out)
+    assert len(text) == 2
+    assert not text[0].strip()
+    assert 'Second' in text[1]
+    with open(orig, 'rb') as f:
+        orig_contents = PdfFileReader(f).getPage(0).getContents().getData()
+    with open(out, 'rb') as f:
+        assert PdfFileReader(f).getPage(0).getContents().getData() == \
+            orig_contents
+
+
+def test_overlay_no_pages(pypdf, asset_dir):
+    orig = os.path.join(asset_dir, 'test_patent.pdf')
+    out = pypdf.overlay_hocr_pages(72, [], orig)
+    assert len(pdf_text(out)) == 2
+
+
+def test_get_page_num(pypdf):
+    assert pypdf._get_page_num('/tmp/scan2/doc_12.jpg') == 12
+    assert pypdf._get_page_num('doc_3_preprocess.png') == 3
+
+
+def test_overlay_bad_hocr(pypdf, asset_dir):
+    """Garbage hocr gives an empty text layer instead of failing."""
+    orig = os.path.join(asset_dir, 'test_recipe.pdf')
+    img_filename, hocr_filename = make_page(asset_dir, 'test_recipe_1',
+                                            ['a', 'b'])
+    with open(hocr_filename, 'w') as f:
+        f.write('not hocr <')
+    out = pypdf.overlay_hocr_pages(72, [(img_filename, hocr_filename)], orig)
+    assert len(pdf_text(out)) == 1
+
+
+@pytest.mark.parametrize("textangle", [90, 180, 270])
+def test_overlay_rotated_text(pypdf, asset_dir, textangle):
+    orig = os.path.join(asset_dir, 'test_recipe.pdf')
+    page = make_page(asset_dir, 'test_recipe_1', ['Simply', 'Recipes'],
+                     line_extra='textangle %d; ' % textangle)
+    out = pypdf.overlay_hocr_pages(72, [page], orig)
+    text = pdf_text(out)[0]
+    assert 'Simply' in text and 'Recipes' in text
+
+
+def test_text_matrix(pypdf):
+    """Words sit on the baseline and are stretched to their box."""
+    canvas = pypdfocr_pdf.Canvas(io.BytesIO())
+    text = canvas.beginText()
+    line = pypdfocr_hocr.HocrLine((100, 100, 500, 150), (0, -10), 0)
+    word = pypdfocr_hocr.HocrWord(1, line, (100, 100, 300, 150), 10, 'word')
+    pypdf._add_word(text, word, 1000, 72)
+    code = text.getCode()
+    assert '1 0 0 1 100 860 Tm (word) Tj' in code
+    width = pdfmetrics.stringWidth('word', 'Helvetica', 10)
+    assert '%s Tz' % fp_str(100.0*200/width) in code
+
+
+def test_overlay_drop_pages(pypdf, asset_dir):
+    """Dropped pages are left out, unless that would leave nothing."""
+    orig = os.path.join(asset_dir, 'test_patent.pdf')
+    pages = [make_page(asset_dir, 'test_patent_2', ['Second', 'Page'])]
+    out = pypdf.overlay_hocr_pages(72, pages, orig, drop_pages=[1])
+    text = pdf_text(out)
+    assert len(text) == 1
+    assert 'Second' in text[0]
+    out = pypdf.overlay_hocr_pages(72, [], orig, drop_pages=[1, 2])
+    assert len(pdf_text(out)) == 2
+
+
+def test_overlay_stats(pypdf, asset_dir):
+    """The text layer, merge and write stages are timed, and words counted."""
+    orig = os.path.join(asset_dir, 'test_patent.pdf')
+    pages = [make_page(asset_dir, 'test_patent_1', ['Simply', 'Recipes']),
+             make_page(asset_dir, 'test_patent_2', ['Second', 'Page'])]
+    stats = pypdfocr_stats.PyStats(orig)
+    with pypdfocr_stats.use_stats(stats):
+        pypdf.overlay_hocr_pages(72, pages, orig)
+    report = stats.get_report()
+    assert report['stages']['hocr_parse']['count'] == 2
+    # One per page, and the save of the whole layer
+    assert report['stages']['text_layer']['count'] == 3
+    assert report['stages']['merge']['count'] == 1
+    assert report['stages']['write']['count'] == 1
+    assert report['counters'] == {'words': 4}
@@ -2,9 +2,12 @@ import os
 import shutil
 
 import mock
+from multiprocessing.pool import ThreadPool
 import pytest
+from PIL import Image
 
 from pypdfocr import pypdfocr_preprocess
+from pypdfocr.pypdfocr_cpu import get_cpu_count
 
 
 @pytest.fixture
@@ -23,7 +26,7 @@ def asset_dir(tmpdir):
 
 
 def test_config(pypre):
-    assert pypre.threads == 4
+    assert pypre.threads == get_cpu_count()
     pypre = pypdfocr_preprocess.PyPreprocess({'threads': 1})
     assert pypre.threads == 1
 
@@ -50,3 +53,68 @@ def test_keyboard_interrupt(pypre, monkeypatch, caplog):
     with pytest.raises(Exception):
         pypre.preprocess(['foo.jpg'])
     assert "keyboard interrupt" in caplog.text
+
+
+def test_shared_pool(pypre, monkeypatch):
+    pypre.pool = ThreadPool(2)
+    monkeypatch.setattr(pypre, 'cmd', mock.Mock(return_value=""))
+    assert pypre.preprocess(['foo.jpg', 'bar.jpg']) == \
+        ['foo_preprocess.jpg', 'bar_preprocess.jpg']
+    pypre.pool.close()
+
+
+def test_numpy_missing(monkeypatch, caplog):
+    """Without numpy, the convert engine is used instead."""
+    monkeypatch.setattr(pypdfocr_preprocess, 'NUMPY_ENABLED', False)
+    pypre = pypdfocr_preprocess.PyPreprocess({'engine': 'numpy'})
+    assert pypre.engine == 'convert'
+    assert "Could not find numpy" in caplog.text
+
+
+def test_local_mean():
+    numpy = pytest.importorskip('numpy')
+    pixels = numpy.random.RandomState(0).randint(0, 256, (20, 30))
+    mean = pypdfocr_preprocess.local_mean(pixels.astype(float), 5)
+    padded = numpy.pad(pixels, 2, 'edge')
+    assert mean.shape == pixels.shape
+    assert mean[0, 0] == pytest.approx(padded[:5, :5].mean())
+    assert mean[10, 17] == pytest.approx(pixels[8:13, 15:20].mean())
+
+
+def test_vertical_runs():
+    numpy = pytest.importorskip('numpy')
+    mask = numpy.zeros((10, 3), dtype=bool)
+    mask[1:5, 0] = True  # long enough
+    mask[6:9, 1] = True  # too short
+    mask[6:10, 2] = True  # long enough, at the bottom edge
+    runs = pypdfocr_preprocess.vertical_runs(mask, 4)
+    assert (runs[:, 0] == mask[:, 0]).all()
+    assert not runs[:, 1].any()
+    assert (runs[:, 2] == mask[:, 2]).all()
+
+
+def test_numpy_engine(asset_dir):
+    """The numpy engine whitens the background, keeps the text, and
+    removes long vertical lines."""
+    numpy = pytest.importorskip('numpy')
+    pixels = numpy.full((200, 300), 200, dtype=numpy.uint8)
+    pixels[50:60, 50:60] = 20  # a blob of ink
+    pixels[20:180, 200:202] = 20  # a table rule
+    in_filename = os.path.join(asset_dir, 'page_1.png')
+    Image.fromarray(pixels).save(in_filename, dpi=(150, 150))
+
+    pypre = pypdfocr_preprocess.PyPreprocess({'engine': 'numpy'})
+    out_filename = pypre.preprocess([in_filename])[0]
+    assert out_filename == os.path.join(asset_dir, 'page_1_preprocess.png')
+    out = Image.open(out_filename)
+    assert out.info['dpi'] == pytest.approx((150, 150), abs=0.1)
+    result = numpy.asarray(out)
+    assert result[10, 10] == 255
+    assert result[55, 55] < 128
+    assert (result[30:170, 200:202] > 128).all()
+
+
+def test_numpy_engine_infile_missing():
+    pytest.importorskip('numpy')
+    pypre = pypdfocr_preprocess.PyPreprocess({'engine': 'numpy'})
+    assert pypre._run_preprocess('infile.jpg') == 'infile.jpg'
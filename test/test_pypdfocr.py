@@ -1,13 +1,22 @@
 from collections import namedtuple
+import json
 import logging
 import os
 import shutil
+import sys
+import threading
+import time
 
 import pytest
+import mock
 from mock import patch
+from PIL import Image, ImageDraw
 from PyPDF2 import PdfFileReader
 
 from pypdfocr import pypdfocr
+from pypdfocr import pypdfocr_stats
+from pypdfocr.pypdfocr_blank import PyBlankDetector
+from pypdfocr.pypdfocr_orientation import PyOrientation
 
 
 Spec = namedtuple(
@@ -202,3 +211,414 @@ class TestPydfocr:
         else:
             assert pdfocr.ts.binary == '"/usr/bin/tesseract"'
             assert pdfocr.gs.binary == "C:\\usr\\bin\\ghostscript"
+
+    def test_stream_conversion(self, pdfocr, tmpdir):
+        """Pages are OCR'ed as the renderer yields them and merged in order.
+        """
+        pdfocr.config = pdfocr.get_options(['foo.pdf', '--stream'])
+        pdfocr.blank = PyBlankDetector({'detect': False})
+        pdfocr.orientation = PyOrientation({'detect': False})
+        pdfocr.gs = mock.Mock()
+        pdfocr.gs.iter_img_from_pdf.return_value = (
+            300, iter(['foo_1.jpg', 'foo_2.jpg', 'foo_3.jpg']))
+        pdfocr.ts = mock.Mock()
+        pdfocr.ts.threads = 2
+        pdfocr.ts.make_hocr_from_pnm.side_effect = \
+            lambda fn: fn.replace('.jpg', '.hocr')
+        pdfocr.pdf = mock.Mock()
+        pdfocr.pdf.start_text_layer.return_value = 'layer'
+        pdfocr.pdf.merge_text_layer.return_value = 'foo_ocr.pdf'
+        assert pdfocr.run_conversion('foo.pdf') == 'foo_ocr.pdf'
+        assert pdfocr.pdf.add_text_page.call_args_list == [
+            mock.call('layer', 300, 'foo_%d.hocr' % i, 'foo_%d.jpg' % i)
+            for i in (1, 2, 3)]
+        pdfocr.pdf.merge_text_layer.assert_called_once_with('layer', 'foo.pdf',
+                                                            [])
+        assert not pdfocr.gs.make_img_from_pdf.called
+
+    def test_stream_conversion_gs_error(self, pdfocr):
+        """A gs failure half way through stops the private pool and comes
+        out as the SystemExit of the failure."""
+        pdfocr.config = pdfocr.get_options(['foo.pdf', '--stream'])
+        pdfocr.blank = PyBlankDetector({'detect': False})
+        pdfocr.orientation = PyOrientation({'detect': False})
+
+        def render():
+            yield 'foo_1.jpg'
+            sys.exit(-1)
+        pdfocr.gs = mock.Mock()
+        pdfocr.gs.iter_img_from_pdf.return_value = (300, render())
+        pdfocr.ts = mock.Mock()
+        pdfocr.ts.threads = 2
+        pdfocr.ts.make_hocr_from_pnm.side_effect = \
+            lambda fn: fn.replace('.jpg', '.hocr')
+        pdfocr.pdf = mock.Mock()
+        with pytest.raises(SystemExit):
+            pdfocr.run_conversion('foo.pdf')
+        assert not pdfocr.pdf.merge_text_layer.called
+
+    def test_scratch_dir(self, pdfocr, tmpdir):
+        """Intermediate files go to a scratch directory that is removed."""
+        scratch_root = tmpdir.mkdir('scratch')
+        pdfocr.config = pdfocr.get_options(
+            ['foo.pdf', '--scratch-dir', str(scratch_root)])
+        pdfocr.blank = PyBlankDetector({'detect': False})
+        pdfocr.orientation = PyOrientation({'detect': False})
+        scratch_dirs = []
+
+        def make_img(pdf_filename, output_dir):
+            scratch_dirs.append(output_dir)
+            img_filename = os.path.join(output_dir, 'foo_1.jpg')
+            with open(img_filename, 'w') as f:
+                f.write('')
+            return 300, [img_filename]
+        pdfocr.gs = mock.Mock()
+        pdfocr.gs.make_img_from_pdf.side_effect = make_img
+        pdfocr.ts = mock.Mock()
+        pdfocr.ts.make_hocr_from_pnms.side_effect = \
+            lambda fns: [(fn, fn.replace('.jpg', '.hocr')) for fn in fns]
+        pdfocr.pdf = mock.Mock()
+        pdfocr.pdf.overlay_hocr_pages.return_value = 'foo_ocr.pdf'
+        assert pdfocr.run_conversion('foo.pdf') == 'foo_ocr.pdf'
+        assert os.path.dirname(scratch_dirs[0]) == str(scratch_root)
+        assert scratch_root.listdir() == []
+
+        # Debugging leaves the files for a look
+        pdfocr.config.debug = True
+        pdfocr.run_conversion('foo.pdf')
+        assert scratch_root.listdir() == [scratch_root.join(
+            os.path.basename(scratch_dirs[1]))]
+
+    def _make_pages(self, tmpdir, blank):
+        """Write a page image for each page, blank or with some text."""
+        img_filenames = []
+        for page_num, is_blank in enumerate(blank, 1):
+            img = Image.new('L', (850, 1100), 250)
+            if not is_blank:
+                ImageDraw.Draw(img).rectangle((100, 100, 700, 400), fill=0)
+            img_filename = str(tmpdir.join('foo_%d.jpg' % page_num))
+            img.save(img_filename)
+            img_filenames.append(img_filename)
+        return img_filenames
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_blank_pages(self, pdfocr, tmpdir, stream):
+        """Blank pages aren't OCR'ed, and are dropped with --drop-blank."""
+        argv = ['foo.pdf', '--drop-blank']
+        if stream:
+            argv.append('--stream')
+        pdfocr.config = pdfocr.get_options(argv)
+        pdfocr.blank = PyBlankDetector(pdfocr.config.blank)
+        pdfocr.blank.drop = True
+        pdfocr.orientation = PyOrientation({'detect': False})
+        img_filenames = self._make_pages(tmpdir, [False, True, False])
+        pdfocr.gs = mock.Mock()
+        pdfocr.gs.make_img_from_pdf.return_value = (300, img_filenames)
+        pdfocr.gs.iter_img_from_pdf.return_value = (300, iter(img_filenames))
+        pdfocr.ts = mock.Mock()
+        pdfocr.ts.threads = 2
+        pdfocr.ts.make_hocr_from_pnms.side_effect = \
+            lambda fns: [(fn, fn.replace('.jpg', '.hocr')) for fn in fns]
+        pdfocr.ts.make_hocr_from_pnm.side_effect = \
+            lambda fn: fn.replace('.jpg', '.hocr')
+        pdfocr.pdf = mock.Mock()
+        pdfocr.pdf._get_page_num = pypdfocr.PyPdf._get_page_num
+        if stream:
+            pdfocr._run_stream_conversion('foo.pdf')
+            ocr_filenames = [call[0][0] for call in
+                             pdfocr.ts.make_hocr_from_pnm.call_args_list]
+            assert pdfocr.pdf.merge_text_layer.call_args[0][2] == [2]
+        else:
+            pdfocr._run_staged_conversion('foo.pdf')
+            ocr_filenames = pdfocr.ts.make_hocr_from_pnms.call_args[0][0]
+            assert pdfocr.pdf.overlay_hocr_pages.call_args[0][3] == [2]
+        assert sorted(ocr_filenames) == [img_filenames[0], img_filenames[2]]
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_upright_pages(self, pdfocr, stream):
+        """Pages are OCR'ed upright, and the text put back on the page as
+        it was rendered."""
+        argv = ['foo.pdf']
+        if stream:
+            argv.append('--stream')
+        pdfocr.config = pdfocr.get_options(argv)
+        pdfocr.blank = PyBlankDetector({'detect': False})
+        pdfocr.orientation = mock.Mock()
+        pdfocr.orientation.make_upright.return_value = (
+            'foo_1_upright.jpg', 90, 0.0)
+        pdfocr.gs = mock.Mock()
+        pdfocr.gs.make_img_from_pdf.return_value = (300, ['foo_1.jpg'])
+        pdfocr.gs.iter_img_from_pdf.return_value = (300, iter(['foo_1.jpg']))
+        pdfocr.ts = mock.Mock()
+        pdfocr.ts.threads = 2
+        pdfocr.ts.make_hocr_from_pnms.side_effect = \
+            lambda fns: [(fn, fn.replace('.jpg', '.hocr')) for fn in fns]
+        pdfocr.ts.make_hocr_from_pnm.side_effect = \
+            lambda fn: fn.replace('.jpg', '.hocr')
+        pdfocr.pdf = mock.Mock()
+        with patch('pypdfocr.pypdfocr.restore_hocr') as restore_hocr:
+            if stream:
+                pdfocr._run_stream_conversion('foo.pdf')
+                pdfocr.pdf.add_text_page.assert_called_once_with(
+                    mock.ANY, 300, 'foo_1_upright.hocr', 'foo_1.jpg')
+            else:
+                pdfocr._run_staged_conversion('foo.pdf')
+                pdfocr.ts.make_hocr_from_pnms.assert_called_once_with(
+                    ['foo_1_upright.jpg'])
+                assert pdfocr.pdf.overlay_hocr_pages.call_args[0][1] == \
+                    [('foo_1.jpg', 'foo_1_upright.hocr')]
+        restore_hocr.assert_called_once_with('foo_1_upright.hocr', 90, 0.0)
+
+    def test_shared_pool(self, pdfocr):
+        """All the stages share one pool, which is shut down at the end."""
+        pdfocr.config = pdfocr.get_options(['foo.pdf'])
+        pdfocr._setup_external_tools()
+        assert pdfocr.pool is not None
+        assert pdfocr.gs.pool is pdfocr.pool
+        assert pdfocr.ts.pool is pdfocr.pool
+        assert pdfocr.preprocess.pool is pdfocr.pool
+        pdfocr._teardown_external_tools()
+        assert pdfocr.pool is None
+
+    def test_document_cache(self, pdfocr, tmpdir, monkeypatch):
+        """A byte-identical pdf reuses the earlier output without OCR."""
+        conffile = tmpdir.join("test.conf")
+        conffile.write("""
+            cache:
+                dir: %s
+            """ % tmpdir.join('cache'))
+        pdfocr.config = pdfocr.get_options(['foo.pdf', '-c', str(conffile)])
+        pdfocr._setup_external_tools()
+        pdfocr.ts._ts_version = '4.01'
+
+        def convert(pdf_filename):
+            ocr_pdf_filename = pdf_filename.replace('.pdf', '_ocr.pdf')
+            with open(pdf_filename) as f, open(ocr_pdf_filename, 'w') as g:
+                g.write('OCR of ' + f.read())
+            return ocr_pdf_filename
+        run_conversion = mock.Mock(side_effect=convert)
+        monkeypatch.setattr(pdfocr, 'run_conversion', run_conversion)
+
+        for name, contents in [('a', 'scan'), ('b', 'scan'), ('c', 'other')]:
+            tmpdir.join(name + '.pdf').write(contents)
+            pdfocr._convert_and_file_email(str(tmpdir.join(name + '.pdf')))
+        assert run_conversion.call_args_list == [
+            mock.call(str(tmpdir.join('a.pdf'))),
+            mock.call(str(tmpdir.join('c.pdf')))]
+        assert tmpdir.join('b_ocr.pdf').read() == 'OCR of scan'
+
+        # A different language needs a new conversion
+        pdfocr.config.lang = 'deu'
+        pdfocr._convert_and_file_email(str(tmpdir.join('b.pdf')))
+        assert run_conversion.call_count == 3
+        pdfocr._teardown_external_tools()
+
+    def test_settings_engine(self, pdfocr):
+        """Documents OCR'ed by the persistent engines and by the tesseract
+        binary don't share cached outputs or checkpoints."""
+        pdfocr.config = pdfocr.get_options(['foo.pdf'])
+        pdfocr._setup_external_tools()
+        pdfocr.ts._ts_version = '4.01'
+        binary_settings = pdfocr._get_settings()
+        pdfocr.ts.engines = mock.Mock()
+        assert pdfocr._get_settings() != binary_settings
+        pdfocr.ts.engines = None
+        pdfocr._teardown_external_tools()
+
+    def test_settings_adaptive_dpi(self, pdfocr):
+        """Changing how the render dpi is picked needs a new conversion."""
+        pdfocr.config = pdfocr.get_options(['foo.pdf'])
+        pdfocr._setup_external_tools()
+        pdfocr.ts._ts_version = '4.01'
+        settings = set([pdfocr._get_settings()])
+        for name, value in [('adaptive_dpi', True), ('min_dpi', 150),
+                            ('max_dpi', 400), ('x_height', 16.0)]:
+            setattr(pdfocr.gs, name, value)
+            settings.add(pdfocr._get_settings())
+        assert len(settings) == 5
+        pdfocr._teardown_external_tools()
+
+    def test_stats_report(self, pdfocr, tmpdir, monkeypatch):
+        """Each conversion gets a timings report, and adds to the
+        histograms of all of them."""
+        stats_dir = tmpdir.join('stats')
+        pdfocr.config = pdfocr.get_options(
+            ['foo.pdf', '--stats-dir', str(stats_dir)])
+        pdfocr._setup_external_tools()
+
+        def convert(pdf_filename):
+            with pypdfocr_stats.timed('render'):
+                ocr_pdf_filename = pdf_filename.replace('.pdf', '_ocr.pdf')
+                with open(ocr_pdf_filename, 'w') as f:
+                    f.write('OCR of scan')
+            return ocr_pdf_filename
+        monkeypatch.setattr(pdfocr, 'run_conversion', convert)
+        for name in ['a', 'b']:
+            tmpdir.join(name + '.pdf').write('scan')
+            pdfocr._convert_and_file_email(str(tmpdir.join(name + '.pdf')))
+        pdfocr._teardown_external_tools()
+
+        reports = sorted(path.basename for path in stats_dir.listdir())
+        assert len(reports) == 3
+        assert reports[0].startswith('a_')
+        report = json.loads(stats_dir.join(reports[0]).read())
+        assert report['stages']['render']['count'] == 1
+        assert report['counters'] == {'bytes_in': 4, 'bytes_out': 11}
+        histograms = json.loads(stats_dir.join('histograms.json').read())
+        assert histograms['jobs'] == 2
+        assert histograms['stages']['render']['count'] == 2
+        assert histograms['counters']['bytes_out'] == 22
+
+    def test_watch_concurrent(self, pdfocr, tmpdir, monkeypatch):
+        """Files from one scan are converted by separate document workers."""
+        conffile = tmpdir.join("test.conf")
+        conffile.write("""
+            watch:
+                scan_interval: 1
+                max_concurrent_documents: 2
+            """)
+        pdfocr.config = pdfocr.get_options(
+            ['-w', str(tmpdir), '-c', str(conffile)])
+        assert pdfocr.config.watch is True
+        assert pdfocr.config.watch_config['max_concurrent_documents'] == 2
+
+        both_running = threading.Event()
+        started = []
+        converted = []
+
+        def convert(pdf_filename):
+            started.append(pdf_filename)
+            if len(started) == 2:
+                both_running.set()
+            # Only set if the second document starts before this one is done
+            if both_running.wait(5):
+                converted.append(pdf_filename)
+
+        def start(watcher):
+            yield 'a.pdf'
+            yield 'b.pdf'
+            for _ in range(60):
+                if len(converted) == 2:
+                    break
+                time.sleep(0.1)
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(pdfocr, '_convert_and_file_email', convert)
+        monkeypatch.setattr(pypdfocr.PyPdfWatcher, 'start', start)
+        pdfocr._watch()
+        assert sorted(converted) == ['a.pdf', 'b.pdf']
+
+    def test_batch(self, pdfocr, tmpdir, monkeypatch):
+        """A batch converts each pdf once, and a rerun skips the ones that
+        were converted."""
+        for name in ['a', 'b', 'c']:
+            tmpdir.join('scans', name + '.pdf').write(name, ensure=True)
+        tmpdir.join('scans', 'a_ocr.pdf').write('a')
+        os.utime(str(tmpdir.join('scans', 'a.pdf')), (1, 1))
+        manifest = str(tmpdir.join('manifest.jsonl'))
+        pdfocr.config = pdfocr.get_options(
+            ['-b', str(tmpdir.join('scans')), '--manifest', manifest])
+        pdfocr.config.batch = {'max_concurrent_documents': 2}
+
+        def convert(pdf_filename, stats=None):
+            if pdf_filename.endswith('c.pdf'):
+                raise Exception('Boom')
+            return pdf_filename.replace('.pdf', '_ocr.pdf'), "None"
+        convert = mock.Mock(side_effect=convert)
+        monkeypatch.setattr(pdfocr, '_convert_and_file_email', convert)
+        assert pdfocr._batch() == {'converted': 1, 'skipped': 1, 'failed': 1}
+        assert convert.call_count == 2
+
+        records = pypdfocr.PyBatch.read_manifest(manifest)
+        b_pdf = str(tmpdir.join('scans', 'b.pdf'))
+        assert records[b_pdf]['status'] == 'converted'
+        assert records[b_pdf]['output'] == b_pdf.replace('.pdf', '_ocr.pdf')
+        assert records[str(tmpdir.join('scans', 'a.pdf'))]['status'] == \
+            'skipped'
+        assert records[str(tmpdir.join('scans', 'c.pdf'))]['error'] == 'Boom'
+
+        # b is up to date from the manifest alone; only c is tried again
+        tmpdir.join('scans', 'b_ocr.pdf').write('b')
+        convert.reset_mock()
+        assert pdfocr._batch() == {'converted': 0, 'skipped': 2, 'failed': 1}
+        assert [call[0][0] for call in convert.call_args_list] == [
+            str(tmpdir.join('scans', 'c.pdf'))]
+
+    def test_checkpoint_resume(self, pdfocr, tmpdir):
+        """A conversion that dies is resumed from its checkpoint, redoing
+        only the pages that were not done."""
+        pdf_filename = str(tmpdir.join('foo.pdf'))
+        tmpdir.join('foo.pdf').write('scan')
+        checkpoint_root = tmpdir.mkdir('checkpoints')
+        pdfocr.config = pdfocr.get_options(
+            [pdf_filename, '--checkpoint-dir', str(checkpoint_root)])
+        pdfocr.blank = PyBlankDetector({'detect': False})
+        pdfocr.orientation = PyOrientation({'detect': False})
+        pdfocr.preprocess = mock.Mock(engine='convert')
+        skipped = []
+
+        def iter_img(pdf_filename, output_dir, skip_pages):
+            skipped.append(sorted(skip_pages))
+
+            def render():
+                for page_num in range(1, 4):
+                    if page_num not in skip_pages:
+                        img_filename = os.path.join(output_dir,
+                                                    'foo_%d.jpg' % page_num)
+                        open(img_filename, 'w').close()
+                        yield img_filename
+            return 300, render()
+        pdfocr.gs = mock.Mock()
+        pdfocr.gs.iter_img_from_pdf.side_effect = iter_img
+
+        def ocr(img_filename):
+            if img_filename.endswith('_3.jpg') and len(skipped) == 1:
+                raise Exception('Killed')
+            hocr_filename = img_filename.replace('.jpg', '.hocr')
+            open(hocr_filename, 'w').close()
+            return hocr_filename
+        pdfocr.ts = mock.Mock(ts_version='4.01', threads=2)
+        pdfocr.ts.make_hocr_from_pnm.side_effect = ocr
+        pdfocr.pdf = mock.Mock()
+        pdfocr.pdf._get_page_num = pypdfocr.PyPdf._get_page_num
+        pdfocr.pdf.merge_text_layer.return_value = 'foo_ocr.pdf'
+
+        with pytest.raises(Exception):
+            pdfocr.run_conversion(pdf_filename)
+        assert len(checkpoint_root.listdir()) == 1
+        assert pdfocr.ts.make_hocr_from_pnm.call_count == 3
+
+        pdfocr.ts.make_hocr_from_pnm.reset_mock()
+        assert pdfocr.run_conversion(pdf_filename) == 'foo_ocr.pdf'
+        assert skipped == [[], [1, 2, 3]]
+        assert [os.path.basename(call[0][0]) for call in
+                pdfocr.ts.make_hocr_from_pnm.call_args_list] == ['foo_3.jpg']
+        assert sorted(os.path.basename(call[0][2]) for call in
+                      pdfocr.pdf.add_text_page.call_args_list[-3:]) == \
+            ['foo_1.hocr', 'foo_2.hocr', 'foo_3.hocr']
+        assert checkpoint_root.listdir() == []
+
+    def test_run_jobs(self, pdfocr, tmpdir, monkeypatch):
+        """Document workers run the queued jobs and record how they went."""
+        pdfocr.config = pdfocr.get_options(['--serve', '0'])
+        jobs = pypdfocr.PyJobQueue(str(tmpdir.join('jobs')))
+        good = jobs.submit('good.pdf')['id']
+        bad = jobs.submit('bad.pdf')['id']
+
+        def convert(pdf_filename, stats=None):
+            if pdf_filename.endswith('bad.pdf'):
+                raise Exception('Boom')
+            return pdf_filename.replace('.pdf', '_ocr.pdf'), "None"
+        monkeypatch.setattr(pdfocr, '_convert_and_file_email', convert)
+        worker = threading.Thread(target=pdfocr._run_jobs, args=(jobs,))
+        worker.start()
+        for _ in range(50):
+            if jobs.get(bad)['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.1)
+        jobs.stop()
+        worker.join(5)
+        assert jobs.get(good)['status'] == 'done'
+        assert jobs.get(good)['output'].endswith('good_ocr.pdf')
+        assert jobs.get(bad)['status'] == 'failed'
+        assert jobs.get(bad)['error'] == 'Boom'
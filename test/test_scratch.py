@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from pypdfocr.pypdfocr_scratch import PyDeleteQueue, PyScratch
+
+
+def test_cleanup(tmpdir):
+    """Everything in the scratch directory is removed together."""
+    with PyScratch(str(tmpdir)) as scratch:
+        assert os.path.dirname(scratch.path) == str(tmpdir)
+        assert os.path.basename(scratch.path).startswith(
+            'pypdfocr_%d_' % os.getpid())
+        for name in ['doc_1.jpg', 'doc_1.hocr', 'doc_1_preprocess.jpg']:
+            with open(os.path.join(scratch.path, name), 'w') as f:
+                f.write('')
+    assert tmpdir.listdir() == []
+
+
+def test_default_root():
+    scratch = PyScratch()
+    try:
+        assert os.path.isdir(scratch.path)
+    finally:
+        scratch.cleanup()
+    assert not os.path.exists(scratch.path)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="Can't check for processes")
+def test_sweep(tmpdir):
+    """Only the directories of processes that are gone are removed."""
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    tmpdir.mkdir('pypdfocr_%d_abc' % proc.pid).join('doc_1.jpg').write('')
+    tmpdir.mkdir('other_dir')
+    scratch = PyScratch(str(tmpdir))
+    assert PyScratch.sweep(str(tmpdir)) == \
+        [str(tmpdir.join('pypdfocr_%d_abc' % proc.pid))]
+    assert sorted(os.listdir(str(tmpdir))) == \
+        sorted(['other_dir', os.path.basename(scratch.path)])
+    scratch.cleanup()
+
+
+def test_delete_queue(tmpdir):
+    tmpdir.join('a.jpg').write('')
+    scratch = PyScratch(str(tmpdir.mkdir('scratch')))
+    with open(os.path.join(scratch.path, 'b.jpg'), 'w') as f:
+        f.write('')
+    delete_queue = PyDeleteQueue()
+    delete_queue.delete(str(tmpdir.join('a.jpg')))
+    scratch.cleanup(delete_queue)
+    delete_queue.delete(str(tmpdir.join('missing.jpg')))
+    assert delete_queue.close(timeout=5)
+    assert tmpdir.join('scratch').listdir() == []
+    assert not tmpdir.join('a.jpg').exists()
+    assert delete_queue.failed == []
+
+
+def test_delete_queue_retry(tmpdir, monkeypatch):
+    """Failed deletes are retried with backoff, up to a limit."""
+    tmpdir.join('locked.jpg').write('')
+    tmpdir.join('stuck.jpg').write('')
+    remove = os.remove
+    attempts = []
+
+    def locked_remove(path):
+        attempts.append(os.path.basename(path))
+        if path.endswith('stuck.jpg') or attempts.count('locked.jpg') < 3:
+            raise OSError(13, 'Permission denied')
+        remove(path)
+    monkeypatch.setattr('os.remove', locked_remove)
+
+    delete_queue = PyDeleteQueue(tries=4, pause=0.01)
+    delete_queue.delete(str(tmpdir.join('locked.jpg')))
+    delete_queue.delete(str(tmpdir.join('stuck.jpg')))
+    assert delete_queue.close(timeout=5)
+    assert not tmpdir.join('locked.jpg').exists()
+    assert attempts.count('locked.jpg') == 3
+    assert attempts.count('stuck.jpg') == 4
+    assert delete_queue.failed == [str(tmpdir.join('stuck.jpg'))]
@@ -0,0 +1,179 @@
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from pypdfocr.pypdfocr_server import PyJobQueue, is_loopback, make_server
+from pypdfocr.pypdfocr_stats import PyHistograms, PyStats
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:  # Python 2
+    from urllib2 import Request, urlopen, HTTPError
+
+
+@pytest.fixture
+def jobs(tmpdir):
+    return PyJobQueue(str(tmpdir.join('jobs')))
+
+
+@pytest.fixture
+def histograms():
+    return PyHistograms()
+
+
+@pytest.fixture
+def server(jobs, histograms):
+    """Serve the job API on a free localhost port."""
+    server = make_server('127.0.0.1:0', jobs, histograms)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def request(url, data=None, content_type='application/json'):
+    """:returns: (status code, body) of an HTTP request"""
+    req = Request(url, data)
+    if data is not None:
+        req.add_header('Content-Type', content_type)
+    try:
+        response = urlopen(req, timeout=5)
+    except HTTPError as err:
+        return err.code, json.loads(err.read().decode('utf-8'))
+    body = response.read()
+    if response.headers.get('Content-Type') == 'application/json':
+        body = json.loads(body.decode('utf-8'))
+    return response.getcode(), body
+
+
+class TestJobQueue:
+
+    def test_priority(self, jobs):
+        """Higher priorities first, then in the order they came in."""
+        ids = [jobs.submit('a.pdf')['id'], jobs.submit('b.pdf', 5)['id'],
+               jobs.submit('c.pdf')['id'], jobs.submit('d.pdf', 5)['id']]
+        order = [jobs.next_job()['id'] for _ in ids]
+        assert order == [ids[1], ids[3], ids[0], ids[2]]
+        assert jobs.get(ids[0])['status'] == 'running'
+
+    def test_persistent(self, jobs, tmpdir):
+        """Jobs survive a restart, and running ones are queued again."""
+        done = jobs.submit('a.pdf', 2)['id']
+        failed = jobs.submit('b.pdf', 1)['id']
+        running = jobs.submit('c.pdf')['id']
+        queued = jobs.submit('d.pdf', -1)['id']
+        assert jobs.next_job()['id'] == done
+        jobs.finish(done, 'a_ocr.pdf')
+        assert jobs.next_job()['id'] == failed
+        jobs.finish(failed, error='Boom')
+        assert jobs.next_job()['id'] == running
+
+        restarted = PyJobQueue(str(tmpdir.join('jobs')))
+        assert restarted.get(done)['status'] == 'done'
+        assert restarted.get(done)['output'] == 'a_ocr.pdf'
+        assert restarted.get(failed)['error'] == 'Boom'
+        assert restarted.get(running)['status'] == 'queued'
+        assert [restarted.next_job()['id'] for _ in range(2)] == \
+            [running, queued]
+
+    def test_stop(self, jobs):
+        threading.Timer(0.1, jobs.stop).start()
+        assert jobs.next_job() is None
+
+
+class TestJobServer:
+
+    def test_submit_path(self, jobs, server, tmpdir):
+        tmpdir.join('scan.pdf').write('scan')
+        tmpdir.join('scan_ocr.pdf').write('OCR of scan')
+        code, job = request(server + '/jobs', json.dumps(
+            {'path': str(tmpdir.join('scan.pdf')),
+             'priority': 3}).encode('utf-8'))
+        assert code == 201
+        assert job['status'] == 'queued'
+        assert job['priority'] == 3
+
+        code, body = request(server + '/jobs/%s/result' % job['id'])
+        assert code == 409
+        job = jobs.next_job()
+        jobs.finish(job['id'], str(tmpdir.join('scan_ocr.pdf')),
+                    stats={'seconds': 1.5})
+        code, job = request(server + '/jobs/' + job['id'])
+        assert job['status'] == 'done'
+        assert job['stats'] == {'seconds': 1.5}
+        assert request(server + '/jobs/%s/result' % job['id']) == \
+            (200, b'OCR of scan')
+        code, all_jobs = request(server + '/jobs')
+        assert [j['id'] for j in all_jobs] == [job['id']]
+
+    def test_upload(self, jobs, server):
+        code, job = request(server + '/jobs?priority=2', b'%PDF-1.4 scan',
+                            'application/pdf')
+        assert code == 201
+        assert job['upload'] is True
+        assert job['priority'] == 2
+        with open(job['pdf'], 'rb') as f:
+            assert f.read() == b'%PDF-1.4 scan'
+        assert os.path.dirname(job['pdf']) == jobs.uploads_dir
+
+    def test_stats(self, server, histograms):
+        stats = PyStats('scan.pdf')
+        stats.add_time('tesseract', 0.3)
+        stats.count('pages', 2)
+        histograms.add(stats)
+        code, report = request(server + '/stats')
+        assert code == 200
+        assert report['jobs'] == 1
+        assert report['stages']['tesseract']['count'] == 1
+        assert report['counters'] == {'pages': 2}
+
+    def test_remote_refused(self, jobs):
+        """Only localhost, unless remote clients are explicitly allowed."""
+        assert is_loopback('127.0.0.1')
+        assert is_loopback('localhost')
+        assert not is_loopback('0.0.0.0')
+        with pytest.raises(ValueError):
+            make_server('0.0.0.0:0', jobs)
+        server = make_server('0.0.0.0:0', jobs, allow_remote=True)
+        server.server_close()
+        server = make_server('localhost:0', jobs)
+        server.server_close()
+
+    def test_bad_requests(self, server, tmpdir):
+        assert request(server + '/jobs/0123abcd')[0] == 404
+        assert request(server + '/other')[0] == 404
+        assert request(server + '/jobs', b'not json')[0] == 400
+        assert request(server + '/jobs', json.dumps(
+            {'path': str(tmpdir.join('missing.pdf'))}).encode('utf-8'))[0] \
+            == 400
+
+    @pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                        reason='No Unix sockets')
+    def test_unix_socket(self, jobs, tmpdir):
+        path = str(tmpdir.join('pypdfocr.sock'))
+        server = make_server('unix:' + path, jobs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b'GET /jobs HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                response += data
+            client.close()
+            assert response.startswith(b'HTTP/1.0 200')
+            assert response.endswith(b'[]')
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,100 @@
+import json
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from pypdfocr import pypdfocr_stats
+from pypdfocr.pypdfocr_interrupts import map_in_shared_pool
+from pypdfocr.pypdfocr_stats import (PyHistograms, PyStats, PyTimedIterator,
+                                     count, timed, use_stats)
+
+
+@pytest.fixture
+def stats():
+    return PyStats('scan.pdf')
+
+
+class TestStats:
+
+    def test_report(self, stats):
+        with use_stats(stats):
+            with timed('render'):
+                pass
+            pypdfocr_stats.add_time('tesseract', 2.0)
+            pypdfocr_stats.add_time('tesseract', 1.0)
+            count('pages', 2)
+            count('words', 100)
+        stats.finish()
+        report = stats.get_report()
+        assert report['name'] == 'scan.pdf'
+        assert report['stages']['render']['count'] == 1
+        assert report['stages']['tesseract'] == {
+            'count': 2, 'total': 3.0, 'min': 1.0, 'max': 2.0}
+        assert report['counters'] == {'pages': 2, 'words': 100}
+        assert stats.get_summary().split(', ')[1] == 'tesseract 3.00s'
+
+    def test_no_stats(self):
+        """Nothing is recorded, and nothing breaks, outside a job."""
+        assert pypdfocr_stats.get_current() is None
+        with timed('render'):
+            count('pages')
+
+    def test_nested(self, stats):
+        other = PyStats('other.pdf')
+        with use_stats(stats):
+            with use_stats(other):
+                count('pages')
+            count('pages', 5)
+        assert pypdfocr_stats.get_current() is None
+        assert other.counters == {'pages': 1}
+        assert stats.counters == {'pages': 5}
+
+    def test_shared_pool(self, stats):
+        """Work mapped over the shared pool records into the caller's job."""
+        pool = ThreadPool(processes=2)
+        try:
+            with use_stats(stats):
+                map_in_shared_pool(pool, lambda x: count('pages', x),
+                                   [1, 2, 3])
+            # Stats are not left behind in the pool threads
+            map_in_shared_pool(pool, lambda x: count('pages', x), [10, 20])
+        finally:
+            pool.close()
+            pool.join()
+        assert stats.counters == {'pages': 6}
+
+    def test_timed_iterator(self):
+        words = PyTimedIterator(iter(['a', 'b']))
+        assert list(words) == ['a', 'b']
+        assert words.seconds >= 0.0
+
+
+class TestHistograms:
+
+    def test_histograms(self):
+        histograms = PyHistograms()
+        for seconds in [0.0005, 0.003, 0.003, 5000.0]:
+            stats = PyStats()
+            stats.add_time('tesseract', seconds)
+            stats.count('pages')
+            stats.finish()
+            histograms.add(stats)
+        report = histograms.get_report()
+        assert report['jobs'] == 4
+        assert report['counters'] == {'pages': 4}
+        assert report['stages']['total']['count'] == 4
+        tesseract = report['stages']['tesseract']
+        assert tesseract['count'] == 4
+        assert tesseract['min'] == 0.0005
+        assert tesseract['max'] == 5000.0
+        assert tesseract['buckets'] == {'0.001': 1, '0.004': 2, '+Inf': 1}
+        assert tesseract['p50'] == 0.004
+        assert tesseract['p99'] == 5000.0
+
+    def test_write_report(self, tmpdir):
+        filename = str(tmpdir.join('histograms.json'))
+        pypdfocr_stats.write_report({'jobs': 1}, filename)
+        pypdfocr_stats.write_report({'jobs': 2}, filename)
+        assert json.loads(tmpdir.join('histograms.json').read()) == \
+            {'jobs': 2}
+        assert tmpdir.listdir() == [tmpdir.join('histograms.json')]
@@ -4,8 +4,11 @@ import subprocess
 
 import pytest
 import mock
+from multiprocessing.pool import ThreadPool
 
 from pypdfocr import pypdfocr_tesseract
+from pypdfocr.pypdfocr_cache import PyCache
+from pypdfocr.pypdfocr_cpu import PyCpuBudget
 
 
 class TestTesseract:
@@ -177,3 +180,103 @@ class TestTesseract:
         assert os.path.exists(outp)
         with open(outp) as f:
             assert 'Lorum' in f.read()
+
+    def test_persistent_no_tesserocr(self, monkeypatch, caplog):
+        monkeypatch.setattr(pypdfocr_tesseract, 'TESSEROCR_ENABLED', False)
+        pyts = pypdfocr_tesseract.PyTesseract({'persistent': True})
+        assert pyts.engines is None
+        assert "tesserocr" in caplog.text
+
+    @pytest.fixture
+    def mock_tesserocr(self, monkeypatch):
+        tesserocr = mock.Mock()
+        tesserocr.tesseract_version.return_value = \
+            "tesseract 4.1.1\n leptonica-1.79.0"
+        tesserocr.PyTessBaseAPI.side_effect = lambda **kw: mock.Mock(
+            GetHOCRText=mock.Mock(return_value=u"<div class='ocr_page'/>"))
+        monkeypatch.setattr(pypdfocr_tesseract, 'TESSEROCR_ENABLED', True)
+        monkeypatch.setattr(pypdfocr_tesseract, 'tesserocr', tesserocr,
+                            raising=False)
+        return tesserocr
+
+    def test_persistent_engines(self, mock_tesserocr, tmpdir):
+        """Engines are loaded once per language and reused for every page."""
+        pyts = pypdfocr_tesseract.PyTesseract({'persistent': True,
+                                               'threads': 1})
+        assert pyts.ts_version == "4.1.1"
+        fns = []
+        for name in ['a.jpg', 'b.jpg']:
+            tmpdir.join(name).write('')
+            fns.append(str(tmpdir.join(name)))
+        result = pyts.make_hocr_from_pnms(fns)
+        assert result == [(fns[0], str(tmpdir.join('a.hocr'))),
+                          (fns[1], str(tmpdir.join('b.hocr')))]
+        assert "<div class='ocr_page'/>" in tmpdir.join('a.hocr').read()
+        assert mock_tesserocr.PyTessBaseAPI.call_count == 1
+
+        pyts.lang = 'deu'
+        pyts.make_hocr_from_pnm(fns[0])
+        assert mock_tesserocr.PyTessBaseAPI.call_count == 2
+        pyts.engines.close()
+        assert pyts.engines.idle == {}
+
+    def test_shared_pool(self, monkeypatch, pyts, caplog):
+        """A failing page in a shared pool exits instead of hanging."""
+        pyts._ts_version = "4.01"
+        pyts.pool = ThreadPool(2)
+        monkeypatch.setattr('os.path.exists', mock.Mock(return_value=True))
+        monkeypatch.setattr('os.path.isfile', mock.Mock(return_value=True))
+        monkeypatch.setattr('subprocess.check_output', mock.Mock())
+        assert pyts.make_hocr_from_pnms(['foo.tiff', 'bar.tiff']) == \
+            [("foo.tiff", "foo.hocr"), ("bar.tiff", "bar.hocr")]
+
+        monkeypatch.setattr('os.path.exists', mock.Mock(return_value=False))
+        with pytest.raises(SystemExit):
+            pyts.make_hocr_from_pnms(['foo.tiff'])
+        assert pyts.msgs['TS_img_MISSING'] in caplog.text
+        pyts.pool.close()
+
+    def test_cache(self, monkeypatch, pyts, tmpdir):
+        """A page that was OCR'ed before skips tesseract."""
+        pyts._ts_version = "4.01"
+        pyts.cache = PyCache(str(tmpdir.join('cache')), 1 << 20, '.hocr')
+
+        def run_tesseract(cmd, **kwargs):
+            basename = cmd.split('"')[3]
+            with open(basename + '.hocr', 'w') as f:
+                f.write('hocr of ' + basename)
+        check_output = mock.Mock(side_effect=run_tesseract)
+        monkeypatch.setattr('subprocess.check_output', check_output)
+
+        tmpdir.join('a.jpg').write('page')
+        tmpdir.join('b.jpg').write('page')
+        tmpdir.join('c.jpg').write('other page')
+        for name in ['a', 'b', 'c']:
+            pyts.make_hocr_from_pnm(str(tmpdir.join(name + '.jpg')))
+        assert check_output.call_count == 2
+        assert tmpdir.join('b.hocr').read() == \
+            'hocr of ' + str(tmpdir.join('a'))
+
+        # Changing the language changes the key
+        pyts.lang = 'deu'
+        pyts.make_hocr_from_pnm(str(tmpdir.join('a.jpg')))
+        assert check_output.call_count == 3
+        assert pyts.cache.stats()['hits'] == 1
+
+    def test_cpu_budget(self, monkeypatch, pyts):
+        """Each tesseract run holds omp_threads tokens and is limited to
+        that many OpenMP threads."""
+        pyts._ts_version = "4.01"
+        pyts.budget = PyCpuBudget(3)
+        pyts.omp_threads = 2
+        monkeypatch.setattr('os.path.exists', mock.Mock(return_value=True))
+        monkeypatch.setattr('os.path.isfile', mock.Mock(return_value=True))
+
+        def run_tesseract(cmd, **kwargs):
+            assert pyts.budget.free == 1
+            assert kwargs['env']['OMP_THREAD_LIMIT'] == '2'
+        check_output = mock.Mock(side_effect=run_tesseract)
+        monkeypatch.setattr('subprocess.check_output', check_output)
+        pyts.make_hocr_from_pnm('foo.tiff')
+        assert check_output.call_count == 1
+        assert pyts.budget.free == 3
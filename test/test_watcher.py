@@ -77,3 +77,15 @@ class TestWatching:
         # After returning filename once, check it's removed from the queue
         assert watcher.check_queue() is None
         assert 'blah.pdf' not in watcher.events
+
+    def test_check_queue_all(self, watcher):
+        """Every file that is ready is returned in one scan."""
+        watcher.events['a.pdf'] = time.time() - 4
+        watcher.events['b.pdf'] = time.time() - 4
+        watcher.events['c.pdf'] = time.time()
+        assert sorted(watcher.check_queue_all()) == ['a.pdf', 'b.pdf']
+        assert watcher.events['a.pdf'] == -1
+        assert watcher.events['b.pdf'] == -1
+        assert watcher.check_queue_all() == []
+        assert 'a.pdf' not in watcher.events
+        assert 'c.pdf' in watcher.events